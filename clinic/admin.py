@@ -3,12 +3,15 @@ from smtplib import SMTPException
 
 from django.contrib import admin, messages
 from django.core.mail import send_mail
+from django.db.models import Count, IntegerField, OuterRef, Subquery
 from django.template.loader import render_to_string
 from django.contrib.sites.shortcuts import get_current_site
 from django.urls import reverse
 from django.utils.translation import gettext as _
 
+from clinic.instrumentation import timed
 from clinic.models import *
+from clinic.routers import use_replica
 
 logger = logging.getLogger(__name__)
 
@@ -19,9 +22,20 @@ class SiteAdmin(admin.ModelAdmin):
 			qs = qs.filter(site=get_current_site(request))
 		return qs
 
+	def changelist_view(self, request, extra_context=None):
+		# browsing lists can be served by a replica, but actions (POST) must read what they change
+		if request.method != 'GET':
+			return super().changelist_view(request, extra_context)
+		with use_replica():
+			response = super().changelist_view(request, extra_context)
+			if hasattr(response, 'render'):
+				response.render()
+		return response
+
 class DoctorAdmin(SiteAdmin):
 	list_display=('name', 'provider_type', 'verified', 'get_languages', 'push_token', 'in_session', 'last_seen')
-	readonly_fields=('access_url', 'credentials', 'utc_offset', 'last_seen', 'last_notified', 'self_certification_questions', 'remarks', 'in_session', 'ip_address', 'user_agent')
+	readonly_fields=('access_url', 'credentials', 'utc_offset', 'last_seen', 'last_notified', 'next_notify_at', 'self_certification_questions', 'remarks', 'in_session', 'ip_address', 'user_agent')
+	list_select_related=('presence',)
 
 	def get_languages(self, obj):
 		return ", ".join([l.name for l in obj.languages.all()])
@@ -30,6 +44,11 @@ class DoctorAdmin(SiteAdmin):
 	def push_token(self, obj):
 		return bool(obj.fcm_token)
 
+	def last_seen(self, obj):
+		return obj.presence.last_seen
+	last_seen.short_description = _("last seen")
+	last_seen.admin_order_field = 'presence__last_seen'
+
 	def access_url(self, obj):
 		if obj.pk:
 			return reverse('consultation') + '?provider_id=' + str(obj.uuid)
@@ -56,13 +75,14 @@ class DoctorAdmin(SiteAdmin):
 		}
 		msg_plain = render_to_string('clinic/provider_approval_email.txt', context)
 		msg_html = render_to_string('clinic/provider_approval_email.html', context)
-		send_mail(
-			"Welcome to doc19.org!",
-			msg_plain,
-			"doc19.org team <contact@doc19.org>",
-			[obj.email],
-			html_message=msg_html
-		)
+		with timed('external'):
+			send_mail(
+				"Welcome to doc19.org!",
+				msg_plain,
+				"doc19.org team <contact@doc19.org>",
+				[obj.email],
+				html_message=msg_html
+			)
 
 	def save_model(self, request, obj, form, change):
 		if not request.user.is_superuser and not hasattr(obj, 'site'):
@@ -95,7 +115,23 @@ class CallSummaryInline(admin.StackedInline):
 
 class PatientAdmin(SiteAdmin):
 	inlines = [CallSummaryInline]
-	list_display=('id', 'language', 'doctor', 'session_started', 'wait_duration', 'call_duration', 'call_success')
+	list_display=('id', 'language', 'doctor', 'session_started', 'wait_duration', 'call_duration', 'call_success', 'unread_messages')
+	list_select_related=('language', 'presence__doctor')
+
+	def get_queryset(self, request):
+		# counted in the list's query, from the index of unread messages
+		unread = ChatMessage.get_unread(ChatMessage.objects.filter(patient=OuterRef('uuid')), by_doctor=True)
+		unread = unread.order_by().values('patient').annotate(count=Count('pk')).values('count')
+		return super().get_queryset(request).annotate(unread_messages=Subquery(unread, output_field=IntegerField()))
+
+	def doctor(self, obj):
+		return obj.presence.doctor
+	doctor.short_description = _("provider")
+
+	def session_started(self, obj):
+		return obj.presence.session_started
+	session_started.short_description = _("session started")
+	session_started.admin_order_field = 'presence__session_started'
 
 	def call_duration(self, obj):
 		return obj.callsummary.duration
@@ -103,6 +139,11 @@ class PatientAdmin(SiteAdmin):
 	def call_success(self, obj):
 		return obj.callsummary.successful
 
+	def unread_messages(self, obj):
+		return obj.unread_messages or 0
+	unread_messages.short_description = _("unread messages")
+	unread_messages.admin_order_field = 'unread_messages'
+
 	def get_list_filter(self, request):
 		list_filter=('language', 'feedback_response')
 		if request.user.is_superuser:
@@ -0,0 +1,118 @@
+"""
+Cold storage for patients whose calls are long over.
+
+archive_patients writes each batch of patients, with their presence row,
+call summary, Twilio call events and any remaining chat messages, as
+gzipped JSON lines to ARCHIVE_STORAGE, and only then deletes them from the
+database. Files are named patients/<date archived>/<first id>-<last id>.jsonl.gz
+so restore_patient can find a patient's record without an index.
+"""
+
+from datetime import datetime
+import gzip, json, re
+
+from django.conf import settings
+from django.core import serializers
+from django.core.files.base import ContentFile
+from django.core.serializers.json import DjangoJSONEncoder
+from django.db import transaction
+from django.db.models import Q
+from django.utils.module_loading import import_string
+
+from clinic.models import *
+
+PREFIX = 'patients'
+
+FILE_NAME = re.compile(r'(\d+)-(\d+)\.jsonl\.gz$')
+
+def storage():
+	return import_string(settings.ARCHIVE_STORAGE)(location=settings.ARCHIVE_LOCATION)
+
+def archivable(cutoff):
+	"Patients whose call ended, or who gave up waiting, before cutoff."
+	ended = Q(presence__session_ended__lt=cutoff)
+	abandoned = Q(presence__session_started__isnull=True, created__lt=cutoff) & (Q(presence__last_seen__isnull=True) | Q(presence__last_seen__lt=cutoff))
+	# patients involved in a report are kept, since reports protect them from deletion
+	return Patient.objects.filter(ended | abandoned).filter(report__isnull=True, reported_by__isnull=True)
+
+def serialize(objects):
+	return serializers.serialize('python', objects)
+
+def records(patients):
+	"Return one JSON-serializable record per patient, holding everything archive_batch deletes."
+	events = {p.id: [] for p in patients}
+	for e in CallEvent.objects.filter(patient_id__in=events).order_by('id'):
+		events[e.patient_id].append(e)
+	messages = {p.uuid: [] for p in patients}
+	for m in ChatMessage.objects.filter(patient_id__in=messages).order_by('id'):
+		messages[m.patient_id].append(m)
+
+	for p in patients:
+		objects = [p, p.presence]
+		try:
+			objects.append(p.callsummary)
+		except CallSummary.DoesNotExist:
+			pass
+		yield {
+			'id': p.id,
+			'uuid': str(p.uuid),
+			'objects': serialize(objects + events[p.id] + messages[p.uuid]),
+		}
+
+def archive_batch(ids, cutoff):
+	"""
+	Write the patients with these ids that are still archivable as of cutoff
+	to storage and delete them; return the name of the file written and how
+	many were archived, or None and 0 if none were left.
+	"""
+	with transaction.atomic():
+		# locked until they're deleted, so that nothing added for them in between (a late
+		# Twilio callback, a chat message written behind) is deleted without being archived,
+		# and checked again once locked, since they may have changed since the ids were read
+		patients = list(archivable(cutoff).filter(id__in=ids).select_for_update(of=('self',)).select_related('presence', 'callsummary').order_by('id'))
+		if not patients:
+			return None, 0
+		ids = [p.id for p in patients]
+		lines = [json.dumps(record, cls=DjangoJSONEncoder) for record in records(patients)]
+		name = '{}/{:%Y-%m-%d}/{}-{}.jsonl.gz'.format(PREFIX, datetime.now(), patients[0].id, patients[-1].id)
+		name = storage().save(name, ContentFile(gzip.compress('\n'.join(lines).encode('utf-8'))))
+
+		uuids = [p.uuid for p in patients]
+		CallEvent.objects.filter(patient_id__in=ids).delete()
+		ChatMessage.objects.filter(patient_id__in=uuids).delete()
+		CallSummary.objects.filter(patient_id__in=ids).delete()
+		PatientPresence.objects.filter(patient_id__in=ids).delete()
+		Patient.objects.filter(id__in=ids).delete()
+	return name, len(patients)
+
+def archive_files(s, path=PREFIX):
+	try:
+		dirs, files = s.listdir(path)
+	except FileNotFoundError:
+		# nothing has been archived to this filesystem yet
+		return
+	for name in files:
+		yield path + '/' + name
+	for d in sorted(dirs):
+		yield from archive_files(s, path + '/' + d)
+
+def find(patient_id):
+	"Return the archived record of a patient, or None."
+	s = storage()
+	for name in archive_files(s):
+		match = FILE_NAME.search(name)
+		if not match or not int(match.group(1)) <= patient_id <= int(match.group(2)):
+			continue
+		with s.open(name) as f:
+			for line in gzip.decompress(f.read()).decode('utf-8').splitlines():
+				record = json.loads(line)
+				if record['id'] == patient_id:
+					return record
+	return None
+
+@transaction.atomic
+def restore(record):
+	"Put an archived patient and their related rows back in the database."
+	for obj in serializers.deserialize('python', record['objects']):
+		# saved as raw, so the presence row comes from the archive rather than the post_save receiver
+		obj.save()
@@ -0,0 +1,95 @@
+"""
+Async versions of the endpoints clients poll, served instead of the ones in
+views.py when ASYNC_VIEWS is set (see clinic/urls.py and medicam/asgi.py).
+
+Under an ASGI server a long poll waiting in wait() is a suspended coroutine
+rather than a worker thread, so one process can hold as many waiting callers
+as it has sockets for (see the bench_idle_connections command). The queries
+are the sync helpers in views.py, run in Django's thread pool through
+sync_to_async; everything else stays on the event loop.
+
+That only holds while every middleware is async-capable (see
+clinic/middleware.py, and the opt-in INSTRUMENTATION and PROFILING
+middleware). Django 3.2's view decorators don't preserve coroutine
+functions either, so these check the method and mark CSRF exemption by
+hand.
+"""
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotAllowed, HttpResponseNotFound, JsonResponse
+
+from clinic import metrics, pubsub, views
+
+async def wait(request):
+	"Long poll, like views.wait."
+	if not settings.LONG_POLL_TIMEOUT:
+		raise Http404
+
+	patient_id = request.COOKIES.get('patient_id')
+	doctor_id = request.COOKIES.get('doctor_id')
+	if not patient_id and not doctor_id:
+		return HttpResponseBadRequest("patient_id or doctor_id required")
+
+	patient_uuid = await sync_to_async(views.consultation_uuid)(patient_id, doctor_id)
+	if patient_uuid is None:
+		return HttpResponseNotFound("no consultation")
+
+	async with pubsub.subscribe_async(patient_uuid) as waiter:
+		presence = await sync_to_async(views.consultation_state)(patient_uuid, waiting_caller=bool(patient_id))
+		if presence is None:
+			return HttpResponseNotFound("no consultation")
+		event = views.unseen_event(presence, request.GET.get('state'))
+		if event:
+			return JsonResponse({'event': event})
+		if presence['session_started']:
+			await sync_to_async(views.seen)(patient_id, doctor_id)
+
+		message = await waiter.get(settings.LONG_POLL_TIMEOUT)
+	if message is None:
+		return HttpResponse(status=204)
+	return JsonResponse({'event': message['event']})
+
+async def queue(request):
+	if request.method != 'GET':
+		return HttpResponseNotAllowed(['GET'])
+	patient_id = request.COOKIES.get('patient_id')
+	if not patient_id:
+		return HttpResponseBadRequest("patient_id required")
+	status = await sync_to_async(views.queue_status)(patient_id)
+	if status is None:
+		return HttpResponseNotFound("not waiting")
+	return JsonResponse(status)
+
+async def chat(request):
+	if request.method not in ('GET', 'POST'):
+		return HttpResponseNotAllowed(['GET', 'POST'])
+	metrics.CHAT_REQUESTS.labels(method=request.method).inc()
+
+	patient_id = request.COOKIES.get('patient_id')
+	doctor_id = request.COOKIES.get('doctor_id')
+	if not patient_id and not doctor_id:
+		return HttpResponseBadRequest("patient_id or doctor_id required")
+
+	patient_uuid = await sync_to_async(views.consultation_uuid)(patient_id, doctor_id)
+	if patient_uuid is None:
+		return HttpResponseNotFound("no active session")
+	await sync_to_async(views.seen)(patient_id, doctor_id)
+
+	if request.method == 'POST':
+		try:
+			await sync_to_async(views.save_chat_message)(patient_uuid, doctor_id, request.body)
+		except ValueError:
+			return HttpResponseBadRequest("uuid and text required")
+		return HttpResponse(status=200)
+
+	messages = await sync_to_async(views.chat_messages)(patient_uuid, patient_id, doctor_id)
+	return JsonResponse({'messages': messages})
+
+async def twilio_status_callback(request):
+	if request.method != 'POST':
+		return HttpResponseNotAllowed(['POST'])
+	metrics.CALLBACKS.labels(event=metrics.callback_event_label(request.POST.get('StatusCallbackEvent'))).inc()
+	await sync_to_async(views.save_call_event)(views.call_event(request.POST))
+	return HttpResponse(status=200)
+twilio_status_callback.csrf_exempt = True
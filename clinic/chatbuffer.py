@@ -0,0 +1,321 @@
+"""
+Write-behind buffer for chat messages, whether they're sent over the chat
+socket (see clinic/sockets.py) or posted to views.chat.
+
+post() checks a message, acknowledges it at once and hands it to the other
+participant through pubsub. It then appends the message to its room's
+buffer in the cache. A thread in each process writes the buffered messages
+of every room with one bulk_create every CHAT_FLUSH_INTERVAL seconds, or
+as soon as CHAT_FLUSH_SIZE are waiting in a process. Readers merge a
+room's buffer with what's in the database (see views.chat_messages), so a
+message shows up straight away even before it's written.
+
+The cache only guarantees add() is atomic, so rooms and the set of rooms
+waiting to be written are locked with it. Messages are only buffered when
+CACHE_BACKEND points somewhere the workers share; with the default
+per-process cache each one is written as it's sent. A message a client
+sends twice, e.g. when retrying, is only stored once, even when the retry
+reaches another worker. Whatever is still buffered when a process exits is
+written then.
+
+Read receipts work the same way. Each time a participant is sent the
+other's messages, mark_read() moves their cursor for the consultation up
+to the newest of them, and the flush sets ChatMessage.read on everything
+under every cursor that moved with one UPDATE.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime
+import atexit, json, logging, os, threading, time, uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Q
+
+from clinic import pubsub
+from clinic.clients import once
+from clinic.models import *
+
+logger = logging.getLogger(__name__)
+
+# Postgres NOTIFY payloads must be shorter than 8000 bytes; longer messages are published without their text
+MAX_PUBLISHED_BYTES = 7000
+
+# buffered messages and the UUIDs of messages seen, which catch duplicates, are kept this long
+BUFFER_TIMEOUT = 24 * 60 * 60
+LOCK_TIMEOUT = 5
+
+# caches that each process keeps to itself, which can't be shared between workers
+LOCAL_CACHES = (
+	'django.core.cache.backends.locmem.LocMemCache',
+	'django.core.cache.backends.dummy.DummyCache',
+)
+
+DIRTY_KEY = 'chat:dirty' # rooms with buffered messages
+CURSORS_KEY = 'chat:cursors' # (room, reader) pairs whose cursor moved since the last flush
+FLUSH_LOCK = 'chat:flushing'
+
+# readers
+PATIENT = 'patient'
+DOCTOR = 'doctor'
+
+def buffer_key(patient_uuid):
+	return 'chat:buffer:{}'.format(patient_uuid)
+
+def seen_key(message_uuid):
+	return 'chat:seen:{}'.format(message_uuid)
+
+def cursor_key(patient_uuid, reader):
+	return 'chat:cursor:{}:{}'.format(patient_uuid, reader)
+
+def shared_cache():
+	"Return whether the cache is shared by the workers."
+	return settings.CACHES['default']['BACKEND'] not in LOCAL_CACHES
+
+def buffering():
+	return bool(settings.CHAT_FLUSH_INTERVAL) and shared_cache()
+
+class LockTimeout(Exception):
+	pass
+
+@contextmanager
+def locked(key):
+	"Hold a lock on key, shared through the cache; raise LockTimeout if it can't be had."
+	key += ':lock'
+	token = uuid.uuid4().hex
+	# a holder that died lets its lock expire after LOCK_TIMEOUT, so waiting longer means it's busy
+	deadline = time.monotonic() + LOCK_TIMEOUT + 1
+	while not cache.add(key, token, LOCK_TIMEOUT):
+		if time.monotonic() > deadline:
+			raise LockTimeout(key)
+		time.sleep(0.005)
+	try:
+		yield
+	finally:
+		# the lock may have expired and been taken by someone else meanwhile
+		if cache.get(key) == token:
+			cache.delete(key)
+
+def add_to_set(key, members):
+	with locked(key):
+		cache.set(key, cache.get(key, set()) | members, None)
+
+def pop_set(key):
+	with locked(key):
+		members = cache.get(key, set())
+		cache.delete(key)
+	return members
+
+def buffered(patient_uuid):
+	"Return the messages waiting to be written for a patient's consultation."
+	return cache.get(buffer_key(patient_uuid), [])
+
+def to_model(message):
+	return ChatMessage(
+		uuid=message['uuid'],
+		patient_id=message['patient_id'],
+		doctor_id=message['doctor_id'],
+		text=message['text'],
+		sent=message['sent'],
+	)
+
+def unstored(messages):
+	"Return models of the messages that aren't stored yet, locking their rooms until the transaction ends."
+	rooms = {m['patient_id'] for m in messages}
+	# the partitioned table only refuses a uuid stored again with the same sent, and a retry is sent
+	# later, so writers of a room take turns to check what's stored
+	list(Patient.objects.filter(uuid__in=rooms).order_by('id').select_for_update().values_list('id'))
+	stored = {str(u) for u in ChatMessage.objects.filter(patient_id__in=rooms, uuid__in=[m['uuid'] for m in messages]).values_list('uuid', flat=True)}
+	new = []
+	for m in messages:
+		if m['uuid'] not in stored:
+			stored.add(m['uuid'])
+			new.append(to_model(m))
+	return new
+
+def write(messages):
+	try:
+		with transaction.atomic():
+			ChatMessage.objects.bulk_create(unstored(messages), ignore_conflicts=True)
+	except IntegrityError:
+		# e.g. a patient who doesn't exist (any more); write the others one at a time
+		for m in messages:
+			try:
+				with transaction.atomic():
+					ChatMessage.objects.bulk_create(unstored([m]), ignore_conflicts=True)
+			except IntegrityError:
+				logger.warning("Dropped chat message %s", m['uuid'])
+
+def append(message):
+	room = message['patient_id']
+	with locked(buffer_key(room)):
+		messages = buffered(room)
+		cache.set(buffer_key(room), messages + [message], BUFFER_TIMEOUT)
+	if not messages:
+		# rooms are marked when their buffer fills, and flush() keeps them marked while messages remain
+		add_to_set(DIRTY_KEY, {room})
+	writer().added()
+
+def flush():
+	"Write the buffered messages of every room, then the read receipts; return how many messages were written."
+	if not cache.add(FLUSH_LOCK, True, LOCK_TIMEOUT * 12):
+		return 0 # another process is at it
+	try:
+		count = flush_messages()
+		flush_cursors()
+		return count
+	finally:
+		cache.delete(FLUSH_LOCK)
+
+def flush_messages():
+	rooms = pop_set(DIRTY_KEY)
+	if not rooms:
+		return 0
+	try:
+		messages = [m for messages in cache.get_many([buffer_key(r) for r in rooms]).values() for m in messages]
+		write(messages)
+	except Exception:
+		add_to_set(DIRTY_KEY, rooms)
+		raise
+
+	written = {m['uuid'] for m in messages}
+	remaining = set()
+	for room in rooms:
+		with locked(buffer_key(room)):
+			# messages appended since the buffers were read stay
+			left = [m for m in buffered(room) if m['uuid'] not in written]
+			if left:
+				cache.set(buffer_key(room), left, BUFFER_TIMEOUT)
+				remaining.add(room)
+			else:
+				cache.delete(buffer_key(room))
+	if remaining:
+		add_to_set(DIRTY_KEY, remaining)
+	return len(messages)
+
+def flush_cursors():
+	moved = pop_set(CURSORS_KEY)
+	if not moved:
+		return
+	try:
+		cursors = cache.get_many([cursor_key(room, reader) for room, reader in moved])
+		seen = Q()
+		for room, reader in moved:
+			sent = cursors.get(cursor_key(room, reader))
+			if sent:
+				seen |= Q(patient_id=room, sent__lte=sent, doctor__isnull=reader == DOCTOR)
+		if seen:
+			ChatMessage.objects.filter(seen, read__isnull=True).update(read=datetime.now())
+	except Exception:
+		add_to_set(CURSORS_KEY, moved)
+		raise
+	for room in {room for room, reader in moved}:
+		# lets senders show that their messages were read
+		pubsub.send(room, pubsub.READ)
+
+def mark_read(patient_uuid, reader, sent):
+	"Move the cursor of the caller or provider (reader) up to sent, when they've been sent the other's messages up to then."
+	key = cursor_key(patient_uuid, reader)
+	current = cache.get(key)
+	if current and current >= sent:
+		return
+	with locked(key):
+		current = cache.get(key)
+		if current and current >= sent:
+			return
+		cache.set(key, sent, BUFFER_TIMEOUT)
+	add_to_set(CURSORS_KEY, {(str(patient_uuid), reader)})
+	if buffering():
+		# a process may only ever read, and still has to write what was read
+		writer().ensure_flushing()
+	else:
+		flush_cursors()
+
+class Writer:
+	"Flushes the buffer from a thread in each process that adds to it."
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.count = 0 # messages this process buffered since the last flush
+		self.wakeup = threading.Event()
+		self.thread = None
+		self.pid = None
+
+	def added(self):
+		with self.lock:
+			self.count += 1
+			full = self.count >= settings.CHAT_FLUSH_SIZE
+		self.ensure_flushing()
+		if full:
+			self.wakeup.set()
+
+	def ensure_flushing(self):
+		# started by the first message, so it's never inherited by forked gunicorn workers
+		with self.lock:
+			if self.thread is None or self.pid != os.getpid():
+				self.pid = os.getpid()
+				self.thread = threading.Thread(target=self.run, name='chat-writer', daemon=True)
+				self.thread.start()
+				atexit.register(flush)
+
+	def run(self):
+		while True:
+			self.wakeup.wait(settings.CHAT_FLUSH_INTERVAL)
+			self.wakeup.clear()
+			with self.lock:
+				self.count = 0
+			try:
+				close_old_connections()
+				flush()
+			except Exception:
+				logger.exception("Could not write chat messages, retrying")
+
+@once
+def writer():
+	return Writer()
+
+def post(patient_uuid, doctor_id, data, doctor_name=None):
+	"""
+	Accept a chat message from the caller, or from the provider if doctor_id
+	is set, in the consultation of patient_uuid. Raise ValueError if data
+	isn't a message with a valid uuid and some text.
+	"""
+	text = data.get('text') if isinstance(data, dict) else None
+	if not isinstance(text, str) or not text:
+		raise ValueError("text required")
+	message_uuid = str(uuid.UUID(str(data.get('uuid'))))
+	patient_uuid = str(uuid.UUID(str(patient_uuid)))
+	if not cache.add(seen_key(message_uuid), True, BUFFER_TIMEOUT):
+		return # a retry of a message that was already accepted
+
+	if doctor_id and doctor_name is None:
+		doctor_name = Doctor.objects.filter(uuid=doctor_id).values_list('name', flat=True).first() or ''
+	message = {
+		'uuid': message_uuid,
+		'patient_id': patient_uuid,
+		'doctor_id': str(doctor_id) if doctor_id else None,
+		'doctor_name': doctor_name if doctor_id else None,
+		'text': text,
+		'sent': datetime.now(),
+	}
+	published = {
+		'uuid': message_uuid,
+		'doctor_name': message['doctor_name'],
+		'sent': message['sent'].isoformat(),
+		'time': message['sent'].timestamp() * 1000, # JS uses milliseconds
+		'text': text,
+	}
+	if len(json.dumps(published).encode('utf-8')) > MAX_PUBLISHED_BYTES:
+		# sockets read it back instead, and may not share the buffer, so it can't wait to be written
+		del published['text']
+
+	try:
+		if 'text' not in published or not buffering():
+			write([message])
+		else:
+			append(message)
+	except Exception:
+		# let the client try again
+		cache.delete(seen_key(message_uuid))
+		raise
+	pubsub.send(patient_uuid, pubsub.MESSAGE, **published)
@@ -0,0 +1,62 @@
+"""
+Clients for external services, initialized on first use.
+
+Importing the Firebase, Sentry and Twilio SDKs takes longer than starting
+Django itself, so they're imported here when first needed rather than when
+settings or views load. Web workers pay for each one on the first request
+that uses it, and management commands that never send a notification or
+set up a call don't pay for them at all (see the startup_report command).
+"""
+
+import functools, json, threading
+
+from django.conf import settings
+
+_lock = threading.Lock()
+
+def once(func):
+	"Call func the first time the accessor is used and return the same result afterwards."
+	result = []
+	@functools.wraps(func)
+	def accessor():
+		if not result:
+			with _lock:
+				if not result:
+					result.append(func())
+		return result[0]
+	return accessor
+
+@once
+def firebase_messaging():
+	import firebase_admin
+	from firebase_admin import credentials, messaging
+	if settings.FIREBASE_SERVICE_ACCOUNT:
+		firebase_admin.initialize_app(credentials.Certificate(json.loads(settings.FIREBASE_SERVICE_ACCOUNT)))
+	return messaging
+
+@once
+def twilio_access_token():
+	from twilio.jwt import access_token
+	from twilio.jwt.access_token import grants
+	return access_token
+
+@once
+def http():
+	# a shared session keeps connections to Twilio alive between calls
+	import requests
+	return requests.Session()
+
+@once
+def sentry():
+	import sentry_sdk
+	if settings.SENTRY_DSN:
+		from sentry_sdk.integrations.django import DjangoIntegration
+		sentry_sdk.init(dsn=settings.SENTRY_DSN, integrations=[DjangoIntegration()], send_default_pii=False)
+	return sentry_sdk
+
+def report_exception(e):
+	"Send an exception raised outside a web worker to Sentry, initializing it first."
+	if settings.SENTRY_DSN:
+		sentry_sdk = sentry()
+		sentry_sdk.capture_exception(e)
+		sentry_sdk.flush()
@@ -5,3 +5,13 @@ def sentry_config(request):
 		return {'SENTRY_CONFIG': {'dsn': settings.SENTRY_DSN}}
 	else:
 		return {}
+
+def long_polling(request):
+	return {'LONG_POLL': bool(settings.LONG_POLL_TIMEOUT)}
+
+def chat_socket(request):
+	# the chat socket is served by medicam/asgi.py, which also turns on ASYNC_VIEWS
+	if settings.ASYNC_VIEWS:
+		from clinic.sockets import CHAT_PATH
+		return {'CHAT_SOCKET': CHAT_PATH}
+	return {}
@@ -0,0 +1,238 @@
+"""
+Opt-in per-view instrumentation.
+
+When settings.INSTRUMENTATION is enabled, InstrumentationMiddleware records
+the query count, DB time, external call time (Twilio, FCM, email) and
+template render time of every request. The timings are sent back in a
+Server-Timing header and aggregated into per-view histograms, which each
+worker periodically writes to INSTRUMENTATION_DIR for the
+instrumentation_report command to merge.
+"""
+
+from collections import defaultdict
+from contextlib import contextmanager
+import asyncio, contextvars, json, os, threading, time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.db.backends.signals import connection_created
+from django.template.backends import django as django_backend
+
+# upper bounds of the histogram buckets, in milliseconds
+BUCKETS = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, float('inf'))
+
+TIMINGS = ('total', 'db', 'external', 'render')
+
+FLUSH_INTERVAL = 10 # seconds
+
+# a context variable rather than a thread local, since sync_to_async carries it into the
+# threads where async views run their queries
+_timings = contextvars.ContextVar('timings', default=None)
+
+class RequestTimings:
+	def __init__(self):
+		self.queries = 0
+		self.ms = dict.fromkeys(TIMINGS, 0.0)
+
+	def record_query(self, execute, sql, params, many, context):
+		start = time.perf_counter()
+		try:
+			return execute(sql, params, many, context)
+		finally:
+			self.queries += 1
+			self.ms['db'] += (time.perf_counter() - start) * 1000
+
+	def server_timing(self):
+		return ', '.join([
+			'total;dur={:.1f}'.format(self.ms['total']),
+			'db;dur={:.1f};desc="{} queries"'.format(self.ms['db'], self.queries),
+			'external;dur={:.1f}'.format(self.ms['external']),
+			'render;dur={:.1f}'.format(self.ms['render']),
+		])
+
+@contextmanager
+def timed(kind):
+	"Add the time spent in the block to the current request's `kind` timing, if it's being instrumented."
+	timings = _timings.get()
+	if timings is None:
+		yield
+		return
+	start = time.perf_counter()
+	try:
+		yield
+	finally:
+		timings.ms[kind] += (time.perf_counter() - start) * 1000
+
+class Histogram:
+	def __init__(self, counts=None, total=0.0):
+		self.counts = counts or [0] * len(BUCKETS)
+		self.total = total
+
+	def observe(self, value):
+		self.total += value
+		for i, bound in enumerate(BUCKETS):
+			if value <= bound:
+				self.counts[i] += 1
+				return
+
+	def merge(self, other):
+		self.counts = [a + b for a, b in zip(self.counts, other.counts)]
+		self.total += other.total
+
+	@property
+	def count(self):
+		return sum(self.counts)
+
+	def quantile(self, q):
+		"Return the upper bound of the bucket containing the q-th quantile."
+		rank = q * self.count
+		seen = 0
+		for bound, count in zip(BUCKETS, self.counts):
+			seen += count
+			if count and seen >= rank:
+				return bound
+		return 0
+
+class ViewStats:
+	def __init__(self):
+		self.histograms = {kind: Histogram() for kind in TIMINGS + ('queries',)}
+
+	def observe(self, timings):
+		for kind in TIMINGS:
+			self.histograms[kind].observe(timings.ms[kind])
+		self.histograms['queries'].observe(timings.queries)
+
+	def to_dict(self):
+		return {kind: {'counts': h.counts, 'total': h.total} for kind, h in self.histograms.items()}
+
+	@classmethod
+	def from_dict(cls, data):
+		stats = cls()
+		for kind, h in data.items():
+			stats.histograms[kind] = Histogram(h['counts'], h['total'])
+		return stats
+
+	def merge(self, other):
+		for kind, h in other.histograms.items():
+			self.histograms[kind].merge(h)
+
+_stats = defaultdict(ViewStats)
+_stats_lock = threading.Lock()
+_last_flush = time.monotonic()
+
+def snapshot_path(pid=None):
+	return os.path.join(settings.INSTRUMENTATION_DIR, '{}.json'.format(pid or os.getpid()))
+
+def flush():
+	"Write this process's histograms to INSTRUMENTATION_DIR."
+	global _last_flush
+	with _stats_lock:
+		data = {view: stats.to_dict() for view, stats in _stats.items()}
+		_last_flush = time.monotonic()
+	os.makedirs(settings.INSTRUMENTATION_DIR, exist_ok=True)
+	path = snapshot_path()
+	with open(path + '.tmp', 'w') as f:
+		json.dump(data, f)
+	os.replace(path + '.tmp', path)
+
+def load_snapshots():
+	"Merge the histograms written by every process into a dict of view name to ViewStats."
+	merged = defaultdict(ViewStats)
+	if not os.path.isdir(settings.INSTRUMENTATION_DIR):
+		return merged
+	for name in os.listdir(settings.INSTRUMENTATION_DIR):
+		if not name.endswith('.json'):
+			continue
+		with open(os.path.join(settings.INSTRUMENTATION_DIR, name)) as f:
+			for view, data in json.load(f).items():
+				merged[view].merge(ViewStats.from_dict(data))
+	return merged
+
+def view_name(request):
+	match = getattr(request, 'resolver_match', None)
+	# group unresolved paths together so 404s don't create a histogram per URL
+	return match.view_name if match else '<unresolved>'
+
+def record_query(execute, sql, params, many, context):
+	timings = _timings.get()
+	if timings is None:
+		return execute(sql, params, many, context)
+	return timings.record_query(execute, sql, params, many, context)
+
+def instrument(connection, **kwargs):
+	# once per connection object, which lasts as long as its thread
+	if record_query not in connection.execute_wrappers:
+		connection.execute_wrappers.append(record_query)
+
+class InstrumentationMiddleware:
+	async_capable = True
+	sync_capable = True
+
+	def __init__(self, get_response):
+		if not settings.INSTRUMENTATION:
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+		# async views query from other threads, whose connections are instrumented as they connect
+		connection_created.connect(instrument)
+		for connection in connections.all():
+			instrument(connection)
+		if asyncio.iscoroutinefunction(get_response):
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		for connection in connections.all():
+			instrument(connection)
+		timings = RequestTimings()
+		token = _timings.set(timings)
+		start = time.perf_counter()
+		try:
+			response = self.get_response(request)
+		finally:
+			_timings.reset(token)
+		if self.observe(request, response, timings, start):
+			flush()
+		return response
+
+	async def __acall__(self, request):
+		timings = RequestTimings()
+		token = _timings.set(timings)
+		start = time.perf_counter()
+		try:
+			response = await self.get_response(request)
+		finally:
+			_timings.reset(token)
+		if self.observe(request, response, timings, start):
+			await sync_to_async(flush, thread_sensitive=False)()
+		return response
+
+	def observe(self, request, response, timings, start):
+		"Record the request's timings; return whether it's time to flush."
+		timings.ms['total'] = (time.perf_counter() - start) * 1000
+		response['Server-Timing'] = timings.server_timing()
+		with _stats_lock:
+			_stats[view_name(request)].observe(timings)
+		return time.monotonic() - _last_flush > FLUSH_INTERVAL
+
+class Template:
+	"Wraps a template from the Django backend to time its rendering."
+	def __init__(self, template):
+		self.template = template
+
+	def __getattr__(self, name):
+		return getattr(self.template, name)
+
+	def render(self, context=None, request=None):
+		with timed('render'):
+			return self.template.render(context, request)
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+	"Template backend used in place of Django's when instrumentation is enabled."
+	def from_string(self, template_code):
+		return Template(super().from_string(template_code))
+
+	def get_template(self, template_name):
+		return Template(super().get_template(template_name))
@@ -0,0 +1,29 @@
+from datetime import datetime, timedelta
+
+from clinic import archive
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--days', type=int, default=settings.ARCHIVE_AFTER_DAYS, help="Archive patients whose call ended more than this many days ago.")
+		parser.add_argument('--batch-size', type=int, default=500)
+		parser.add_argument('--dry-run', action='store_true', help="Only count the patients that would be archived.")
+
+	def handle(self, *args, **options):
+		cutoff = datetime.now() - timedelta(days=options['days'])
+		patients = archive.archivable(cutoff)
+		if options['dry_run']:
+			self.stdout.write(f"{patients.count()} patients would be archived.")
+			return
+
+		total = 0
+		while True:
+			ids = list(patients.order_by('id').values_list('id', flat=True)[:options['batch_size']])
+			if not ids:
+				break
+			name, count = archive.archive_batch(ids, cutoff)
+			if count:
+				total += count
+				self.stdout.write(f"Archived {count} patients to {name}.")
+		self.stdout.write(self.style.SUCCESS(f"Archived {total} patients."))
@@ -0,0 +1,261 @@
+"""
+Repeatable micro and macro benchmarks of the clinic's hot paths.
+
+Creates a throwaway test database, fills it with seed_load_data up to each
+of the requested sizes (in patients) and times each benchmark against it,
+recording latency percentiles and queries per iteration. Results can be
+written as JSON and compared with an earlier run, in which case the
+command fails if any benchmark got slower by more than the threshold or
+started issuing more queries.
+"""
+
+from datetime import datetime, timedelta
+from io import StringIO
+import json, os, platform, random, statistics, tempfile, time
+
+from clinic.models import *
+from django.core.management import call_command
+from django.core.management.base import BaseCommand, CommandError
+from django.db import DatabaseError, connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+import django
+
+BENCHMARKS = []
+
+def benchmark(func):
+	"Register a method that sets up a benchmark and returns (run, setup), where setup may be None."
+	BENCHMARKS.append(func)
+	return func
+
+def percentile(values, q):
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+class QueryCounter:
+	def __init__(self):
+		self.count = 0
+
+	def __call__(self, execute, sql, params, many, context):
+		self.count += 1
+		return execute(sql, params, many, context)
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--sizes', default='1000,10000', help="Comma-separated numbers of patients to benchmark at.")
+		parser.add_argument('--repeat', type=int, default=20, help="Timed iterations of each benchmark.")
+		parser.add_argument('--only', action='append', default=[], help="Only run the named benchmark (may be repeated).")
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--output', help="Write the results as JSON to this file.")
+		parser.add_argument('--compare', help="JSON results of an earlier run to check for regressions.")
+		parser.add_argument('--threshold', type=float, default=0.25, help="Fractional slowdown of the median that counts as a regression.")
+		parser.add_argument('--min-delta', type=float, default=0.5, help="Ignore slowdowns smaller than this many milliseconds.")
+
+	def handle(self, *args, **options):
+		self.options = options
+		sizes = sorted(int(s) for s in options['sizes'].split(','))
+		names = [b.__name__ for b in BENCHMARKS]
+		for name in options['only']:
+			if name not in names:
+				raise CommandError("Unknown benchmark {!r}, choose from {}".format(name, ', '.join(names)))
+
+		if connection.vendor == 'sqlite':
+			connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'bench.sqlite3')
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		try:
+			with override_settings(
+				SITE_ID=1,
+				ALLOWED_HOSTS=['testserver'],
+				# every simulated client comes from the same address
+				RATE_LIMITS={},
+				# chat is written by the request that sends it, so its queries are counted, and
+				# nothing is left buffered for the test database
+				CHAT_FLUSH_INTERVAL=0,
+				STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+			):
+				results = self.run(sizes)
+		finally:
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		report = {
+			'created': datetime.now().isoformat(timespec='seconds'),
+			'database': connection.vendor,
+			'python': platform.python_version(),
+			'django': django.get_version(),
+			'repeat': options['repeat'],
+			'seed': options['seed'],
+			'results': results,
+		}
+		self.print_results(results)
+		if options['output']:
+			with open(options['output'], 'w') as f:
+				json.dump(report, f, indent=2)
+
+		if options['compare']:
+			with open(options['compare']) as f:
+				regressions = self.compare(json.load(f)['results'], results)
+			if regressions:
+				raise CommandError("{} regression(s) against {}".format(len(regressions), options['compare']))
+
+	def run(self, sizes):
+		results = []
+		seeded = 0
+		for i, size in enumerate(sizes):
+			# grow the data set incrementally; each step needs its own seed so uuids don't collide
+			self.stdout.write("Seeding {} patients...".format(size))
+			call_command('seed_load_data', patients=size - seeded, doctors=max(10, (size - seeded) // 100), seed=self.options['seed'] + i, stdout=StringIO())
+			seeded = size
+
+			self.random = random.Random(self.options['seed'])
+			for func in BENCHMARKS:
+				if self.options['only'] and func.__name__ not in self.options['only']:
+					continue
+				run, setup = func(self)
+				try:
+					results.append({'benchmark': func.__name__, 'size': size, **self.measure(run, setup)})
+				except DatabaseError as e:
+					# e.g. notify_filter relies on Postgres date functions sqlite doesn't have
+					self.stderr.write(self.style.WARNING("{} failed on {}: {}".format(func.__name__, connection.vendor, e)))
+					results.append({'benchmark': func.__name__, 'size': size, 'error': str(e)})
+		return results
+
+	def measure(self, run, setup):
+		timings, queries = [], []
+		# the first iteration warms up caches and isn't recorded
+		for i in range(self.options['repeat'] + 1):
+			if setup:
+				setup()
+			counter = QueryCounter()
+			with connection.execute_wrapper(counter):
+				start = time.perf_counter()
+				run()
+				elapsed = (time.perf_counter() - start) * 1000
+			if i:
+				timings.append(elapsed)
+				queries.append(counter.count)
+		return {
+			'median': statistics.median(timings),
+			'min': min(timings),
+			'p95': percentile(timings, 0.95),
+			'queries': max(queries),
+		}
+
+	def refresh_queue(self):
+		# keep the callers seeded as waiting online however long the run takes
+		PatientPresence.objects.filter(session_started__isnull=True, patient__created__gt=datetime.now()-timedelta(hours=1)).update(last_seen=datetime.now())
+
+	def sample(self, qs, n=20):
+		ids = list(qs.values_list('pk', flat=True)[:1000])
+		return self.random.sample(ids, min(n, len(ids)))
+
+	def cycle(self, items):
+		# returns a function giving the next item on each call, so each iteration touches different rows
+		items = list(items)
+		state = {'i': 0}
+		def next_item():
+			state['i'] += 1
+			return items[state['i'] % len(items)]
+		return next_item
+
+	@benchmark
+	def get_queue(self):
+		pairs = self.cycle(PatientPresence.objects.values_list('site_id', 'language_id').distinct())
+		def run():
+			site_id, language_id = pairs()
+			PatientPresence.get_queue(PatientPresence.objects.filter(site_id=site_id, language_id=language_id)).first()
+		return run, self.refresh_queue
+
+	@benchmark
+	def notify_filter(self):
+		languages = self.cycle(Language.objects.values_list('id', flat=True))
+		def run():
+			list(Doctor.notify_filter(Doctor.objects.filter(site_id=1, languages=languages()))[:10])
+		return run, None
+
+	@benchmark
+	def notify_object(self):
+		languages = self.cycle(Language.objects.values_list('id', flat=True))
+		def run():
+			Doctor.notify_object(Doctor.objects.filter(site_id=1, languages=languages()), timedelta(minutes=5))
+		return run, None
+
+	@benchmark
+	def doctor_patient(self):
+		doctors = self.cycle(self.sample(Doctor.objects.filter(sessions__isnull=False).distinct()))
+		def run():
+			Doctor(pk=doctors()).patient
+		return run, None
+
+	@benchmark
+	def track_added(self):
+		ids = self.sample(Patient.objects.filter(presence__session_ended__isnull=False))
+		patients = self.cycle(Patient.objects.filter(pk__in=ids).values_list('uuid', 'created'))
+		def run():
+			uuid, created = patients()
+			Patient(uuid=uuid, created=created).track_added
+		return run, None
+
+	@benchmark
+	def chat_get(self):
+		client = Client()
+		patients = self.cycle(Patient.objects.filter(chatmessage__isnull=False).distinct().values_list('uuid', flat=True)[:20])
+		def run():
+			client.cookies['patient_id'] = str(patients())
+			response = client.get(reverse('chat'))
+			assert response.status_code == 200, response.status_code
+		return run, None
+
+	@benchmark
+	def twilio_status_callback(self):
+		client = Client()
+		rooms = self.cycle(Patient.objects.values_list('uuid', flat=True)[:20])
+		def run():
+			room = str(rooms())
+			response = client.post(reverse('twilio_status_callback'), {
+				'RoomName': room,
+				'RoomStatus': ROOM_IN_PROGRESS,
+				'StatusCallbackEvent': EVENT_TRACK_ADDED,
+				'Timestamp': datetime.utcnow().isoformat() + 'Z',
+				'ParticipantStatus': PARTICIPANT_CONNECTED,
+				'ParticipantIdentity': room,
+				'TrackKind': TRACK_AUDIO,
+			})
+			assert response.status_code == 200, response.status_code
+		return run, None
+
+	@benchmark
+	def generate_call_summaries(self):
+		# regenerate the summaries of a few finished calls each iteration
+		patients = self.sample(Patient.objects.filter(callsummary__isnull=False), 100)
+		def setup():
+			CallSummary.objects.filter(patient_id__in=self.random.sample(patients, min(10, len(patients)))).update(duration=None)
+		def run():
+			call_command('generate_call_summaries', stdout=StringIO())
+		return run, setup
+
+	def compare(self, baseline, results):
+		baseline = {(r['benchmark'], r['size']): r for r in baseline}
+		regressions = []
+		for r in results:
+			old = baseline.get((r['benchmark'], r['size']))
+			if not old or 'error' in old or 'error' in r:
+				continue
+			slower = r['median'] - old['median']
+			if (slower > self.options['min_delta'] and slower > old['median'] * self.options['threshold']) or r['queries'] > old['queries']:
+				regressions.append(r)
+				self.stdout.write(self.style.ERROR("{} @ {}: median {:.2f}ms -> {:.2f}ms, queries {} -> {}".format(
+					r['benchmark'], r['size'], old['median'], r['median'], old['queries'], r['queries'])))
+		if not regressions:
+			self.stdout.write(self.style.SUCCESS("No regressions against baseline."))
+		return regressions
+
+	def print_results(self, results):
+		columns = ('size', 'median ms', 'min ms', 'p95 ms', 'queries')
+		self.stdout.write('{:<25}'.format('benchmark') + ''.join('{:>12}'.format(c) for c in columns))
+		for r in results:
+			if 'error' in r:
+				self.stdout.write('{:<25}{:>12}  failed: {}'.format(r['benchmark'], r['size'], r['error']))
+				continue
+			row = (r['size'], *('{:.2f}'.format(r[k]) for k in ('median', 'min', 'p95')), r['queries'])
+			self.stdout.write('{:<25}'.format(r['benchmark']) + ''.join('{:>12}'.format(c) for c in row))
@@ -0,0 +1,176 @@
+"""
+Compare how many waiting clients one worker process can hold under WSGI
+and ASGI.
+
+Creates waiting callers in the configured database, starts gunicorn with a
+single worker for each server type in turn (a sync WSGI worker, a threaded
+WSGI worker, and a uvicorn ASGI worker serving clinic/async_views.py),
+opens a long poll to /clinic/wait/ for every caller at once and counts how
+many of them the worker answered within the hold time, i.e. held open
+concurrently, along with the worker's resident memory. The callers are
+deleted afterwards.
+"""
+
+import asyncio, os, signal, socket, statistics, subprocess, sys, tempfile, time
+
+from clinic.models import *
+from django.core.management.base import BaseCommand, CommandError
+
+SERVERS = {
+	'wsgi': ['medicam.wsgi'],
+	'wsgi-threads': ['medicam.wsgi', '--worker-class', 'gthread'],
+	'asgi': ['medicam.asgi:application', '--worker-class', 'uvicorn.workers.UvicornWorker'],
+}
+
+def wait_until_serving(process, port, timeout):
+	"Wait for the server to answer a request; return False if it exits or doesn't answer within timeout."
+	deadline = time.monotonic() + timeout
+	while time.monotonic() < deadline and process.poll() is None:
+		try:
+			with socket.create_connection(('127.0.0.1', port), timeout=5) as sock:
+				# a wait request without cookies is answered straight away
+				sock.sendall(b"GET /clinic/wait/ HTTP/1.1\r\nHost: localhost\r\nConnection: close\r\n\r\n")
+				if sock.recv(12).startswith(b'HTTP/'):
+					return True
+		except OSError:
+			pass
+		time.sleep(0.2)
+	return False
+
+def children(pid):
+	"Return the ids of the processes whose parent is pid (Linux only)."
+	found = []
+	for entry in os.listdir('/proc'):
+		if entry.isdigit():
+			try:
+				with open('/proc/{}/stat'.format(entry)) as f:
+					# the command name in parentheses may contain spaces
+					if int(f.read().rsplit(')', 1)[1].split()[1]) == pid:
+						found.append(int(entry))
+			except (OSError, IndexError, ValueError):
+				pass
+	return found
+
+def rss_mb(pid):
+	try:
+		with open('/proc/{}/status'.format(pid)) as f:
+			for line in f:
+				if line.startswith('VmRSS:'):
+					return int(line.split()[1]) / 1024
+	except OSError:
+		pass
+	return None
+
+async def long_poll(port, patient_uuid, timeout):
+	"Return (status, seconds) of one wait request, or (None, None) if it wasn't answered within timeout."
+	loop = asyncio.get_running_loop()
+	start = loop.time()
+	writer = None
+	try:
+		reader, writer = await asyncio.wait_for(asyncio.open_connection('127.0.0.1', port), timeout)
+		writer.write((
+			"GET /clinic/wait/?state=waiting HTTP/1.1\r\n"
+			"Host: localhost\r\n"
+			"Cookie: patient_id={}\r\n"
+			"Connection: close\r\n\r\n"
+		).format(patient_uuid).encode('ascii'))
+		await writer.drain()
+		status_line = await asyncio.wait_for(reader.readline(), timeout - (loop.time() - start))
+		return int(status_line.split()[1]), loop.time() - start
+	except (asyncio.TimeoutError, OSError, IndexError, ValueError):
+		return None, None
+	finally:
+		if writer:
+			writer.close()
+
+def worker_rss_mb(pid):
+	workers = children(pid)
+	return sum(filter(None, map(rss_mb, workers))) if workers else None
+
+async def long_polls(port, uuids, timeout, server_pid, sample_after):
+	"Return the responses to a wait request per uuid, and the workers' memory while they were held."
+	polls = asyncio.gather(*[long_poll(port, u, timeout) for u in uuids])
+	await asyncio.sleep(sample_after)
+	rss = worker_rss_mb(server_pid)
+	return await polls, rss
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--connections', type=int, default=200, help="Waiting clients to connect at once.")
+		parser.add_argument('--hold', type=int, default=5, help="LONG_POLL_TIMEOUT of the server, in seconds.")
+		parser.add_argument('--servers', default=','.join(SERVERS), help="Comma-separated server types to compare: " + ', '.join(SERVERS))
+		parser.add_argument('--threads', type=int, default=8, help="Threads of the wsgi-threads worker.")
+		parser.add_argument('--port', type=int, default=8765)
+		parser.add_argument('--site', type=int, default=1)
+
+	def handle(self, *args, **options):
+		servers = options['servers'].split(',')
+		for server in servers:
+			if server not in SERVERS:
+				raise CommandError("Unknown server {!r}, choose from {}".format(server, ', '.join(SERVERS)))
+		language = Language.objects.first()
+		if language is None:
+			raise CommandError("Add a language first, e.g. with sync_languages.")
+
+		patients = [Patient.objects.create(site_id=options['site'], language=language, enable_video=False) for i in range(options['connections'])]
+		try:
+			results = [self.run_server(server, [p.uuid for p in patients], options) for server in servers]
+		finally:
+			Patient.objects.filter(id__in=[p.id for p in patients]).delete()
+
+		self.stdout.write("{:<14} {:>11} {:>8} {:>9} {:>7} {:>12} {:>10}".format(
+			'server', 'connections', 'held', 'answered', 'errors', 'median s', 'worker MB'))
+		for r in results:
+			if 'error' in r:
+				self.stdout.write("{:<14} failed: {}".format(r['server'], r['error']))
+				continue
+			self.stdout.write("{:<14} {:>11} {:>8} {:>9} {:>7} {:>12} {:>10}".format(
+				r['server'], r['connections'], r['held'], r['answered'], r['errors'],
+				'{:.2f}'.format(r['median']) if r['median'] is not None else '-',
+				'{:.0f}'.format(r['rss']) if r['rss'] is not None else '-'))
+
+	def run_server(self, server, uuids, options):
+		hold = options['hold']
+		env = dict(os.environ, LONG_POLL_TIMEOUT=str(hold), SITE_ID=str(options['site']))
+		# medicam/asgi.py turns the async views on itself
+		env.pop('ASYNC_VIEWS', None)
+		command = [sys.executable, '-m', 'gunicorn'] + SERVERS[server] + [
+			'--workers', '1',
+			'--threads', str(options['threads'] if server == 'wsgi-threads' else 1),
+			'--bind', '127.0.0.1:{}'.format(options['port']),
+			'--backlog', str(max(2048, len(uuids))),
+			'--timeout', str(hold * 2 + 30),
+		]
+		self.stderr.write("Starting {} server...".format(server))
+		log = tempfile.TemporaryFile('w+')
+		process = subprocess.Popen(command, env=env, stdout=subprocess.DEVNULL, stderr=log)
+		try:
+			if not wait_until_serving(process, options['port'], 60):
+				process.kill()
+				process.wait()
+				log.seek(0)
+				lines = log.read().strip().splitlines()
+				self.stderr.write("The {} server didn't start:\n{}".format(server, '\n'.join(lines[-20:])))
+				errors = [line for line in lines if 'Error' in line]
+				return {'server': server, 'error': errors[-1] if errors else "didn't start"}
+
+			# everyone answered within the hold time (plus some slack) was being held at the same time
+			responses, rss = asyncio.run(long_polls(options['port'], uuids, hold * 2 + 5, process.pid, hold / 2))
+		finally:
+			process.send_signal(signal.SIGTERM)
+			try:
+				process.communicate(timeout=30)
+			except subprocess.TimeoutExpired:
+				process.kill()
+			log.close()
+
+		answered = [seconds for status, seconds in responses if status in (200, 204)]
+		return {
+			'server': server,
+			'connections': len(uuids),
+			'held': sum(1 for seconds in answered if seconds <= hold + 1),
+			'answered': len(answered),
+			'errors': sum(1 for status, seconds in responses if status is not None and status not in (200, 204)),
+			'median': statistics.median(answered) if answered else None,
+			'rss': rss,
+		}
@@ -0,0 +1,62 @@
+"""
+Measure what clinic.ratelimit adds to each request.
+
+Runs RateLimitMiddleware around a view that does nothing, against the
+configured cache, and reports the time per request for a path it doesn't
+limit, for requests it lets through and for requests it refuses, next to
+calling the view directly. Each run uses a made-up client address and
+cookie, so real clients' buckets aren't touched.
+"""
+
+import time, uuid
+
+from django.core.management.base import BaseCommand, CommandError
+from django.http import HttpResponse
+from django.test import RequestFactory
+from django.test.utils import override_settings
+from django.urls import NoReverseMatch, reverse
+
+from clinic.ratelimit import RateLimitMiddleware
+
+def view(request):
+	return HttpResponse()
+
+def per_request_us(handler, request, count):
+	start = time.perf_counter()
+	for i in range(count):
+		handler(request)
+	return (time.perf_counter() - start) / count * 1e6
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--requests', type=int, default=10000, help="Requests per case.")
+		parser.add_argument('--route', default='chat', help="URL name of the limited endpoint.")
+
+	def handle(self, *args, **options):
+		try:
+			path = reverse(options['route'])
+		except NoReverseMatch:
+			raise CommandError("Unknown URL name {!r}".format(options['route']))
+
+		def request(path):
+			r = RequestFactory().get(path, REMOTE_ADDR='198.51.100.{}'.format(uuid.uuid4().int % 250 + 1))
+			r.COOKIES['patient_id'] = str(uuid.uuid4())
+			return r
+
+		count = options['requests']
+		generous = {'ip': (1e9, 1e9), 'cookie': (1e9, 1e9)}
+		strict = {'ip': (1e-9, 1), 'cookie': (1e-9, 1)}
+		results = [('view alone', per_request_us(view, request(path), count))]
+		with override_settings(RATE_LIMITS={options['route']: generous}):
+			results.append(('unlimited path', per_request_us(RateLimitMiddleware(view), request('/clinic/'), count)))
+			results.append(('allowed', per_request_us(RateLimitMiddleware(view), request(path), count)))
+		with override_settings(RATE_LIMITS={options['route']: strict}):
+			middleware, refused = RateLimitMiddleware(view), request(path)
+			# empties the buckets, so every timed request is refused
+			middleware(refused)
+			results.append(('refused', per_request_us(middleware, refused, count)))
+
+		baseline = results[0][1]
+		self.stdout.write("{:<16} {:>12} {:>12}".format('case', 'us/request', 'overhead us'))
+		for case, us in results:
+			self.stdout.write("{:<16} {:>12.1f} {:>12.1f}".format(case, us, us - baseline))
@@ -0,0 +1,18 @@
+"""
+End the sessions nobody finished; see clinic/sweeper.py.
+"""
+
+from datetime import timedelta
+
+from clinic import sweeper
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--minutes', type=int, default=settings.STALE_SESSION_MINUTES, help="Close sessions nobody has been seen in for this many minutes.")
+		parser.add_argument('--batch-size', type=int, default=500)
+
+	def handle(self, *args, **options):
+		room_ended, timed_out = sweeper.sweep(timedelta(minutes=options['minutes']), options['batch_size'])
+		self.stdout.write(self.style.SUCCESS(f"Closed {room_ended} sessions whose room ended and {timed_out} that timed out."))
@@ -1,4 +1,5 @@
 from clinic.models import *
+from clinic.routers import use_replica
 from django.core.management.base import BaseCommand, CommandError
 
 def strip_microseconds(d):
@@ -6,8 +7,10 @@ def strip_microseconds(d):
 
 class Command(BaseCommand):
 	def handle(self, *args, **kwargs):
-		for patient in Patient.objects.filter(callsummary__duration__isnull=True):
-			self.update_summary(patient)
+		# events are read from a replica; summaries are still written to the primary
+		with use_replica():
+			for patient in Patient.objects.filter(callsummary__duration__isnull=True):
+				self.update_summary(patient)
 
 	def update_summary(self, patient):
 		try:
@@ -21,7 +24,7 @@ class Command(BaseCommand):
 			if not first_event:
 				first_event = e.timestamp
 
-			if e.participant_id == str(patient.uuid):
+			if e.participant_role == ROLE_PATIENT:
 				if not summary.patient_connected and e.event == EVENT_PARTICIPANT_CONNECTED:
 					summary.patient_connected = strip_microseconds(e.timestamp - first_event)
 				elif not summary.patient_audio_start and e.event == EVENT_TRACK_ADDED and e.track_kind == TRACK_AUDIO:
@@ -29,7 +32,7 @@ class Command(BaseCommand):
 				elif not summary.patient_video_start and e.event == EVENT_TRACK_ADDED and e.track_kind == TRACK_VIDEO:
 					summary.patient_video_start = strip_microseconds(e.timestamp - first_event)
 
-			elif e.participant_id == str(patient.doctor.id):
+			elif e.participant_role == ROLE_DOCTOR:
 				if not summary.doctor_connected and e.event == EVENT_PARTICIPANT_CONNECTED:
 					summary.doctor_connected = strip_microseconds(e.timestamp - first_event)
 				elif not summary.doctor_audio_start and e.event == EVENT_TRACK_ADDED and e.track_kind == TRACK_AUDIO:
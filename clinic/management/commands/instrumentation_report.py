@@ -0,0 +1,49 @@
+"""
+Print the per-view histograms recorded by InstrumentationMiddleware.
+"""
+
+import json, os
+
+from clinic import instrumentation
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--json', action='store_true', help="Print the merged histograms as JSON.")
+		parser.add_argument('--reset', action='store_true', help="Delete the recorded histograms after printing them.")
+
+	def handle(self, *args, **options):
+		stats = instrumentation.load_snapshots()
+
+		if options['json']:
+			self.stdout.write(json.dumps({
+				'buckets': [str(b) for b in instrumentation.BUCKETS],
+				'views': {view: s.to_dict() for view, s in stats.items()},
+			}, indent=2))
+		elif not stats:
+			self.stdout.write(self.style.WARNING(f"No instrumentation recorded in {settings.INSTRUMENTATION_DIR}."))
+		else:
+			self.print_table(stats)
+
+		if options['reset'] and os.path.isdir(settings.INSTRUMENTATION_DIR):
+			for name in os.listdir(settings.INSTRUMENTATION_DIR):
+				os.remove(os.path.join(settings.INSTRUMENTATION_DIR, name))
+
+	def print_table(self, stats):
+		columns = ('requests', 'queries', 'total p50', 'total p95', 'db mean', 'external mean', 'render mean')
+		self.stdout.write('{:<30}'.format('view') + ''.join('{:>15}'.format(c) for c in columns))
+		for view, s in sorted(stats.items(), key=lambda item: -item[1].histograms['total'].total):
+			h = s.histograms
+			count = h['total'].count
+			mean = lambda kind: h[kind].total / count
+			row = (
+				count,
+				'{:.1f}'.format(mean('queries')),
+				'<{}ms'.format(h['total'].quantile(0.5)),
+				'<{}ms'.format(h['total'].quantile(0.95)),
+				'{:.1f}ms'.format(mean('db')),
+				'{:.1f}ms'.format(mean('external')),
+				'{:.1f}ms'.format(mean('render')),
+			)
+			self.stdout.write('{:<30}'.format(view) + ''.join('{:>15}'.format(c) for c in row))
@@ -0,0 +1,227 @@
+"""
+Simulate concurrent callers and providers against a throwaway database.
+
+Creates a test database (a temporary file for sqlite, test_<name> for
+Postgres), stubs out Twilio, FCM and S3, then runs scripted callers
+(disclaimer -> consultation polling -> chat -> finish) and providers
+(consultation polling -> session -> chat -> finish) through the full
+middleware stack. Reports throughput, latency percentiles and query
+counts per endpoint, and how long callers waited to be matched.
+
+sqlite only allows one writer at a time and fails some transactions
+outright under contention, so use Postgres for numbers worth comparing.
+"""
+
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from unittest import mock
+import json, os, random, tempfile, threading, time, uuid
+
+from clinic import chatbuffer
+from clinic.models import *
+from django.core.management import call_command
+from django.core.management.base import BaseCommand
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+
+def percentile(values, q):
+	if not values:
+		return 0
+	values = sorted(values)
+	return values[min(len(values) - 1, int(q * len(values)))]
+
+class Recorder:
+	"Collects latencies, errors and query counts per endpoint from every simulated client."
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.local = threading.local()
+		self.latencies = defaultdict(list)
+		self.errors = Counter()
+		self.queries = Counter()
+		self.waits = []
+
+	def count_query(self, execute, sql, params, many, context):
+		with self.lock:
+			self.queries[getattr(self.local, 'endpoint', 'setup')] += 1
+		return execute(sql, params, many, context)
+
+	def request(self, client, method, endpoint, path, **kwargs):
+		self.local.endpoint = endpoint
+		start = time.perf_counter()
+		response = getattr(client, method)(path, **kwargs)
+		elapsed = time.perf_counter() - start
+		with self.lock:
+			self.latencies[endpoint].append(elapsed)
+			if response.status_code >= 500:
+				self.errors[endpoint] += 1
+		return response
+
+def in_session(response):
+	return response.status_code == 200 and b'container session' in response.content
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--callers', type=int, default=50, help="Total number of callers to simulate.")
+		parser.add_argument('--concurrency', type=int, default=10, help="Number of callers waiting or in a call at once.")
+		parser.add_argument('--providers', type=int, default=5, help="Number of providers taking calls.")
+		parser.add_argument('--poll-interval', type=float, default=0.5, help="Seconds between consultation and chat polls.")
+		parser.add_argument('--chat-messages', type=int, default=3, help="Chat messages sent by each side per call.")
+		parser.add_argument('--timeout', type=float, default=300, help="Give up on callers not matched after this many seconds.")
+		parser.add_argument('--seed', type=int, default=0)
+		parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+	def handle(self, *args, **options):
+		self.options = options
+		self.recorder = Recorder()
+		self.random = random.Random(options['seed'])
+		self.done = threading.Event()
+
+		if connection.vendor == 'sqlite':
+			connection.settings_dict['TEST']['NAME'] = os.path.join(tempfile.mkdtemp(), 'loadtest.sqlite3')
+		old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True, serialize=False)
+		try:
+			with override_settings(
+				SITE_ID=1,
+				ALLOWED_HOSTS=['testserver'],
+				# every simulated client comes from the same address
+				RATE_LIMITS={},
+				# chat is written by the request that sends it, so its queries are counted, and
+				# nothing is left buffered for the test database
+				CHAT_FLUSH_INTERVAL=0,
+				DEFAULT_FILE_STORAGE='django.core.files.storage.FileSystemStorage',
+				MEDIA_ROOT=tempfile.mkdtemp(),
+				STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage',
+			), mock.patch('clinic.views.get_twilio_jwt', return_value='jwt'), \
+					mock.patch('clinic.views.setup_twilio_room'), \
+					mock.patch('firebase_admin.messaging.send', return_value='stubbed'):
+				results = self.run()
+		finally:
+			# before the test database goes, in case anything is still buffered
+			chatbuffer.flush()
+			connection.creation.destroy_test_db(old_name, verbosity=0)
+
+		if options['json']:
+			self.stdout.write(json.dumps(results, indent=2))
+		else:
+			self.print_results(results)
+
+	def run(self):
+		call_command('sync_languages')
+		languages = list(Language.objects.all())
+		doctors = []
+		for i in range(self.options['providers']):
+			doctor = Doctor.objects.create(name=f"Provider {i}", site_id=1, verified=True)
+			doctor.languages.set(languages)
+			doctors.append(doctor)
+		connection.close()
+
+		start = time.perf_counter()
+		providers = [threading.Thread(target=self.thread, args=(self.provider, doctor.uuid)) for doctor in doctors]
+		for t in providers:
+			t.start()
+		with ThreadPoolExecutor(max_workers=self.options['concurrency']) as pool:
+			for i in range(self.options['callers']):
+				pool.submit(self.thread, self.caller)
+		self.done.set()
+		for t in providers:
+			t.join()
+		duration = time.perf_counter() - start
+
+		return self.results(duration)
+
+	def thread(self, script, *args):
+		try:
+			with connection.execute_wrapper(self.recorder.count_query):
+				script(*args)
+		except Exception as e:
+			self.stderr.write(self.style.ERROR(f"{script.__name__} failed: {e!r}"))
+		finally:
+			connection.close()
+
+	def sleep(self):
+		time.sleep(self.options['poll_interval'] * self.random.uniform(0.5, 1.5))
+
+	def chat(self, client):
+		for i in range(self.options['chat_messages']):
+			body = json.dumps({'uuid': str(uuid.uuid4()), 'text': "Message {}".format(i)})
+			self.recorder.request(client, 'post', 'chat POST', '/clinic/chat/', data=body, content_type='application/json')
+			self.sleep()
+			self.recorder.request(client, 'get', 'chat GET', '/clinic/chat/')
+
+	def caller(self):
+		record = self.recorder.request
+		client = Client(raise_request_exception=False)
+		record(client, 'post', 'disclaimer', '/clinic/disclaimer/', data={'video': '1'})
+
+		joined = time.perf_counter()
+		deadline = joined + self.options['timeout']
+		while True:
+			response = record(client, 'get', 'consultation', '/clinic/consultation/')
+			if in_session(response):
+				break
+			elif response.status_code == 302 or time.perf_counter() > deadline:
+				# the provider ended the session before the caller saw it, or nobody answered
+				return
+			self.sleep()
+		with self.recorder.lock:
+			self.recorder.waits.append(time.perf_counter() - joined)
+
+		self.chat(client)
+		record(client, 'post', 'finish', '/clinic/finish/', data={'end_session': '1'})
+		record(client, 'post', 'finish', '/clinic/finish/', data={'feedback_response': '0', 'feedback_text': ''})
+
+	def provider(self, doctor_uuid):
+		record = self.recorder.request
+		client = Client(raise_request_exception=False)
+		record(client, 'get', 'consultation', '/clinic/consultation/?provider_id={}'.format(doctor_uuid))
+
+		while not self.done.is_set():
+			if in_session(record(client, 'get', 'consultation', '/clinic/consultation/')):
+				self.chat(client)
+				record(client, 'post', 'finish', '/clinic/finish/')
+			else:
+				self.sleep()
+
+		record(client, 'post', 'finish', '/clinic/finish/', data={'stop_consulting': '1'})
+
+	def results(self, duration):
+		recorder = self.recorder
+		presences = PatientPresence.objects.filter(session_started__isnull=False).select_related('patient')
+		match_latency = [(p.session_started - p.patient.created).total_seconds() for p in presences]
+
+		total_requests = sum(len(l) for l in recorder.latencies.values())
+		return {
+			'callers': self.options['callers'],
+			'matched': len(recorder.waits),
+			'concurrency': self.options['concurrency'],
+			'providers': self.options['providers'],
+			'duration': duration,
+			'throughput': total_requests / duration,
+			'queries': sum(recorder.queries.values()),
+			'endpoints': {
+				endpoint: {
+					'requests': len(latencies),
+					'errors': recorder.errors[endpoint],
+					'queries': recorder.queries[endpoint],
+					'p50': percentile(latencies, 0.5),
+					'p95': percentile(latencies, 0.95),
+					'p99': percentile(latencies, 0.99),
+				} for endpoint, latencies in sorted(recorder.latencies.items())
+			},
+			'match_latency': {q: percentile(match_latency, float(q[1:]) / 100) for q in ('p50', 'p95', 'p99')},
+			'observed_wait': {q: percentile(recorder.waits, float(q[1:]) / 100) for q in ('p50', 'p95', 'p99')},
+		}
+
+	def print_results(self, r):
+		self.stdout.write(f"{r['matched']}/{r['callers']} callers matched with {r['providers']} providers, {r['concurrency']} callers at a time")
+		self.stdout.write(f"{r['duration']:.1f}s, {r['throughput']:.1f} requests/s, {r['queries']} queries")
+		self.stdout.write('')
+		columns = ('requests', 'errors', 'queries/req', 'p50 ms', 'p95 ms', 'p99 ms')
+		self.stdout.write('{:<15}'.format('endpoint') + ''.join('{:>12}'.format(c) for c in columns))
+		for endpoint, e in r['endpoints'].items():
+			row = (e['requests'], e['errors'], '{:.1f}'.format(e['queries'] / e['requests']), *('{:.1f}'.format(e[q] * 1000) for q in ('p50', 'p95', 'p99')))
+			self.stdout.write('{:<15}'.format(endpoint) + ''.join('{:>12}'.format(c) for c in row))
+		self.stdout.write('')
+		for label, key in (("match latency (server)", 'match_latency'), ("wait observed by callers", 'observed_wait')):
+			self.stdout.write("{}: p50 {:.2f}s, p95 {:.2f}s, p99 {:.2f}s".format(label, *r[key].values()))
@@ -0,0 +1,24 @@
+from clinic import partitions
+from django.core.management.base import BaseCommand
+from django.db import connection
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--dry-run', action='store_true', help="Show what would be created and dropped without changing anything.")
+		parser.add_argument('--no-drop', action='store_true', help="Only create partitions.")
+
+	def handle(self, *args, **options):
+		if connection.vendor != 'postgresql':
+			self.stdout.write(self.style.WARNING("Partitioning requires PostgreSQL; nothing to do."))
+			return
+
+		for table in partitions.TABLES:
+			if not partitions.is_partitioned(table):
+				self.stdout.write(self.style.WARNING(f"{table.table} isn't partitioned, skipping."))
+				continue
+
+			for name in partitions.ensure_partitions(table, dry_run=options['dry_run']):
+				self.stdout.write(self.style.SUCCESS(f"Created {name}."))
+			if not options['no_drop']:
+				for name in partitions.drop_expired(table, dry_run=options['dry_run']):
+					self.stdout.write(self.style.SUCCESS(f"Dropped {name}."))
@@ -0,0 +1,59 @@
+from io import StringIO
+import pstats, shutil
+
+from clinic import profiling
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('action', choices=['list', 'dump', 'enable', 'disable', 'clear'])
+		parser.add_argument('profile_id', nargs='?', help="Profile to dump (see list); defaults to the newest.")
+		parser.add_argument('--sort', default='cumulative', help="pstats sort key for dump.")
+		parser.add_argument('--limit', type=int, default=40, help="Number of functions to print for dump.")
+		parser.add_argument('--output', help="Copy the raw pstats file here instead of printing it (e.g. for snakeviz).")
+
+	def handle(self, *args, **options):
+		getattr(self, options['action'])(options)
+
+	def list(self, options):
+		state = "disabled" if profiling.is_disabled() else "enabled"
+		self.stdout.write("Profiling is {}.".format(state))
+		for p in profiling.list_profiles():
+			self.stdout.write("{id}  {time:.19}  {status}  {duration_ms:8.1f}ms  {method} {path} ({view}, {user})".format(**p))
+
+	def dump(self, options):
+		profile_id = options['profile_id']
+		if not profile_id:
+			profiles = profiling.list_profiles()
+			if not profiles:
+				raise CommandError("No profiles have been captured.")
+			profile_id = profiles[0]['id']
+		try:
+			path = profiling.profile_path(profile_id)
+			if options['output']:
+				shutil.copyfile(path, options['output'])
+				return
+			out = StringIO()
+			stats = pstats.Stats(path, stream=out)
+		except (OSError, ValueError) as e:
+			raise CommandError("Can't read profile {}: {}".format(profile_id, e))
+		stats.strip_dirs().sort_stats(options['sort']).print_stats(options['limit'])
+		self.stdout.write(out.getvalue())
+
+	def switch(self, disabled):
+		if not profiling.is_switchable():
+			raise CommandError("Profiling can't be switched at runtime with a cache that isn't shared between processes; set CACHE_BACKEND, or unset PROFILING and restart.")
+		profiling.set_disabled(disabled)
+
+	def enable(self, options):
+		self.switch(False)
+		self.stdout.write(self.style.SUCCESS("Profiling enabled."))
+
+	def disable(self, options):
+		# takes effect in every worker sharing the cache, without a restart
+		self.switch(True)
+		self.stdout.write(self.style.SUCCESS("Profiling disabled."))
+
+	def clear(self, options):
+		shutil.rmtree(profiling.profile_dir(), ignore_errors=True)
+		self.stdout.write(self.style.SUCCESS("Deleted all profiles."))
@@ -2,19 +2,23 @@
 Delete chat messages that are too old.
 """
 
-from datetime import timedelta, datetime
+from datetime import datetime
 
-from clinic.models import ChatMessage
+from clinic import partitions
+from clinic.models import CHAT_MESSAGE_MAX_AGE, ChatMessage
 from django.core.management.base import BaseCommand
 
-
-MAX_AGE = timedelta(1)  # 1 day
-
 class Command(BaseCommand):
 	def handle(self, *args, **kwargs):
+		table = next(t for t in partitions.TABLES if t.table == ChatMessage._meta.db_table)
+		if partitions.is_partitioned(table):
+			# whole days of expired messages are dropped with their partitions, leaving only
+			# the part of the oldest remaining day to delete row by row
+			for name in partitions.drop_expired(table):
+				self.stdout.write(self.style.SUCCESS(f"Dropped {name}."))
+
 		old_messages = ChatMessage.objects.filter(
-			sent__lte=datetime.now() - MAX_AGE
-		).all()
-		delete_count = old_messages.count()
-		old_messages.delete()
+			sent__lte=datetime.now() - CHAT_MESSAGE_MAX_AGE
+		)
+		delete_count, _ = old_messages.delete()
 		self.stdout.write(self.style.SUCCESS(f"Deleted {delete_count} messages."))
@@ -0,0 +1,17 @@
+from clinic import archive
+from clinic.models import Patient
+from django.core.management.base import BaseCommand, CommandError
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('patient_ids', nargs='+', type=int)
+
+	def handle(self, *args, **options):
+		for patient_id in options['patient_ids']:
+			if Patient.objects.filter(id=patient_id).exists():
+				raise CommandError(f"Patient {patient_id} is already in the database.")
+			record = archive.find(patient_id)
+			if not record:
+				raise CommandError(f"Patient {patient_id} isn't in the archive.")
+			archive.restore(record)
+			self.stdout.write(self.style.SUCCESS(f"Restored patient {patient_id} with {len(record['objects']) - 1} related rows."))
@@ -0,0 +1,281 @@
+"""
+Bulk-generate realistic volumes of clinic data for benchmarking.
+
+Rows are built in memory from a seeded random generator and written with
+bulk_create in chunks, so the same options and seed always produce the
+same rows (with timestamps relative to the time of the run). Primary keys
+are assigned explicitly so related rows can be created without reading
+anything back, and sequences are reset afterwards.
+"""
+
+from contextlib import contextmanager
+from datetime import datetime, time, timedelta
+import random, uuid
+
+from clinic.models import *
+from django.contrib.sites.models import Site
+from django.core.management.base import BaseCommand
+from django.core.management.color import no_style
+from django.db import connection, transaction
+from django.db.models import Max
+
+LANGUAGE_TAGS = [
+	('en', "English"), ('es', "Spanish"), ('fr', "French"), ('de', "German"), ('pt', "Portuguese"),
+	('it', "Italian"), ('zh', "Chinese"), ('ar', "Arabic"), ('hi', "Hindi"), ('ru', "Russian"),
+]
+
+TIMESTAMP_FIELDS = [
+	(Doctor, 'created'), (Doctor, 'last_updated'),
+	(Patient, 'created'), (Patient, 'last_updated'),
+	(CallEvent, 'received'),
+	(CallSummary, 'created'), (CallSummary, 'last_updated'),
+]
+
+@contextmanager
+def explicit_timestamps():
+	"Let bulk_create write generated values to auto_now and auto_now_add fields."
+	fields = [model._meta.get_field(name) for model, name in TIMESTAMP_FIELDS]
+	saved = [(f.auto_now, f.auto_now_add) for f in fields]
+	for f in fields:
+		f.auto_now = f.auto_now_add = False
+	try:
+		yield
+	finally:
+		for f, (auto_now, auto_now_add) in zip(fields, saved):
+			f.auto_now, f.auto_now_add = auto_now, auto_now_add
+
+def strip_microseconds(d):
+	return d - timedelta(microseconds=d.microseconds)
+
+def next_id(model):
+	return (model.objects.aggregate(Max('pk'))['pk__max'] or 0) + 1
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--patients', type=int, default=100000)
+		parser.add_argument('--doctors', type=int, default=1000)
+		parser.add_argument('--sites', type=int, default=3, help="Number of sites to spread rows across, creating them if needed.")
+		parser.add_argument('--languages', type=int, default=5, help="Number of languages to use (at most {}).".format(len(LANGUAGE_TAGS)))
+		parser.add_argument('--messages-per-call', type=int, default=4)
+		parser.add_argument('--days', type=int, default=30, help="Spread patients over this many days before now.")
+		parser.add_argument('--chunk-size', type=int, default=5000)
+		parser.add_argument('--seed', type=int, default=0)
+
+	def handle(self, *args, **options):
+		self.options = options
+		self.random = random.Random(options['seed'])
+		self.now = datetime.now().replace(microsecond=0)
+
+		self.sites = self.get_sites(options['sites'])
+		self.languages = self.get_languages(options['languages'])
+
+		with explicit_timestamps():
+			self.create_doctors()
+			self.create_patients()
+
+		with connection.cursor() as cursor:
+			for sql in connection.ops.sequence_reset_sql(no_style(), [Doctor, Doctor.languages.through, Patient, ChatMessage, CallEvent, CallSummary]):
+				cursor.execute(sql)
+
+	def get_sites(self, count):
+		sites = list(Site.objects.order_by('id')[:count])
+		for i in range(len(sites), count):
+			sites.append(Site.objects.create(domain='load-{}.doc19.org'.format(i), name='Load test {}'.format(i)))
+		return [site.id for site in sites]
+
+	def get_languages(self, count):
+		languages = []
+		for tag, name in LANGUAGE_TAGS[:count]:
+			language, created = Language.objects.get_or_create(ietf_tag=tag, defaults={'name': name})
+			languages.append(language.id)
+		return languages
+
+	def uuid(self):
+		return uuid.UUID(int=self.random.getrandbits(128), version=4)
+
+	def chunks(self, count, first_id):
+		size = self.options['chunk_size']
+		for start in range(0, count, size):
+			yield range(first_id + start, first_id + min(start + size, count))
+
+	def create_doctors(self):
+		r = self.random
+		# doctors available to take calls for each (site, language)
+		self.pool = {}
+
+		for ids in self.chunks(self.options['doctors'], next_id(Doctor)):
+			doctors, presences, languages = [], [], []
+			for id in ids:
+				created = self.now - timedelta(days=self.options['days'] + r.uniform(0, 30))
+				quiet = r.random() < 0.5
+				doctor = Doctor(
+					id=id,
+					uuid=self.uuid(),
+					created=created,
+					last_updated=created,
+					site_id=r.choice(self.sites),
+					name="Provider {}".format(id),
+					verified=r.random() < 0.9,
+					notify=r.random() < 0.9,
+					fcm_token="load-token-{}".format(id) if r.random() < 0.8 else None,
+					notify_interval=timedelta(hours=r.choice((1, 3, 6, 12, 24))),
+					quiet_time_start=time(r.randint(20, 23)) if quiet else None,
+					quiet_time_end=time(r.randint(5, 9)) if quiet else None,
+					utc_offset=r.randrange(-480, 600, 60),
+					last_notified=self.now - timedelta(hours=r.uniform(0, 48)) if r.random() < 0.7 else None,
+				)
+				doctor.update_next_notify_at()
+				doctors.append(doctor)
+
+				online = r.random() < 0.1
+				last_seen = self.now - timedelta(seconds=r.uniform(0, 30) if online else r.uniform(60, 86400 * self.options['days']))
+				presences.append(DoctorPresence(doctor_id=id, last_seen=last_seen))
+
+				for language_id in r.sample(self.languages, r.randint(1, min(3, len(self.languages)))):
+					languages.append(Doctor.languages.through(doctor_id=id, language_id=language_id))
+					if doctor.verified:
+						self.pool.setdefault((doctor.site_id, language_id), []).append(doctor)
+
+			with transaction.atomic():
+				Doctor.objects.bulk_create(doctors)
+				DoctorPresence.objects.bulk_create(presences)
+				Doctor.languages.through.objects.bulk_create(languages)
+			self.stdout.write("Created {} doctors".format(ids[-1]))
+
+	def create_patients(self):
+		r = self.random
+		next_message_id = next_id(ChatMessage)
+		next_event_id = next_id(CallEvent)
+		next_summary_id = next_id(CallSummary)
+
+		for ids in self.chunks(self.options['patients'], next_id(Patient)):
+			patients, presences, messages, events, summaries = [], [], [], [], []
+			for id in ids:
+				site_id = r.choice(self.sites)
+				language_id = r.choice(self.languages)
+				doctors = self.pool.get((site_id, language_id))
+				state = r.random()
+
+				if state < 0.02:
+					# waiting in the queue right now
+					created = self.now - timedelta(seconds=r.uniform(10, 600))
+				else:
+					created = self.now - timedelta(days=r.uniform(0, self.options['days']))
+
+				patient = Patient(
+					id=id,
+					uuid=self.uuid(),
+					created=created,
+					last_updated=created,
+					site_id=site_id,
+					language_id=language_id,
+					enable_video=r.random() < 0.7,
+					feedback_response=r.choice((0, 0, 0, 0, 1, 2)),
+				)
+				presence = PatientPresence(patient_id=id, site_id=site_id, language_id=language_id)
+				patients.append(patient)
+				presences.append(presence)
+
+				if state < 0.02:
+					presence.last_seen = self.now - timedelta(seconds=r.uniform(0, 20))
+				elif state < 0.12 or not doctors:
+					# gave up before being matched
+					presence.last_seen = created + timedelta(seconds=r.uniform(10, 900))
+				else:
+					doctor = r.choice(doctors)
+					presence.doctor_id = doctor.id
+					presence.session_started = created + timedelta(seconds=r.expovariate(1 / 120))
+					if state < 0.13 and created > self.now - timedelta(hours=1):
+						# still in a call
+						presence.last_seen = self.now
+					else:
+						presence.session_ended = presence.session_started + timedelta(seconds=r.uniform(30, 1800))
+						presence.last_seen = presence.session_ended
+
+					for i in range(self.options['messages_per_call']):
+						messages.append(ChatMessage(
+							id=next_message_id,
+							uuid=self.uuid(),
+							patient_id=patient.uuid,
+							doctor_id=doctor.uuid if i % 2 else None,
+							text="Message {}".format(i),
+							sent=presence.session_started + timedelta(seconds=10 * (i + 1)),
+						))
+						next_message_id += 1
+
+					if presence.session_ended:
+						call_events, summary = self.call(patient, doctor, presence, next_event_id)
+						next_event_id += len(call_events)
+						events.extend(call_events)
+						summary.id = next_summary_id
+						next_summary_id += 1
+						summaries.append(summary)
+
+			with transaction.atomic():
+				Patient.objects.bulk_create(patients)
+				PatientPresence.objects.bulk_create(presences)
+				ChatMessage.objects.bulk_create(messages)
+				CallEvent.objects.bulk_create(events)
+				CallSummary.objects.bulk_create(summaries)
+			self.stdout.write("Created {} patients, {} messages, {} call events".format(ids[-1], next_message_id - 1, next_event_id - 1))
+
+	def call(self, patient, doctor, presence, first_id):
+		"Return the Twilio room events and call summary for a finished call."
+		r = self.random
+		start = presence.session_started
+		end = presence.session_ended
+		room = str(patient.uuid)
+		offsets = {}
+
+		timeline = [(EVENT_ROOM_CREATED, None, None, 0)]
+		roles = {str(patient.uuid): ROLE_PATIENT, str(doctor.id): ROLE_DOCTOR}
+		for identity, role in ((str(patient.uuid), 'patient'), (str(doctor.id), 'doctor')):
+			connected = r.uniform(1, 10)
+			audio = connected + r.uniform(0.5, 3)
+			video = audio + r.uniform(0, 2)
+			offsets[role] = (connected, audio, video)
+			timeline += [
+				(EVENT_PARTICIPANT_CONNECTED, identity, None, connected),
+				(EVENT_TRACK_ADDED, identity, TRACK_AUDIO, audio),
+				(EVENT_TRACK_ADDED, identity, TRACK_VIDEO, video),
+			]
+		duration = (end - start).total_seconds()
+		timeline += [
+			(EVENT_PARTICIPANT_DISCONNECTED, str(patient.uuid), None, duration),
+			(EVENT_ROOM_ENDED, None, None, duration + 1),
+		]
+
+		events = []
+		for i, (event, identity, track, offset) in enumerate(sorted(timeline, key=lambda e: e[3])):
+			timestamp = start + timedelta(seconds=offset)
+			events.append(CallEvent(
+				id=first_id + i,
+				received=timestamp,
+				event=event,
+				room_name=room,
+				patient_id=patient.id,
+				participant_role=roles.get(identity),
+				room_status=ROOM_COMPLETED if event == EVENT_ROOM_ENDED else ROOM_IN_PROGRESS,
+				timestamp=timestamp,
+				participant_id=identity,
+				participant_status=PARTICIPANT_DISCONNECTED if event == EVENT_PARTICIPANT_DISCONNECTED else (PARTICIPANT_CONNECTED if identity else None),
+				track_kind=track,
+				room_duration=timedelta(seconds=int(duration + 1)) if event == EVENT_ROOM_ENDED else None,
+			))
+
+		d = lambda seconds: strip_microseconds(timedelta(seconds=seconds))
+		summary = CallSummary(
+			site_id=patient.site_id,
+			patient_id=patient.id,
+			created=end,
+			last_updated=end,
+			first_event=start,
+			patient_connected=d(offsets['patient'][0]),
+			patient_audio_start=d(offsets['patient'][1]),
+			patient_video_start=d(offsets['patient'][2]),
+			doctor_connected=d(offsets['doctor'][0]),
+			doctor_audio_start=d(offsets['doctor'][1]),
+			doctor_video_start=d(offsets['doctor'][2]),
+			duration=d(duration),
+		)
+		return events, summary
@@ -0,0 +1,82 @@
+"""
+Measure what starting the app costs.
+
+Starts fresh interpreters that set up Django, load the URLconf (which
+imports every view) and optionally import extra modules, under
+python -X importtime, then reports the wall time and which packages the
+import time went to.
+"""
+
+from collections import defaultdict
+import json, os, statistics, subprocess, sys
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+CHILD = """
+import os, sys, time
+start = time.perf_counter()
+os.environ.setdefault('DJANGO_SETTINGS_MODULE', {settings!r})
+import django
+django.setup()
+setup = time.perf_counter()
+from django.urls import get_resolver
+get_resolver().url_patterns
+for module in {modules!r}:
+    __import__(module)
+end = time.perf_counter()
+print('{{"setup": %f, "total": %f}}' % (setup - start, end - start))
+"""
+
+def parse_importtime(stderr):
+	"Return the self time in microseconds of each module in python -X importtime output."
+	times = {}
+	for line in stderr.splitlines():
+		if not line.startswith('import time:') or 'self [us]' in line:
+			continue
+		self_us, cumulative, name = line[len('import time:'):].split('|')
+		times[name.strip()] = int(self_us)
+	return times
+
+class Command(BaseCommand):
+	def add_arguments(self, parser):
+		parser.add_argument('--runs', type=int, default=3, help="Fresh interpreters to start; the median is reported.")
+		parser.add_argument('--import', dest='modules', action='append', default=[], help="Also import this module (may be repeated).")
+		parser.add_argument('--limit', type=int, default=15, help="Number of packages to list.")
+		parser.add_argument('--json', action='store_true', help="Print the results as JSON.")
+
+	def handle(self, *args, **options):
+		walls, setups, packages = [], [], []
+		for i in range(options['runs']):
+			code = CHILD.format(settings=os.environ.get('DJANGO_SETTINGS_MODULE', settings.SETTINGS_MODULE), modules=options['modules'])
+			result = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], capture_output=True, text=True)
+			if result.returncode:
+				raise CommandError("Startup failed:\n" + result.stderr[-2000:])
+			timings = json.loads(result.stdout.strip().splitlines()[-1])
+			walls.append(timings['total'])
+			setups.append(timings['setup'])
+
+			by_package = defaultdict(int)
+			for module, us in parse_importtime(result.stderr).items():
+				by_package[module.split('.')[0]] += us
+			packages.append(by_package)
+
+		names = set().union(*packages)
+		import_ms = {name: statistics.median(p.get(name, 0) for p in packages) / 1000 for name in names}
+		top = sorted(import_ms.items(), key=lambda item: -item[1])[:options['limit']]
+		results = {
+			'total_ms': statistics.median(walls) * 1000,
+			'django_setup_ms': statistics.median(setups) * 1000,
+			'imports_ms': sum(import_ms.values()),
+			'packages': dict(top),
+		}
+
+		if options['json']:
+			self.stdout.write(json.dumps(results, indent=2))
+			return
+
+		self.stdout.write("Startup: {total_ms:.0f}ms (django.setup() {django_setup_ms:.0f}ms), of which imports {imports_ms:.0f}ms".format(**results))
+		self.stdout.write('')
+		self.stdout.write('{:<30}{:>10}'.format('package', 'ms'))
+		for name, ms in top:
+			self.stdout.write('{:<30}{:>10.1f}'.format(name, ms))
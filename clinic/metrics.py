@@ -0,0 +1,77 @@
+"""
+Prometheus metrics for the clinic, served by views.metrics.
+
+Counters and histograms are updated in the request path. When
+PROMETHEUS_MULTIPROC_DIR is set (it must be an empty directory when the
+workers start), prometheus_client stores them in memory-mapped files in
+that directory, so a scrape handled by any gunicorn worker reports the
+totals across all of them. Queue depth and online providers are gauges
+read from the database at scrape time.
+"""
+
+from datetime import datetime
+import os
+
+from django.db.models import Count
+from prometheus_client import CollectorRegistry, Counter, Histogram, REGISTRY, generate_latest, multiprocess
+from prometheus_client.core import GaugeMetricFamily
+
+from clinic.models import *
+from clinic.routers import use_replica
+
+NOTIFICATIONS_SENT = Counter('clinic_notifications_sent_total', "Push notifications sent to providers.", ['site'])
+NOTIFICATIONS_FAILED = Counter('clinic_notifications_failed_total', "Push notifications that could not be sent.", ['site'])
+CALLBACKS = Counter('clinic_twilio_callbacks_total', "Twilio room status callbacks received.", ['event'])
+CHAT_REQUESTS = Counter('clinic_chat_requests_total', "Chat polls and posts.", ['method'])
+RATE_LIMITED = Counter('clinic_rate_limited_total', "Requests refused with a 429 by clinic.ratelimit.", ['route'])
+MATCH_LATENCY = Histogram(
+	'clinic_match_latency_seconds',
+	"Time from a caller joining the queue until a provider is matched with them.",
+	['site'],
+	buckets=(5, 15, 30, 60, 120, 300, 600, 1200, 1800, 3600),
+)
+
+CALLBACK_EVENTS = {event for event, _ in EVENT_CHOICES}
+
+def callback_event_label(event):
+	# don't let unexpected callback payloads create new time series
+	return event if event in CALLBACK_EVENTS else 'other'
+
+class ClinicCollector:
+	"Reports gauges computed from the database each time metrics are scraped."
+	def families(self):
+		return (
+			GaugeMetricFamily('clinic_queue_depth', "Callers waiting to be matched.", labels=['site', 'language']),
+			GaugeMetricFamily('clinic_providers_online', "Approved providers currently waiting for or in a call.", labels=['site']),
+		)
+
+	def describe(self):
+		# lets the collector be registered without querying the database
+		return self.families()
+
+	def collect(self):
+		with use_replica():
+			return self.collect_from_database()
+
+	def collect_from_database(self):
+		queue, providers = self.families()
+
+		rows = PatientPresence.get_queue(PatientPresence.objects.all()).order_by().values('site_id', 'language__ietf_tag').annotate(count=Count('pk'))
+		for row in rows:
+			queue.add_metric([str(row['site_id']), row['language__ietf_tag']], row['count'])
+
+		rows = DoctorPresence.objects.filter(doctor__verified=True, last_seen__gt=datetime.now()-DOCTOR_OFFLINE_AFTER).values('doctor__site_id').annotate(count=Count('pk'))
+		for row in rows:
+			providers.add_metric([str(row['doctor__site_id'])], row['count'])
+
+		return (queue, providers)
+
+if 'PROMETHEUS_MULTIPROC_DIR' in os.environ:
+	registry = CollectorRegistry()
+	multiprocess.MultiProcessCollector(registry)
+else:
+	registry = REGISTRY
+registry.register(ClinicCollector())
+
+def render():
+	return generate_latest(registry)
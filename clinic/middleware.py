@@ -0,0 +1,36 @@
+"""
+Keep the middleware stack async-capable, so the async views (see
+clinic/async_views.py) don't each hold a thread under ASGI.
+
+Django runs a middleware that can only handle sync requests, and everything
+beneath it, in a thread for the whole request. WhiteNoise's middleware is
+sync-only; this subclass serves static files the same way but passes other
+requests on without leaving the event loop.
+"""
+
+import asyncio
+
+from whitenoise import middleware
+
+class WhiteNoiseMiddleware(middleware.WhiteNoiseMiddleware):
+	async_capable = True
+
+	def __init__(self, get_response=None, *args, **kwargs):
+		super().__init__(get_response, *args, **kwargs)
+		if asyncio.iscoroutinefunction(get_response):
+			# as django.utils.deprecation.MiddlewareMixin does, so Django awaits this middleware
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		return super().__call__(request)
+
+	async def __acall__(self, request):
+		if self.autorefresh:
+			static_file = self.find_file(request.path_info)
+		else:
+			static_file = self.files.get(request.path_info)
+		if static_file is not None:
+			return self.serve(static_file, request)
+		return await self.get_response(request)
@@ -0,0 +1,21 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:38
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('clinic', '0027_auto_20200404_0202'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctor',
+            name='user',
+            field=models.ForeignKey(null=True, on_delete=django.db.models.deletion.SET_NULL, to=settings.AUTH_USER_MODEL),
+        ),
+    ]
@@ -0,0 +1,45 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:40
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('sites', '0002_alter_domain_unique'),
+        ('clinic', '0028_doctor_user'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DoctorPresence',
+            fields=[
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+                ('doctor', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='presence', serialize=False, to='clinic.Doctor')),
+            ],
+            options={
+                'abstract': False,
+            },
+        ),
+        migrations.CreateModel(
+            name='PatientPresence',
+            fields=[
+                ('last_seen', models.DateTimeField(blank=True, null=True)),
+                ('patient', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='presence', serialize=False, to='clinic.Patient')),
+                ('session_started', models.DateTimeField(blank=True, null=True)),
+                ('session_ended', models.DateTimeField(blank=True, null=True)),
+                ('doctor', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.PROTECT, related_name='sessions', to='clinic.Doctor')),
+                ('language', models.ForeignKey(on_delete=django.db.models.deletion.PROTECT, related_name='+', to='clinic.Language')),
+                ('site', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='sites.Site')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='patientpresence',
+            index=models.Index(condition=models.Q(('session_started__isnull', True)), fields=['site', 'language', 'last_seen'], name='clinic_patient_queue_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='patientpresence',
+            index=models.Index(condition=models.Q(('session_ended__isnull', True), ('session_started__isnull', False)), fields=['doctor'], name='clinic_patient_active_idx'),
+        ),
+    ]
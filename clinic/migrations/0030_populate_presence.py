@@ -0,0 +1,56 @@
+from itertools import islice
+
+from django.db import migrations
+
+BATCH_SIZE = 1000
+
+PATIENT_FIELDS = ('site_id', 'language_id', 'doctor_id', 'last_seen', 'session_started', 'session_ended')
+
+
+def batches(iterable):
+    iterator = iter(iterable)
+    while True:
+        batch = list(islice(iterator, BATCH_SIZE))
+        if not batch:
+            return
+        yield batch
+
+
+def copy_to_presence(apps, schema_editor):
+    Doctor = apps.get_model('clinic', 'Doctor')
+    DoctorPresence = apps.get_model('clinic', 'DoctorPresence')
+    Patient = apps.get_model('clinic', 'Patient')
+    PatientPresence = apps.get_model('clinic', 'PatientPresence')
+
+    rows = Doctor.objects.values_list('id', 'last_seen').iterator(chunk_size=BATCH_SIZE)
+    for batch in batches(rows):
+        DoctorPresence.objects.bulk_create([DoctorPresence(doctor_id=id, last_seen=last_seen) for id, last_seen in batch])
+
+    rows = Patient.objects.values_list('id', *PATIENT_FIELDS).iterator(chunk_size=BATCH_SIZE)
+    for batch in batches(rows):
+        PatientPresence.objects.bulk_create([PatientPresence(patient_id=row[0], **dict(zip(PATIENT_FIELDS, row[1:]))) for row in batch])
+
+
+def copy_from_presence(apps, schema_editor):
+    Doctor = apps.get_model('clinic', 'Doctor')
+    DoctorPresence = apps.get_model('clinic', 'DoctorPresence')
+    Patient = apps.get_model('clinic', 'Patient')
+    PatientPresence = apps.get_model('clinic', 'PatientPresence')
+
+    for presence in DoctorPresence.objects.iterator(chunk_size=BATCH_SIZE):
+        Doctor.objects.filter(id=presence.doctor_id).update(last_seen=presence.last_seen)
+
+    rows = PatientPresence.objects.values_list('patient_id', *PATIENT_FIELDS).iterator(chunk_size=BATCH_SIZE)
+    for row in rows:
+        Patient.objects.filter(id=row[0]).update(**dict(zip(PATIENT_FIELDS, row[1:])))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0029_presence'),
+    ]
+
+    operations = [
+        migrations.RunPython(copy_to_presence, copy_from_presence),
+    ]
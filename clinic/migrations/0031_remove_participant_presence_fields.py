@@ -0,0 +1,52 @@
+# Generated by Django 3.2.25 on 2026-10-19 17:40
+
+# The columns moved to the presence tables by 0029 and 0030 are only removed
+# from the models here. The release phase runs migrate while the previous
+# release's dynos are still serving, and reading them, and rolling back needs
+# them too; a later release drops them once no running code uses them. Until
+# then only the foreign key on clinic_patient.doctor_id is dropped, so that the
+# stale column doesn't stop doctors being deleted.
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0030_populate_presence'),
+    ]
+
+    operations = [
+        migrations.SeparateDatabaseAndState(
+            state_operations=[
+                migrations.RemoveField(
+                    model_name='doctor',
+                    name='last_seen',
+                ),
+                migrations.RemoveField(
+                    model_name='patient',
+                    name='doctor',
+                ),
+                migrations.RemoveField(
+                    model_name='patient',
+                    name='last_seen',
+                ),
+                migrations.RemoveField(
+                    model_name='patient',
+                    name='session_ended',
+                ),
+                migrations.RemoveField(
+                    model_name='patient',
+                    name='session_started',
+                ),
+            ],
+            database_operations=[
+                migrations.AlterField(
+                    model_name='patient',
+                    name='doctor',
+                    field=models.ForeignKey(blank=True, null=True, db_constraint=False, on_delete=django.db.models.deletion.PROTECT, to='clinic.doctor'),
+                ),
+            ],
+        ),
+    ]
@@ -0,0 +1,109 @@
+# Turns clinic_callevent and clinic_chatmessage into tables partitioned by
+# time on Postgres (see clinic/partitions.py); other databases are left
+# alone. The existing table becomes a partition holding everything up to
+# the end of the current period, so no rows are copied, but it is locked
+# while its new primary key index is built.
+
+from datetime import datetime, timedelta
+
+from django.db import migrations
+
+# table, partition column, interval, partitions to create ahead, statements creating the parent's indexes and constraints
+TABLES = [
+    ('clinic_callevent', 'received', 'month', 3, [
+        'CREATE INDEX clinic_callevent_room_name_part_idx ON clinic_callevent (room_name)',
+    ]),
+    ('clinic_chatmessage', 'sent', 'day', 7, [
+        # unique constraints on a partitioned table must include the partition column
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_uuid_sent_key UNIQUE (uuid, sent)',
+        'CREATE INDEX clinic_chatmessage_patient_id_part_idx ON clinic_chatmessage (patient_id)',
+        'CREATE INDEX clinic_chatmessage_doctor_id_part_idx ON clinic_chatmessage (doctor_id)',
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_patient_id_part_fk FOREIGN KEY (patient_id) REFERENCES clinic_patient (uuid) DEFERRABLE INITIALLY DEFERRED',
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_doctor_id_part_fk FOREIGN KEY (doctor_id) REFERENCES clinic_doctor (uuid) DEFERRABLE INITIALLY DEFERRED',
+    ]),
+]
+
+# statements recreating the original indexes and constraints when unpartitioning
+UNPARTITIONED = {
+    'clinic_callevent': [
+        'CREATE INDEX clinic_callevent_room_name_idx ON clinic_callevent (room_name)',
+    ],
+    'clinic_chatmessage': [
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_uuid_key UNIQUE (uuid)',
+        'CREATE INDEX clinic_chatmessage_patient_id_idx ON clinic_chatmessage (patient_id)',
+        'CREATE INDEX clinic_chatmessage_doctor_id_idx ON clinic_chatmessage (doctor_id)',
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_patient_id_fk FOREIGN KEY (patient_id) REFERENCES clinic_patient (uuid) DEFERRABLE INITIALLY DEFERRED',
+        'ALTER TABLE clinic_chatmessage ADD CONSTRAINT clinic_chatmessage_doctor_id_fk FOREIGN KEY (doctor_id) REFERENCES clinic_doctor (uuid) DEFERRABLE INITIALLY DEFERRED',
+    ],
+}
+
+
+def period_start(d, interval):
+    d = d.replace(hour=0, minute=0, second=0, microsecond=0)
+    return d.replace(day=1) if interval == 'month' else d
+
+
+def next_period(start, interval):
+    if interval == 'month':
+        return (start + timedelta(days=32)).replace(day=1)
+    return start + timedelta(days=1)
+
+
+def partition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for table, column, interval, ahead, statements in TABLES:
+        legacy = table + '_legacy'
+        sequence = table + '_part_id_seq'
+        boundary = next_period(period_start(datetime.now(), interval), interval)
+
+        schema_editor.execute('ALTER TABLE {} RENAME TO {}'.format(table, legacy))
+        schema_editor.execute('CREATE TABLE {} (LIKE {}) PARTITION BY RANGE ({})'.format(table, legacy, column))
+
+        # a sequence owned by the new table, so that ids keep counting up and it outlives the legacy partition
+        schema_editor.execute('CREATE SEQUENCE {} OWNED BY {}.id'.format(sequence, table))
+        schema_editor.execute("SELECT setval('{}', COALESCE((SELECT MAX(id) FROM {}), 0) + 1, false)".format(sequence, legacy))
+        schema_editor.execute("ALTER TABLE {} ALTER COLUMN id SET DEFAULT nextval('{}')".format(table, sequence))
+
+        schema_editor.execute('ALTER TABLE {0} ADD CONSTRAINT {0}_part_pkey PRIMARY KEY (id, {1})'.format(table, column))
+        for sql in statements:
+            schema_editor.execute(sql)
+
+        schema_editor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM (MINVALUE) TO ('{}')".format(table, legacy, boundary.isoformat(sep=' ')))
+        schema_editor.execute('CREATE TABLE {0}_default PARTITION OF {0} DEFAULT'.format(table))
+
+        start = boundary
+        for i in range(ahead):
+            end = next_period(start, interval)
+            name = '{}_p{}'.format(table, start.strftime('%Y%m' if interval == 'month' else '%Y%m%d'))
+            schema_editor.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ('{}') TO ('{}')".format(
+                name, table, start.isoformat(sep=' '), end.isoformat(sep=' ')))
+            start = end
+
+
+def unpartition(apps, schema_editor):
+    if schema_editor.connection.vendor != 'postgresql':
+        return
+
+    for table, column, interval, ahead, statements in TABLES:
+        plain = table + '_plain'
+        schema_editor.execute('CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS)'.format(plain, table))
+        schema_editor.execute('INSERT INTO {} SELECT * FROM {}'.format(plain, table))
+        schema_editor.execute('ALTER SEQUENCE {}_part_id_seq OWNED BY {}.id'.format(table, plain))
+        schema_editor.execute('DROP TABLE {}'.format(table))
+        schema_editor.execute('ALTER TABLE {} RENAME TO {}'.format(plain, table))
+        schema_editor.execute('ALTER TABLE {} ADD PRIMARY KEY (id)'.format(table))
+        for sql in UNPARTITIONED[table]:
+            schema_editor.execute(sql)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0031_remove_participant_presence_fields'),
+    ]
+
+    operations = [
+        migrations.RunPython(partition, unpartition),
+    ]
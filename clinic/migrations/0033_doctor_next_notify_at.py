@@ -0,0 +1,32 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:10
+
+from django.db import migrations, models
+from django.db.models import ExpressionWrapper, F
+
+
+def backfill_next_notify_at(apps, schema_editor):
+    Doctor = apps.get_model('clinic', 'Doctor')
+    # mirrors Doctor.update_next_notify_at(); doctors notified before with no interval stay null
+    Doctor.objects.filter(last_notified__isnull=True).update(next_notify_at=F('created'))
+    Doctor.objects.filter(last_notified__isnull=False, notify_interval__isnull=False).update(
+        next_notify_at=ExpressionWrapper(F('last_notified') + F('notify_interval'), output_field=models.DateTimeField()))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0032_partition_events_and_messages'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='doctor',
+            name='next_notify_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_next_notify_at, migrations.RunPython.noop),
+        migrations.AddIndex(
+            model_name='doctor',
+            index=models.Index(condition=models.Q(('next_notify_at__isnull', False), ('notify', True), ('verified', True)), fields=['site', 'next_notify_at'], name='clinic_doctor_notifiable_idx'),
+        ),
+    ]
@@ -0,0 +1,74 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:11
+
+import uuid
+
+from django.db import migrations, models, transaction
+import django.db.models.deletion
+
+BATCH_SIZE = 1000
+
+ROLE_PATIENT = 1
+ROLE_DOCTOR = 2
+
+
+def valid_uuid(value):
+    try:
+        uuid.UUID(value)
+        return True
+    except (TypeError, ValueError):
+        return False
+
+
+def resolve_participants(apps, schema_editor):
+    # mirrors CallEvent.resolve_participant(), a batch of events at a time
+    CallEvent = apps.get_model('clinic', 'CallEvent')
+    Patient = apps.get_model('clinic', 'Patient')
+
+    last_id = 0
+    while True:
+        rows = list(CallEvent.objects.filter(id__gt=last_id).order_by('id').values_list('id', 'room_name', 'participant_id')[:BATCH_SIZE])
+        if not rows:
+            return
+        last_id = rows[-1][0]
+
+        rooms = {room for id, room, participant in rows if valid_uuid(room)}
+        patients = {str(u): (id, doctor_id) for u, id, doctor_id in Patient.objects.filter(uuid__in=rooms).values_list('uuid', 'id', 'presence__doctor_id')}
+
+        events = []
+        for id, room, participant in rows:
+            if room not in patients:
+                continue
+            patient_id, doctor_id = patients[room]
+            role = None
+            if participant == room:
+                role = ROLE_PATIENT
+            elif doctor_id is not None and participant == str(doctor_id):
+                role = ROLE_DOCTOR
+            events.append(CallEvent(id=id, patient_id=patient_id, participant_role=role))
+
+        with transaction.atomic():
+            CallEvent.objects.bulk_update(events, ['patient', 'participant_role'])
+
+
+class Migration(migrations.Migration):
+
+    # each batch of the backfill is committed on its own, so the table isn't locked for the whole run
+    atomic = False
+
+    dependencies = [
+        ('clinic', '0033_doctor_next_notify_at'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='callevent',
+            name='participant_role',
+            field=models.PositiveSmallIntegerField(blank=True, choices=[(1, 'caller'), (2, 'provider')], null=True),
+        ),
+        migrations.AddField(
+            model_name='callevent',
+            name='patient',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to='clinic.patient'),
+        ),
+        migrations.RunPython(resolve_participants, migrations.RunPython.noop),
+    ]
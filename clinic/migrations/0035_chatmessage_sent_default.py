@@ -0,0 +1,19 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:28
+
+import datetime
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0034_callevent_patient'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='chatmessage',
+            name='sent',
+            field=models.DateTimeField(default=datetime.datetime.now, editable=False),
+        ),
+    ]
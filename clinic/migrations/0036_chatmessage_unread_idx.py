@@ -0,0 +1,17 @@
+# Generated by Django 3.2.25 on 2026-10-19 18:34
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0035_chatmessage_sent_default'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='chatmessage',
+            index=models.Index(condition=models.Q(('read__isnull', True)), fields=['patient', 'doctor'], name='clinic_chatmessage_unread_idx'),
+        ),
+    ]
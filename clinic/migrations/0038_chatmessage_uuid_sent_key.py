@@ -0,0 +1,36 @@
+# 0032 partitioned clinic_chatmessage on Postgres, where a unique constraint
+# has to include the partition column, so it replaced the unique uuid with
+# clinic_chatmessage_uuid_sent_key, created by hand. This adds that
+# constraint to the model, and to the schema of other databases, where uuid
+# stays unique on its own too; on Postgres only the state changes.
+
+from django.db import migrations, models
+
+
+class UnlessPartitioned(migrations.SeparateDatabaseAndState):
+    def database_forwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            super().database_forwards(app_label, schema_editor, from_state, to_state)
+
+    def database_backwards(self, app_label, schema_editor, from_state, to_state):
+        if schema_editor.connection.vendor != 'postgresql':
+            super().database_backwards(app_label, schema_editor, from_state, to_state)
+
+
+OPERATIONS = [
+    migrations.AddConstraint(
+        model_name='chatmessage',
+        constraint=models.UniqueConstraint(fields=('uuid', 'sent'), name='clinic_chatmessage_uuid_sent_key'),
+    ),
+]
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('clinic', '0037_watermark'),
+    ]
+
+    operations = [
+        UnlessPartitioned(state_operations=OPERATIONS, database_operations=OPERATIONS),
+    ]
@@ -1,8 +1,12 @@
 from django.conf import settings
 from django.contrib.sites.models import Site
+from django.core.cache import cache
+from django.core.cache.utils import make_template_fragment_key
 from django.db import models
 from django.db.models import F, Q
 from django.db.models.functions import Extract
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils.translation import gettext as _
 
 import os, uuid
@@ -12,7 +16,6 @@ class Participant(models.Model):
 	uuid = models.UUIDField(unique=True, default=uuid.uuid4, editable=False)
 	created = models.DateTimeField(auto_now_add=True)
 	last_updated = models.DateTimeField(auto_now=True)
-	last_seen = models.DateTimeField(blank=True, null=True)
 	ip_address = models.GenericIPAddressField(blank=True, null=True, verbose_name=_("IP address"))
 	twilio_jwt = models.TextField(blank=True, null=True, editable=False)
 	site = models.ForeignKey(Site, on_delete=models.CASCADE)
@@ -20,6 +23,13 @@ class Participant(models.Model):
 	class Meta:
  		abstract = True
 
+class Presence(models.Model):
+	"Volatile state for a Participant, kept in a narrow row so heartbeats don't rewrite the wide one."
+	last_seen = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		abstract = True
+
 class Language(models.Model):
 	ietf_tag = models.CharField(max_length=5, unique=True)
 	name = models.CharField(max_length=30)
@@ -72,6 +82,8 @@ class Doctor(Participant):
 	last_notified = models.DateTimeField(blank=True, null=True)
 	notify = models.BooleanField(default=True, verbose_name=_("send notifications"), help_text=_("Not yet implemented"))
 	notify_interval = models.DurationField(blank=True, null=True, verbose_name=_("notify me no more than once every"), default=timedelta(hours=6))
+	# last_notified + notify_interval, kept up to date by save() so due doctors can be found with an index; null if never due again
+	next_notify_at = models.DateTimeField(blank=True, null=True, editable=False)
 	quiet_time_start = models.TimeField(blank=True, null=True, verbose_name=_("start of quiet hours"))
 	quiet_time_end = models.TimeField(blank=True, null=True, verbose_name=_("end of quiet hours"))
 	fcm_token = models.TextField(blank=True, null=True, verbose_name=_("FCM push token"))
@@ -83,29 +95,55 @@ class Doctor(Participant):
 
 	class Meta:
 		verbose_name = "provider"
+		indexes = [
+			models.Index(fields=['site', 'next_notify_at'], condition=Q(verified=True, notify=True, next_notify_at__isnull=False), name='clinic_doctor_notifiable_idx'),
+		]
 
 	def __str__(self):
 		return self.name
 
+	def save(self, *args, **kwargs):
+		if kwargs.get('update_fields') is None:
+			self.update_next_notify_at()
+		super().save(*args, **kwargs)
+
+	def update_next_notify_at(self):
+		"Recompute next_notify_at after last_notified or notify_interval changed."
+		if self.last_notified is None:
+			self.next_notify_at = self.created or datetime.now()
+		elif self.notify_interval is None:
+			self.next_notify_at = None
+		else:
+			self.next_notify_at = self.last_notified + self.notify_interval
+
 	@property
 	def patient(self):
-		try:
-			return self.patient_set.get(session_started__isnull=False, session_ended__isnull=True)
-		except Patient.DoesNotExist:
-			return None
+		# the active session is looked up once per instance; views assign to
+		# this property when they start or finish a session
+		if not hasattr(self, '_patient'):
+			try:
+				# the latest, should an abandoned session still be open (see close_stale_sessions)
+				self._patient = PatientPresence.get_active_sessions(self.sessions.select_related('patient')).latest('session_started').patient
+			except PatientPresence.DoesNotExist:
+				self._patient = None
+		return self._patient
+
+	@patient.setter
+	def patient(self, patient):
+		self._patient = patient
 
 	@property
 	def in_session(self):
-		return self.patient_set.filter(session_started__isnull=False, session_ended__isnull=True).exists()
+		return self.patient is not None
 
 	@classmethod
 	def notify_filter(self, qs):
 		# start with those who want notifications and have a push token
-		qs = qs.filter(verified=True, notify=True, fcm_token__isnull=False, last_seen__isnull=False)
+		qs = qs.filter(verified=True, notify=True, fcm_token__isnull=False, presence__last_seen__isnull=False)
 		qs = qs.exclude(fcm_token='')
 
 		# exclude those last notified within their notify_interval
-		due_for_notification = Q(last_notified__isnull=True) | Q(notify_interval__lt=datetime.now()-F('last_notified'))
+		due_for_notification = Q(next_notify_at__lt=datetime.now())
 
 		# annotate with quiet time in UTC
 		local_to_utc = lambda field: Extract(field, 'epoch') + (F('utc_offset') * 60)
@@ -117,15 +155,21 @@ class Doctor(Participant):
 		current_time_epoch = (current_time.hour * 60 * 60) + (current_time.minute * 60) + current_time.second
 		not_quiet_time = null_qt | Q(utc_quiet_time_start__gt=current_time_epoch, utc_quiet_time_end__lt=current_time_epoch)
 
-		return qs.filter(due_for_notification & not_quiet_time).order_by('-last_seen')
+		return qs.filter(due_for_notification & not_quiet_time).order_by('-presence__last_seen')
 
 	@classmethod
 	def notify_object(self, queryset, frequency):
 		if not queryset.filter(last_notified__gt=datetime.now()-frequency).exists():
-			return self.notify_filter(queryset).order_by('last_notified').first()
+			# whoever has been due the longest
+			return self.notify_filter(queryset).order_by('next_notify_at').first()
 		else:
 			return False
 
+DOCTOR_OFFLINE_AFTER=timedelta(seconds=40)
+
+class DoctorPresence(Presence):
+	doctor = models.OneToOneField(Doctor, primary_key=True, on_delete=models.CASCADE, related_name='presence')
+
 FEEDBACK_CHOICES=(
 	(0, "Yes"),
 	(1, "No, there was a technical problem"),
@@ -136,9 +180,6 @@ PATIENT_OFFLINE_AFTER=timedelta(seconds=25)
 
 class Patient(Participant):
 	language = models.ForeignKey(Language, on_delete=models.PROTECT)
-	doctor = models.ForeignKey(Doctor, on_delete=models.PROTECT, blank=True, null=True)
-	session_started = models.DateTimeField(blank=True, null=True)
-	session_ended = models.DateTimeField(blank=True, null=True)
 	notes = models.TextField(blank=True, editable=False)
 	enable_video = models.BooleanField()
 	text_only = models.BooleanField(default=False)
@@ -150,36 +191,83 @@ class Patient(Participant):
 
 	@property
 	def in_session(self):
-		return hasattr(self, 'doctor') and self.session_started and not self.session_ended
+		presence = self.presence
+		return bool(presence.doctor_id and presence.session_started and not presence.session_ended)
 
 	@property
 	def online(self):
-		return bool(self.last_seen) and self.last_seen + PATIENT_OFFLINE_AFTER > datetime.now()
+		last_seen = self.presence.last_seen
+		return bool(last_seen) and last_seen + PATIENT_OFFLINE_AFTER > datetime.now()
 
 	@property
 	def wait_duration(self):
-		if not self.last_seen:
+		presence = self.presence
+		if not presence.last_seen:
 			d = timedelta()
-		elif not self.session_started and not self.online:
-			d = self.last_seen - self.created
-		elif self.session_started:
-			d = self.session_started - self.created
+		elif not presence.session_started and not self.online:
+			d = presence.last_seen - self.created
+		elif presence.session_started:
+			d = presence.session_started - self.created
 		else:
 			d = datetime.now() - self.created
 		return d - timedelta(microseconds=d.microseconds)
 
 	@property
 	def call_events(self):
-		return CallEvent.objects.filter(room_name=str(self.uuid))
+		qs = CallEvent.objects.filter(patient=self)
+		if self.created:
+			# nothing happens in the room before the patient joined, and bounding received
+			# lets Postgres skip the older partitions of the table
+			qs = qs.filter(received__gte=self.created)
+		return qs
 
 	@property
 	def track_added(self):
 		return self.call_events.filter(event=EVENT_TRACK_ADDED).exists()
 
+class PatientPresence(Presence):
+	patient = models.OneToOneField(Patient, primary_key=True, on_delete=models.CASCADE, related_name='presence')
+	# copied from the patient so the queue can be scanned without touching the wide table,
+	# and updated along with it
+	site = models.ForeignKey(Site, on_delete=models.CASCADE, related_name='+')
+	language = models.ForeignKey(Language, on_delete=models.PROTECT, related_name='+')
+	doctor = models.ForeignKey(Doctor, on_delete=models.PROTECT, blank=True, null=True, related_name='sessions')
+	session_started = models.DateTimeField(blank=True, null=True)
+	session_ended = models.DateTimeField(blank=True, null=True)
+
+	class Meta:
+		indexes = [
+			models.Index(fields=['site', 'language', 'last_seen'], condition=Q(session_started__isnull=True), name='clinic_patient_queue_idx'),
+			models.Index(fields=['doctor'], condition=Q(session_started__isnull=False, session_ended__isnull=True), name='clinic_patient_active_idx'),
+		]
+
 	@classmethod
 	def get_queue(self, qs):
 		# must be unmatched and currently online
-		return qs.filter(session_started__isnull=True, last_seen__gt=datetime.now()-PATIENT_OFFLINE_AFTER).order_by('id')
+		return qs.filter(session_started__isnull=True, last_seen__gt=datetime.now()-PATIENT_OFFLINE_AFTER).order_by('patient_id')
+
+	@classmethod
+	def get_active_sessions(self, qs):
+		# matched with a doctor and not yet finished
+		return qs.filter(session_started__isnull=False, session_ended__isnull=True)
+
+@receiver(post_save, sender=Doctor)
+def create_doctor_presence(sender, instance, created, raw=False, **kwargs):
+	if created and not raw:
+		DoctorPresence.objects.create(doctor=instance)
+
+@receiver(post_save, sender=Patient)
+def create_patient_presence(sender, instance, created, raw=False, **kwargs):
+	if created and not raw:
+		PatientPresence.objects.create(patient=instance, site_id=instance.site_id, language_id=instance.language_id)
+
+@receiver(post_save, sender=Patient)
+def update_patient_presence(sender, instance, created, raw=False, update_fields=None, **kwargs):
+	# keeps the presence's copies in step when the patient moves site or language (e.g. in the admin)
+	if created or raw or (update_fields is not None and not {'site', 'language'} & set(update_fields)):
+		return
+	(PatientPresence.objects.filter(patient=instance).exclude(site_id=instance.site_id, language_id=instance.language_id)
+		.update(site_id=instance.site_id, language_id=instance.language_id))
 
 class Report(models.Model):
 	by_doctor = models.ForeignKey(Doctor, on_delete=models.PROTECT, blank=True, null=True)
@@ -188,14 +276,34 @@ class Report(models.Model):
 	reason = models.TextField(blank=True)
 	timestamp = models.DateTimeField(auto_now_add=True)
 
+# purge_old_messages deletes chat messages older than this
+CHAT_MESSAGE_MAX_AGE=timedelta(days=1)
+
 class ChatMessage(models.Model):
+	# on Postgres the table is partitioned by sent, so there uuid is only unique
+	# together with it (see Meta) and chatbuffer.write() skips messages already stored
 	uuid = models.UUIDField(unique=True, editable=False)
 	doctor = models.ForeignKey(Doctor, on_delete=models.CASCADE, blank=True, null=True, to_field='uuid')
 	patient = models.ForeignKey(Patient, on_delete=models.CASCADE, blank=True, null=True, to_field='uuid')
 	text = models.TextField()
-	sent = models.DateTimeField(auto_now_add=True)
+	# not auto_now_add, so that messages written behind keep the time they were sent (see clinic/chatbuffer.py)
+	sent = models.DateTimeField(default=datetime.now, editable=False)
+	# set from the reader's cursor when chatbuffer flushes
 	read = models.DateTimeField(blank=True, null=True)
 
+	class Meta:
+		indexes = [
+			models.Index(fields=['patient', 'doctor'], condition=Q(read__isnull=True), name='clinic_chatmessage_unread_idx'),
+		]
+		constraints = [
+			models.UniqueConstraint(fields=['uuid', 'sent'], name='clinic_chatmessage_uuid_sent_key'),
+		]
+
+	@classmethod
+	def get_unread(self, qs, by_doctor):
+		# messages the provider (by_doctor) or the caller hasn't seen yet, i.e. those the other one sent
+		return qs.filter(read__isnull=True, doctor__isnull=by_doctor)
+
 class Disclaimer(models.Model):
 	site = models.ForeignKey(Site, on_delete=models.CASCADE)
 	html = models.TextField(verbose_name=_("HTML"))
@@ -209,6 +317,11 @@ class VolunteerUpdate(models.Model):
 	message = models.TextField()
 	timestamp = models.DateTimeField(auto_now_add=True)
 
+@receiver([post_save, post_delete], sender=VolunteerUpdate)
+def invalidate_volunteer_updates(sender, **kwargs):
+	# the updates list is cached as a template fragment in volunteer_homepage.html
+	cache.delete(make_template_fragment_key('volunteer_updates'))
+
 EVENT_ROOM_CREATED = "room-created"
 EVENT_ROOM_ENDED = "room-ended"
 EVENT_PARTICIPANT_CONNECTED = "participant-connected"
@@ -253,6 +366,14 @@ TRACK_CHOICES=(
 	(TRACK_VIDEO, "video"),
 )
 
+ROLE_PATIENT = 1
+ROLE_DOCTOR = 2
+
+PARTICIPANT_ROLE_CHOICES=(
+	(ROLE_PATIENT, "caller"),
+	(ROLE_DOCTOR, "provider"),
+)
+
 class CallEvent(models.Model):
 	received = models.DateTimeField(auto_now_add=True)
 	event = models.CharField(max_length=50, choices=EVENT_CHOICES)
@@ -264,10 +385,36 @@ class CallEvent(models.Model):
 	participant_id = models.CharField(max_length=254, blank=True, null=True)
 	participant_duration = models.DurationField(blank=True, null=True)
 	track_kind = models.CharField(max_length=20, blank=True, null=True, choices=TRACK_CHOICES)
+	# resolved from room_name and participant_id when the event is received
+	patient = models.ForeignKey(Patient, blank=True, null=True, on_delete=models.CASCADE, related_name='+')
+	participant_role = models.PositiveSmallIntegerField(blank=True, null=True, choices=PARTICIPANT_ROLE_CHOICES)
 
 	def __str__(self):
 		return "{} {} @ {}".format(self.room_name, self.event, self.timestamp)
 
+	def resolve_participant(self):
+		"Set patient and participant_role from the room name (the patient's UUID) and the participant's identity."
+		try:
+			room = uuid.UUID(self.room_name)
+		except (TypeError, ValueError):
+			return
+		row = Patient.objects.filter(uuid=room).values_list('id', 'presence__doctor_id').first()
+		if not row:
+			return
+		self.patient_id, doctor_id = row
+		if self.participant_id == self.room_name:
+			self.participant_role = ROLE_PATIENT
+		elif doctor_id is not None and self.participant_id == str(doctor_id):
+			self.participant_role = ROLE_DOCTOR
+
+class Watermark(models.Model):
+	"How far an incremental job has got, so its next run can start from there."
+	name = models.CharField(max_length=50, primary_key=True)
+	position = models.DateTimeField()
+
+	def __str__(self):
+		return "{} @ {}".format(self.name, self.position)
+
 SUCCESSFUL_CALL_DURATION=timedelta(seconds=30)
 
 class CallSummary(models.Model):
@@ -0,0 +1,136 @@
+"""
+Time-based range partitions of the append-only tables on Postgres.
+
+Migration 0032 turns clinic_callevent (partitioned by received, a table
+per month) and clinic_chatmessage (by sent, a table per day) into
+partitioned tables. The manage_partitions command creates the partitions
+for the coming periods and drops those whose rows have all expired, so
+retention is a DROP TABLE instead of a mass DELETE, and queries filtering
+on the partition column only scan the matching partitions. Rows outside
+every partition land in a default partition, from which they're moved
+when their partition is created.
+"""
+
+from collections import namedtuple
+from datetime import datetime, timedelta
+import re
+
+from django.conf import settings
+from django.db import connection, transaction
+
+from clinic.models import CHAT_MESSAGE_MAX_AGE
+
+Partition = namedtuple('Partition', 'name start end default') # start/end are None for MINVALUE/MAXVALUE
+
+class PartitionedTable:
+	def __init__(self, table, column, interval, ahead, retention):
+		self.table = table
+		self.column = column
+		self.interval = interval # 'day' or 'month'
+		self.ahead = ahead # periods to create in advance
+		self.retention = retention # timedelta, or None to keep every partition
+
+	def period_start(self, d):
+		d = d.replace(hour=0, minute=0, second=0, microsecond=0)
+		return d.replace(day=1) if self.interval == 'month' else d
+
+	def next_period(self, start):
+		if self.interval == 'month':
+			return (start + timedelta(days=32)).replace(day=1)
+		return start + timedelta(days=1)
+
+	def partition_name(self, start):
+		return '{}_p{}'.format(self.table, start.strftime('%Y%m' if self.interval == 'month' else '%Y%m%d'))
+
+	@property
+	def default_partition(self):
+		return self.table + '_default'
+
+def call_event_retention():
+	days = settings.CALL_EVENT_RETENTION_DAYS
+	return timedelta(days=int(days)) if days else None
+
+TABLES = [
+	PartitionedTable('clinic_callevent', 'received', 'month', ahead=3, retention=call_event_retention()),
+	PartitionedTable('clinic_chatmessage', 'sent', 'day', ahead=7, retention=CHAT_MESSAGE_MAX_AGE),
+]
+
+def is_partitioned(table):
+	if connection.vendor != 'postgresql':
+		return False
+	with connection.cursor() as cursor:
+		cursor.execute("SELECT 1 FROM pg_partitioned_table pt JOIN pg_class c ON c.oid = pt.partrelid WHERE c.relname = %s", [table.table])
+		return cursor.fetchone() is not None
+
+def literal(d):
+	# partition bounds must be constants, so they can't be passed as query parameters
+	return "'{}'".format(d.isoformat(sep=' '))
+
+def parse_bound(value):
+	return None if value in ('MINVALUE', 'MAXVALUE') else datetime.fromisoformat(value.strip("'"))
+
+def partitions(table):
+	"Return the table's partitions, ordered by start."
+	with connection.cursor() as cursor:
+		cursor.execute("""
+			SELECT c.relname, pg_get_expr(c.relpartbound, c.oid)
+			FROM pg_inherits i JOIN pg_class c ON c.oid = i.inhrelid JOIN pg_class p ON p.oid = i.inhparent
+			WHERE p.relname = %s
+		""", [table.table])
+		rows = cursor.fetchall()
+	result = []
+	for name, bound in rows:
+		match = re.match(r"FOR VALUES FROM \((.+)\) TO \((.+)\)", bound)
+		if match:
+			result.append(Partition(name, parse_bound(match.group(1)), parse_bound(match.group(2)), False))
+		else:
+			result.append(Partition(name, None, None, True))
+	return sorted(result, key=lambda p: (p.start is not None, p.start or datetime.min))
+
+def overlaps(partition, start, end):
+	if partition.default:
+		return False
+	return (partition.start is None or partition.start < end) and (partition.end is None or partition.end > start)
+
+@transaction.atomic
+def create_partition(table, start, end):
+	name = table.partition_name(start)
+	q = connection.ops.quote_name
+	with connection.cursor() as cursor:
+		# rows already in the default partition would make a plain CREATE ... PARTITION OF fail, so move them across
+		cursor.execute("SELECT EXISTS(SELECT 1 FROM {} WHERE {} >= %s AND {} < %s)".format(
+			q(table.default_partition), q(table.column), q(table.column)), [start, end])
+		if cursor.fetchone()[0]:
+			cursor.execute("CREATE TABLE {} (LIKE {} INCLUDING DEFAULTS INCLUDING CONSTRAINTS)".format(q(name), q(table.table)))
+			cursor.execute("WITH moved AS (DELETE FROM {} WHERE {} >= %s AND {} < %s RETURNING *) INSERT INTO {} SELECT * FROM moved".format(
+				q(table.default_partition), q(table.column), q(table.column), q(name)), [start, end])
+			cursor.execute("ALTER TABLE {} ATTACH PARTITION {} FOR VALUES FROM ({}) TO ({})".format(q(table.table), q(name), literal(start), literal(end)))
+		else:
+			cursor.execute("CREATE TABLE {} PARTITION OF {} FOR VALUES FROM ({}) TO ({})".format(q(name), q(table.table), literal(start), literal(end)))
+	return name
+
+def ensure_partitions(table, now=None, dry_run=False):
+	"Create the partitions covering the current period and the next table.ahead periods; return their names."
+	existing = partitions(table)
+	created = []
+	start = table.period_start(now or datetime.now())
+	for i in range(table.ahead + 1):
+		end = table.next_period(start)
+		if not any(overlaps(p, start, end) for p in existing):
+			created.append(table.partition_name(start) if dry_run else create_partition(table, start, end))
+		start = end
+	return created
+
+def drop_expired(table, now=None, dry_run=False):
+	"Drop the partitions that only hold rows older than table.retention; return their names."
+	if not table.retention:
+		return []
+	cutoff = (now or datetime.now()) - table.retention
+	dropped = []
+	for p in partitions(table):
+		if not p.default and p.end is not None and p.end <= cutoff:
+			if not dry_run:
+				with connection.cursor() as cursor:
+					cursor.execute("DROP TABLE {}".format(connection.ops.quote_name(p.name)))
+			dropped.append(p.name)
+	return dropped
@@ -0,0 +1,153 @@
+"""
+Sampling profiler for individual requests, for staff only.
+
+When settings.PROFILING is enabled, a staff user can ask for a request to
+be profiled by sending an X-Profile header or a ?profile= query parameter
+whose value is the sampling rate (1 profiles every such request, 0.1 about
+one in ten). The view runs under cProfile and the stats are written to
+PROFILING_DIR, which keeps only the newest PROFILING_MAX_PROFILES. Use the
+profiles command to list and dump them, and to switch profiling off in
+every worker at once. Each host keeps its own PROFILING_DIR, so run the
+command where the profiles were taken; the switch is kept in the cache, so
+it needs CACHE_BACKEND set to one that the workers share.
+"""
+
+from datetime import datetime
+import asyncio, cProfile, json, os, random, re, time
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import MiddlewareNotUsed
+
+from clinic import chatbuffer
+
+DISABLED_KEY = 'profiling_disabled'
+
+def profile_dir():
+	return settings.PROFILING_DIR
+
+def is_disabled():
+	return bool(cache.get(DISABLED_KEY))
+
+def is_switchable():
+	"Return whether the cache is shared, so that the switch reaches the workers."
+	return chatbuffer.shared_cache()
+
+def set_disabled(disabled):
+	if disabled:
+		cache.set(DISABLED_KEY, True, None)
+	else:
+		cache.delete(DISABLED_KEY)
+
+def requested_rate(request):
+	value = request.META.get('HTTP_X_PROFILE') or request.GET.get('profile')
+	if not value:
+		return 0
+	try:
+		return min(max(float(value), 0), 1)
+	except ValueError:
+		return 1
+
+def list_profiles():
+	"Return the metadata of the stored profiles, newest first."
+	if not os.path.isdir(profile_dir()):
+		return []
+	profiles = []
+	for name in sorted(os.listdir(profile_dir()), reverse=True):
+		if name.endswith('.json'):
+			with open(os.path.join(profile_dir(), name)) as f:
+				profiles.append(json.load(f))
+	return profiles
+
+def profile_path(profile_id):
+	if not re.fullmatch(r'[\w.-]+', profile_id):
+		raise ValueError("invalid profile id")
+	return os.path.join(profile_dir(), profile_id + '.prof')
+
+def save(profiler, meta):
+	os.makedirs(profile_dir(), exist_ok=True)
+	base = os.path.join(profile_dir(), meta['id'])
+	profiler.dump_stats(base + '.prof')
+	with open(base + '.json', 'w') as f:
+		json.dump(meta, f)
+	trim()
+
+def trim():
+	# ids sort by time, so the ring buffer drops the oldest first
+	ids = sorted(name[:-5] for name in os.listdir(profile_dir()) if name.endswith('.json'))
+	for profile_id in ids[:-settings.PROFILING_MAX_PROFILES or None]:
+		for ext in ('.json', '.prof'):
+			try:
+				os.remove(os.path.join(profile_dir(), profile_id + ext))
+			except FileNotFoundError:
+				pass
+
+class ProfilingMiddleware:
+	async_capable = True
+	sync_capable = True
+
+	def __init__(self, get_response):
+		if not settings.PROFILING:
+			raise MiddlewareNotUsed
+		self.get_response = get_response
+		if asyncio.iscoroutinefunction(get_response):
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+		# a thread can only run one profiler, and async requests share the event loop's
+		self.profiling_async = False
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		if not self.wanted(request):
+			return self.get_response(request)
+
+		profiler = cProfile.Profile()
+		start = time.perf_counter()
+		profiler.enable()
+		try:
+			response = self.get_response(request)
+		finally:
+			profiler.disable()
+		return self.finish(request, response, profiler, (time.perf_counter() - start) * 1000)
+
+	async def __acall__(self, request):
+		# the user is only looked up, in a thread, for requests asking to be profiled
+		if not requested_rate(request) or self.profiling_async or not await sync_to_async(self.wanted)(request):
+			return await self.get_response(request)
+		if self.profiling_async:
+			# another one started while the user was looked up
+			return await self.get_response(request)
+		self.profiling_async = True
+
+		# this profiles the event loop's thread, so time an async view spends in
+		# sync_to_async shows up as waiting rather than as the functions it called
+		profiler = cProfile.Profile()
+		start = time.perf_counter()
+		profiler.enable()
+		try:
+			response = await self.get_response(request)
+		finally:
+			profiler.disable()
+			self.profiling_async = False
+		return await sync_to_async(self.finish)(request, response, profiler, (time.perf_counter() - start) * 1000)
+
+	def wanted(self, request):
+		rate = requested_rate(request)
+		return bool(rate) and request.user.is_staff and random.random() < rate and not is_disabled()
+
+	def finish(self, request, response, profiler, elapsed):
+		now = datetime.now()
+		meta = {
+			'id': '{:%Y%m%dT%H%M%S%f}-{}'.format(now, os.getpid()),
+			'time': now.isoformat(),
+			'method': request.method,
+			'path': request.path,
+			'view': request.resolver_match.view_name if request.resolver_match else None,
+			'user': request.user.get_username(),
+			'status': response.status_code,
+			'duration_ms': elapsed,
+		}
+		save(profiler, meta)
+		response['X-Profile-Id'] = meta['id']
+		return response
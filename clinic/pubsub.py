@@ -0,0 +1,199 @@
+"""
+Wake up clients waiting on a consultation, whichever worker they're in.
+
+publish() announces that something happened to a patient's consultation
+(they were matched with a provider, a chat message was sent or read, the
+session ended) once the current transaction commits, and threads blocked
+in a Waiter for that patient return straight away instead of the client
+finding out on its next poll.
+
+On Postgres messages go through NOTIFY on a single channel; each process
+runs one thread LISTENing on its own connection, which hands them to the
+waiters in that process. Other databases (sqlite in development and tests)
+get an in-process broker, which only wakes waiters in the same process.
+Set PUBSUB_BROKER to use another Broker subclass, e.g. one backed by a
+message bus shared by several hosts; it only has to implement send() and
+hand whatever arrives to deliver().
+"""
+
+from contextlib import asynccontextmanager, contextmanager
+import asyncio, json, logging, os, queue, select, threading, time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections, transaction
+from django.utils.module_loading import import_string
+
+from clinic.clients import once
+
+logger = logging.getLogger(__name__)
+
+CHANNEL = 'clinic'
+
+MATCHED = 'matched'
+MESSAGE = 'message'
+ENDED = 'ended'
+READ = 'read'
+# sent to every waiter when notifications may have been missed, e.g. while the listener reconnected
+RECHECK = 'recheck'
+
+class Waiter:
+	def __init__(self, keys):
+		self.keys = keys
+		# a SimpleQueue, so a put can't slip in between finding it empty and starting to wait
+		self.messages = queue.SimpleQueue()
+
+	def put(self, message):
+		self.messages.put(message)
+
+	def get(self, timeout):
+		"Return the next message, or None if there isn't one within timeout seconds."
+		try:
+			return self.messages.get(timeout=timeout)
+		except queue.Empty:
+			return None
+
+class AsyncWaiter:
+	"A Waiter for async views: messages may be put from any thread, and get() is awaited on the event loop."
+	def __init__(self, keys):
+		self.keys = keys
+		self.loop = asyncio.get_running_loop()
+		self.queue = asyncio.Queue()
+
+	def put(self, message):
+		try:
+			self.loop.call_soon_threadsafe(self.queue.put_nowait, message)
+		except RuntimeError:
+			pass # the loop has closed, so nobody is waiting any more
+
+	async def get(self, timeout):
+		try:
+			return await asyncio.wait_for(self.queue.get(), timeout)
+		except asyncio.TimeoutError:
+			return None
+
+class Broker:
+	"Keeps track of the waiters in this process; subclasses send() messages to the brokers of every process."
+	def __init__(self):
+		self.lock = threading.Lock()
+		self.waiters = {} # key -> set of Waiters
+
+	def subscribe(self, keys, waiter_class=Waiter):
+		waiter = waiter_class(keys)
+		with self.lock:
+			for key in keys:
+				self.waiters.setdefault(key, set()).add(waiter)
+		return waiter
+
+	def unsubscribe(self, waiter):
+		with self.lock:
+			for key in waiter.keys:
+				waiters = self.waiters.get(key, set())
+				waiters.discard(waiter)
+				if not waiters:
+					self.waiters.pop(key, None)
+
+	def deliver(self, message):
+		with self.lock:
+			waiters = list(self.waiters.get(message['key'], ()))
+		for waiter in waiters:
+			waiter.put(message)
+
+	def deliver_all(self, message):
+		with self.lock:
+			waiters = {waiter for waiters in self.waiters.values() for waiter in waiters}
+		for waiter in waiters:
+			waiter.put(dict(message, key=None))
+
+	def send(self, message):
+		raise NotImplementedError
+
+class InMemoryBroker(Broker):
+	def send(self, message):
+		self.deliver(message)
+
+class PostgresBroker(Broker):
+	def __init__(self, alias=DEFAULT_DB_ALIAS):
+		super().__init__()
+		self.alias = alias
+		self.listener = None
+		self.pid = None
+
+	def subscribe(self, keys, waiter_class=Waiter):
+		self.ensure_listening()
+		return super().subscribe(keys, waiter_class)
+
+	def send(self, message):
+		with connections[self.alias].cursor() as cursor:
+			cursor.execute('SELECT pg_notify(%s, %s)', [CHANNEL, json.dumps(message)])
+
+	def ensure_listening(self):
+		# the listener is started by the first waiter, so it's never inherited by forked gunicorn workers
+		with self.lock:
+			if self.listener is None or self.pid != os.getpid():
+				self.pid = os.getpid()
+				self.listener = threading.Thread(target=self.listen, name='pubsub-listener', daemon=True)
+				self.listener.start()
+
+	def listen(self):
+		import psycopg2
+		while True:
+			conn = None
+			try:
+				conn = psycopg2.connect(**connections[self.alias].get_connection_params())
+				conn.autocommit = True
+				with conn.cursor() as cursor:
+					cursor.execute('LISTEN {}'.format(CHANNEL))
+				self.deliver_all({'event': RECHECK})
+				while True:
+					if select.select([conn], [], [], 5) == ([], [], []):
+						continue
+					conn.poll()
+					while conn.notifies:
+						self.deliver(json.loads(conn.notifies.pop(0).payload))
+			except Exception:
+				logger.exception("Lost the %s notification channel, reconnecting", CHANNEL)
+				time.sleep(1)
+			finally:
+				if conn is not None:
+					conn.close()
+
+@once
+def broker():
+	if settings.PUBSUB_BROKER:
+		return import_string(settings.PUBSUB_BROKER)()
+	if connections[DEFAULT_DB_ALIAS].vendor == 'postgresql':
+		return PostgresBroker()
+	return InMemoryBroker()
+
+@contextmanager
+def subscribe(*keys):
+	"Return a Waiter for the messages published to any of keys while in this block."
+	b = broker()
+	waiter = b.subscribe([str(key) for key in keys])
+	try:
+		yield waiter
+	finally:
+		b.unsubscribe(waiter)
+
+@asynccontextmanager
+async def subscribe_async(*keys):
+	"Like subscribe(), for async views: the Waiter's get() is a coroutine and doesn't hold a thread."
+	b = broker()
+	waiter = b.subscribe([str(key) for key in keys], AsyncWaiter)
+	try:
+		yield waiter
+	finally:
+		b.unsubscribe(waiter)
+
+def send(key, event, **data):
+	"Send event to the waiters on key straight away."
+	message = dict(data, key=str(key), event=event)
+	try:
+		broker().send(message)
+	except DatabaseError:
+		# waiters still find out when they time out and check again
+		logger.exception("Could not publish %s", message)
+
+def publish(key, event, **data):
+	"Send event to the waiters on key once the current transaction commits."
+	transaction.on_commit(lambda: send(key, event, **data))
@@ -0,0 +1,125 @@
+"""
+Token-bucket rate limiting of the endpoints clients hit most, so that a
+misbehaving client or bot can't turn its requests into database writes.
+
+RATE_LIMITS gives each limited URL name a bucket per client IP address
+(see client_ip) and, when the request carries a patient_id or doctor_id
+cookie, one per cookie, as (tokens added per second, bucket size). A
+request takes a token from each of its buckets, and is answered with a
+bare 429 before sessions, authentication or the view are touched if any
+of them is empty.
+
+Buckets live in the cache as (tokens, time) pairs: one get_many per
+limited request, plus a set_many when it's let through. The read and
+write aren't atomic, so concurrent requests may slip a few extra through;
+with the default per-process cache, each worker has its own buckets.
+"""
+
+import asyncio, math, time, uuid
+
+from asgiref.sync import sync_to_async
+from django.conf import settings
+from django.core.cache import cache
+from django.http import HttpResponse
+from django.urls import reverse
+
+from clinic import metrics
+
+def take(buckets, now):
+	"""
+	Take a token from each of buckets, a list of (key, rate, size), if they
+	all have one; otherwise take none and return the seconds until they do.
+	"""
+	states = cache.get_many([key for key, rate, size in buckets])
+	wait = 0
+	refilled = {}
+	for key, rate, size in buckets:
+		tokens, then = states.get(key, (size, now))
+		tokens = min(size, tokens + (now - then) * rate)
+		if tokens < 1:
+			wait = max(wait, (1 - tokens) / rate)
+		refilled[key] = tokens
+	if wait:
+		return wait
+	# a bucket left alone until it's full again is the same as a missing one
+	timeout = max(math.ceil(size / rate) for key, rate, size in buckets)
+	cache.set_many({key: (tokens - 1, now) for key, tokens in refilled.items()}, timeout)
+	return 0
+
+def client_ip(request):
+	"""
+	The address the request reached the nearest of TRUSTED_PROXY_COUNT
+	proxies from. Each proxy appends the address it was connected from to
+	X-Forwarded-For, so anything further left may have been made up by the
+	client, e.g. to get a fresh bucket per request.
+	"""
+	count = settings.TRUSTED_PROXY_COUNT
+	if count:
+		forwarded = [ip.strip() for ip in request.META.get('HTTP_X_FORWARDED_FOR', '').split(',') if ip.strip()]
+		if len(forwarded) >= count:
+			return forwarded[-count]
+	return request.META.get('REMOTE_ADDR')
+
+def client_cookie(request):
+	for name in ('patient_id', 'doctor_id'):
+		value = request.COOKIES.get(name)
+		if value:
+			try:
+				# only well-formed ones, which also keeps cache keys short and clean
+				return str(uuid.UUID(value))
+			except ValueError:
+				pass
+	return None
+
+class RateLimitMiddleware:
+	async_capable = True
+	sync_capable = True
+
+	def __init__(self, get_response):
+		self.get_response = get_response
+		# limits by path, so requests needn't be resolved first
+		self.limits = {reverse(name): (name, limit) for name, limit in settings.RATE_LIMITS.items()}
+		if asyncio.iscoroutinefunction(get_response):
+			self._is_coroutine = asyncio.coroutines._is_coroutine
+
+	def __call__(self, request):
+		if asyncio.iscoroutinefunction(self.get_response):
+			return self.__acall__(request)
+		response = self.limited(request)
+		if response is None:
+			response = self.get_response(request)
+		return response
+
+	async def __acall__(self, request):
+		if request.path_info in self.limits:
+			# the cache may be a database or a network away
+			response = await sync_to_async(self.limited, thread_sensitive=False)(request)
+			if response is not None:
+				return response
+		return await self.get_response(request)
+
+	def buckets(self, request):
+		name, limit = self.limits[request.path_info]
+		if request.method not in limit.get('methods', (request.method,)):
+			return name, []
+		buckets = []
+		ip = client_ip(request)
+		if ip and 'ip' in limit:
+			buckets.append(('ratelimit:{}:ip:{}'.format(name, ip),) + limit['ip'])
+		cookie = client_cookie(request)
+		if cookie and 'cookie' in limit:
+			buckets.append(('ratelimit:{}:cookie:{}'.format(name, cookie),) + limit['cookie'])
+		return name, buckets
+
+	def limited(self, request):
+		"Return a 429 response if the request is over its limits, otherwise None."
+		if request.path_info not in self.limits:
+			return None
+		name, buckets = self.buckets(request)
+		wait = take(buckets, time.time()) if buckets else 0
+		if not wait:
+			return None
+		metrics.RATE_LIMITED.labels(route=name).inc()
+		response = HttpResponse("Too many requests", status=429, content_type='text/plain')
+		response['Retry-After'] = math.ceil(wait)
+		return response
@@ -0,0 +1,109 @@
+"""
+Send read-only workloads to replicas.
+
+Reads go to the primary unless they run inside use_replica(), so anything
+that must see its own writes (consultation polling, matching, finish)
+stays on the primary without having to opt out. Admin changelists,
+reports and exports opt in. A replica is skipped while it lags further
+behind the primary than REPLICA_MAX_LAG seconds, or if its lag can't be
+measured, and reads fall back to the primary.
+
+A replica counts as caught up once it has replayed the primary's WAL up to
+where it was when the check started, so a quiet primary doesn't make it
+look further and further behind; otherwise its lag is the time since it
+last replayed a transaction. Only functions any role may call are used, so
+the app's role doesn't need pg_read_all_stats.
+"""
+
+from contextlib import contextmanager
+import logging, random, threading, time
+
+from django.conf import settings
+from django.db import DEFAULT_DB_ALIAS, DatabaseError, connections
+
+logger = logging.getLogger(__name__)
+
+LAG_CHECK_INTERVAL = 5 # seconds
+
+_local = threading.local()
+# replica alias -> (time checked, lag in seconds or None if unknown)
+_lag = {}
+
+@contextmanager
+def use_replica():
+	"Let reads in this block (on this thread) be served by a replica."
+	previous = getattr(_local, 'use_replica', False)
+	_local.use_replica = True
+	try:
+		yield
+	finally:
+		_local.use_replica = previous
+
+def replicas():
+	return [alias for alias in settings.DATABASES if alias.startswith('replica')]
+
+def measure_lag(alias):
+	connection = connections[alias]
+	if connection.vendor != 'postgresql':
+		return 0
+	# the primary is asked first, so everything written before the check is below its position
+	with connections[DEFAULT_DB_ALIAS].cursor() as cursor:
+		cursor.execute("SELECT pg_current_wal_lsn()")
+		primary_lsn = cursor.fetchone()[0]
+	with connection.cursor() as cursor:
+		cursor.execute("""
+			SELECT pg_is_in_recovery(),
+			pg_last_wal_replay_lsn() >= %s::pg_lsn,
+			EXTRACT(EPOCH FROM now() - pg_last_xact_replay_timestamp())
+		""", [primary_lsn])
+		return lag_seconds(*cursor.fetchone())
+
+def lag_seconds(in_recovery, caught_up, since_replay):
+	"Seconds a replica is behind, or None if that can't be told."
+	if not in_recovery:
+		# e.g. promoted, so no longer following the primary
+		return None
+	if caught_up:
+		# it has replayed everything the primary had written, however long ago the last write was
+		return 0
+	if since_replay is None:
+		# behind, and nothing replayed yet
+		return None
+	return float(since_replay)
+
+def replica_lag(alias):
+	checked, lag = _lag.get(alias, (0, None))
+	if time.monotonic() - checked > LAG_CHECK_INTERVAL:
+		try:
+			lag = measure_lag(alias)
+		except DatabaseError:
+			logger.exception("Could not measure replication lag of %s", alias)
+			lag = None
+		_lag[alias] = (time.monotonic(), lag)
+	return lag
+
+def healthy_replicas():
+	healthy = []
+	for alias in replicas():
+		lag = replica_lag(alias)
+		if lag is not None and lag <= settings.REPLICA_MAX_LAG:
+			healthy.append(alias)
+	return healthy
+
+class ReplicaRouter:
+	def db_for_read(self, model, **hints):
+		if getattr(_local, 'use_replica', False):
+			candidates = healthy_replicas()
+			if candidates:
+				return random.choice(candidates)
+		return DEFAULT_DB_ALIAS
+
+	def db_for_write(self, model, **hints):
+		return DEFAULT_DB_ALIAS
+
+	def allow_relation(self, obj1, obj2, **hints):
+		# replicas hold the same rows as the primary
+		return True
+
+	def allow_migrate(self, db, app_label, model_name=None, **hints):
+		return db == DEFAULT_DB_ALIAS
@@ -0,0 +1,135 @@
+"""
+WebSocket endpoints of the ASGI application (see medicam/asgi.py), which
+Django 3.2 doesn't route by itself.
+
+The chat socket carries a session's chat both ways. When it opens it sends
+the messages so far, then every message either participant sends as soon
+as it's published (see clinic/chatbuffer.py), in the same
+{"messages": [...]} form as views.chat. Fan-out goes through pubsub, keyed by the patient like
+everything else in a consultation, so the two participants may be
+connected to different workers. Clients that can't connect keep polling
+views.chat.
+"""
+
+from datetime import datetime
+import asyncio, io, json, time
+from urllib.parse import urlparse
+
+from asgiref.sync import sync_to_async
+from django.core.exceptions import DisallowedHost
+from django.core.handlers.asgi import ASGIRequest
+from django.core.serializers.json import DjangoJSONEncoder
+from django.utils import translation
+
+from clinic import chatbuffer, metrics, pubsub, views
+from clinic.models import *
+
+CHAT_PATH = '/clinic/chat/socket/'
+
+# close codes
+INVALID_DATA = 1007
+POLICY_VIOLATION = 1008
+NOT_FOUND = 4404
+
+async def application(scope, receive, send):
+	if scope['path'] == CHAT_PATH:
+		await chat_socket(scope, receive, send)
+	else:
+		await reject(receive, send, NOT_FOUND)
+
+async def reject(receive, send, code):
+	if (await receive())['type'] == 'websocket.connect':
+		await send({'type': 'websocket.close', 'code': code})
+
+def same_origin(request):
+	# cookies are sent with cross-site WebSocket handshakes too; browsers always send Origin with them
+	origin = request.META.get('HTTP_ORIGIN')
+	if origin is None:
+		return True
+	try:
+		return urlparse(origin).netloc == request.get_host()
+	except DisallowedHost:
+		return False
+
+def open_session(patient_id, doctor_id):
+	"Return the patient UUID and provider name for a chat socket, or None if there's no consultation."
+	patient_uuid = views.consultation_uuid(patient_id, doctor_id)
+	if patient_uuid is None or views.consultation_state(patient_uuid, waiting_caller=False) is None:
+		return None
+	doctor_name = None
+	if doctor_id:
+		doctor_name = Doctor.objects.filter(uuid=doctor_id).values_list('name', flat=True).first() or ''
+	return str(patient_uuid), doctor_name
+
+def translated(language, func):
+	"Run func in a thread with language active, like sync_to_async."
+	def call(*args):
+		with translation.override(language):
+			return func(*args)
+	return sync_to_async(call)
+
+async def chat_socket(scope, receive, send):
+	# the handshake as a request, for its cookies, Host and Accept-Language
+	request = ASGIRequest(dict(scope, method='GET'), io.BytesIO())
+	if not same_origin(request):
+		return await reject(receive, send, POLICY_VIOLATION)
+
+	patient_id = request.COOKIES.get('patient_id')
+	doctor_id = request.COOKIES.get('doctor_id')
+	session = None
+	if patient_id or doctor_id:
+		session = await sync_to_async(open_session)(patient_id, doctor_id)
+	if session is None:
+		return await reject(receive, send, NOT_FOUND)
+	patient_uuid, doctor_name = session
+	reader = chatbuffer.PATIENT if patient_id else chatbuffer.DOCTOR
+	language = translation.get_language_from_request(request)
+
+	if (await receive())['type'] != 'websocket.connect':
+		return
+	await send({'type': 'websocket.accept'})
+
+	async def send_messages(messages):
+		await send({'type': 'websocket.send', 'text': json.dumps({'messages': messages}, cls=DjangoJSONEncoder)})
+
+	# subscribe before reading the history, so nothing sent in between is missed
+	async with pubsub.subscribe_async(patient_uuid) as waiter:
+		await send_messages(await translated(language, views.chat_messages)(patient_uuid, patient_id, doctor_id))
+		receiving = asyncio.ensure_future(receive())
+		waiting = asyncio.ensure_future(waiter.get(None))
+		# an open socket sends no requests, so it records its participant as still there itself
+		next_seen = time.monotonic() + views.SEEN_INTERVAL.total_seconds()
+		try:
+			while True:
+				done, pending = await asyncio.wait([receiving, waiting], timeout=max(0, next_seen - time.monotonic()), return_when=asyncio.FIRST_COMPLETED)
+				if time.monotonic() >= next_seen:
+					await sync_to_async(views.seen)(patient_id, doctor_id)
+					next_seen = time.monotonic() + views.SEEN_INTERVAL.total_seconds()
+
+				if receiving in done:
+					event = receiving.result()
+					if event['type'] == 'websocket.disconnect':
+						return
+					try:
+						data = json.loads(event.get('text') or event.get('bytes') or '')
+						await sync_to_async(chatbuffer.post)(patient_uuid, doctor_id, data, doctor_name)
+					except ValueError:
+						return await send({'type': 'websocket.close', 'code': INVALID_DATA})
+					metrics.CHAT_REQUESTS.labels(method='SOCKET').inc()
+					receiving = asyncio.ensure_future(receive())
+
+				if waiting in done:
+					message = waiting.result()
+					if message['event'] == pubsub.MESSAGE and 'text' in message:
+						with translation.override(language):
+							name = views.sender_name(message['doctor_name'], patient_id, doctor_id)
+						await send_messages([{'uuid': message['uuid'], 'name': name, 'time': message['time'], 'text': message['text'], 'read': False}])
+						if (message['doctor_name'] is not None) == (reader == chatbuffer.PATIENT):
+							await sync_to_async(chatbuffer.mark_read)(patient_uuid, reader, datetime.fromisoformat(message['sent']))
+					elif message['event'] in (pubsub.MESSAGE, pubsub.READ, pubsub.RECHECK):
+						# too long to publish, read, or possibly missed: resend the history, which clients merge
+						await send_messages(await translated(language, views.chat_messages)(patient_uuid, patient_id, doctor_id))
+					waiting = asyncio.ensure_future(waiter.get(None))
+		finally:
+			receiving.cancel()
+			waiting.cancel()
@@ -1,6 +1,62 @@
-function initChat() {
-	refreshChat();
-	setTimeout(refreshChat, 5000);
+var chatLongPoll = false;
+var chatSocket = null;
+var chatEnded = false;
+var chatWaitDelay = 0;
+
+function initChat(longPoll, socketPath) {
+	chatLongPoll = !!longPoll;
+	if (socketPath && window.WebSocket) {
+		openChatSocket(socketPath);
+	} else {
+		refreshChat();
+	}
+}
+
+function openChatSocket(path) {
+	// messages arrive as they're sent; if the socket can't be opened or drops, poll instead
+	var scheme = location.protocol == "https:" ? "wss://" : "ws://";
+	chatSocket = new WebSocket(scheme + location.host + path);
+	chatSocket.onmessage = function(event) {
+		handleChatResponse(JSON.parse(event.data));
+	};
+	chatSocket.onclose = function(event) {
+		console.error("chat socket closed:", event.code);
+		chatSocket = null;
+		refreshChat();
+	};
+}
+
+function scheduleRefresh() {
+	if (chatEnded) {
+		return;
+	} else if (chatLongPoll) {
+		waitForChat();
+	} else {
+		setTimeout(function() { refreshChat() }, 5000);
+	}
+}
+
+function waitForChat() {
+	// returns when a message is sent or the session ends, or after a timeout
+	var started = Date.now();
+	var xhr = new XMLHttpRequest();
+	xhr.onreadystatechange = function() {
+		if (this.readyState == XMLHttpRequest.DONE) {
+			if (this.status == 200 && JSON.parse(this.responseText).event == "ended") {
+				// nothing more will be said: show the last messages and stop waiting
+				chatEnded = true;
+				refreshChat();
+			} else if (this.status == 200 || this.status == 204) {
+				// back off while the server keeps answering straight away
+				chatWaitDelay = Date.now() - started < 1000 ? Math.min(Math.max(chatWaitDelay * 2, 500), 30000) : 0;
+				setTimeout(function() { refreshChat() }, chatWaitDelay);
+			} else {
+				setTimeout(function() { refreshChat() }, 5000);
+			}
+		}
+	};
+	xhr.open("GET", "/clinic/wait/", true);
+	xhr.send();
 }
 
 function refreshChat() {
@@ -12,7 +68,7 @@ function refreshChat() {
 			} else {
 				console.error("chat error:", this.status, this.responseText);
 			}
-			setTimeout(function() { refreshChat() }, 5000);
+			scheduleRefresh();
 		}
 	};
 	xhr.open("GET", "/clinic/chat/", true);
@@ -47,6 +103,9 @@ function appendMessage(msg) {
 	var elemID = msg.uuid;
 	var elem = document.getElementById(elemID);
 	if (!!elem) { // already exists?
+		if (msg.read) {
+			elem.classList.add('read');
+		}
 		return;
 	}
 
@@ -60,6 +119,9 @@ function appendMessage(msg) {
 	elem.getElementsByClassName('name')[0].innerText = msg.name;
 	elem.getElementsByClassName('time')[0].innerText = time;
 	elem.getElementsByClassName('text')[0].innerText = msg.text;
+	if (msg.read) {
+		elem.classList.add('read');
+	}
 	container.appendChild(elem);
 }
 
@@ -95,14 +157,19 @@ function sendChatMessage() {
 		return;
 	}
 
-	var xhr = new XMLHttpRequest();
-	xhr.onreadystatechange = function() {
-		//TODO: indicate success/failure
-	};
-	xhr.open("POST", "/clinic/chat/", true);
-	xhr.setRequestHeader("Content-Type", "application/json");
-	xhr.setRequestHeader("X-CSRFToken", getCookie('csrftoken'));
-	xhr.send(JSON.stringify({"uuid": uuid, "text": text}));
+	var data = JSON.stringify({"uuid": uuid, "text": text});
+	if (chatSocket && chatSocket.readyState == WebSocket.OPEN) {
+		chatSocket.send(data);
+	} else {
+		var xhr = new XMLHttpRequest();
+		xhr.onreadystatechange = function() {
+			//TODO: indicate success/failure
+		};
+		xhr.open("POST", "/clinic/chat/", true);
+		xhr.setRequestHeader("Content-Type", "application/json");
+		xhr.setRequestHeader("X-CSRFToken", getCookie('csrftoken'));
+		xhr.send(data);
+	}
 
 	field.value = "";
 
@@ -0,0 +1,107 @@
+"""
+Closing sessions that nobody finished.
+
+A session stays active until either participant POSTs to finish, so one
+whose participants just closed the page stays open for good, and keeps
+the doctor's "active" lookups busy. close_stale_sessions ends them:
+
+- when Twilio reports that the session's room ended, as of that event's
+  timestamp;
+- when neither participant has been seen for STALE_SESSION_MINUTES, as of
+  when one of them was last seen. An open session page is seen at least
+  every views.SEEN_INTERVAL, through its chat requests, long polls or chat
+  socket, so this catches participants who closed the page without
+  finishing, whether or not Twilio reports the room ending.
+
+Each pass resumes from a Watermark, so a run only reads the events
+received, and the sessions started, since the previous one. Sessions are
+closed a batch per transaction, and each participant is sent ENDED as if
+the session had been finished.
+"""
+
+from datetime import datetime, timedelta
+
+from django.db import transaction
+from django.db.models import Q
+
+from clinic import pubsub
+from clinic.models import *
+
+ROOM_ENDED = 'room-ended'
+TIMED_OUT = 'stale-session'
+
+# events are stamped received when created but may be committed a little later,
+# so each pass rereads this much before its watermark
+EVENT_LAG = timedelta(minutes=1)
+
+def get_watermark(name):
+	return Watermark.objects.filter(name=name).values_list('position', flat=True).first()
+
+def set_watermark(name, position):
+	Watermark.objects.update_or_create(name=name, defaults={'position': position})
+
+def close(ended):
+	"End the sessions of the patients in ended, a dict of patient id to end time, that are still active."
+	with transaction.atomic():
+		presences = list(PatientPresence.get_active_sessions(PatientPresence.objects.filter(patient_id__in=ended))
+			.select_for_update().select_related('patient'))
+		for presence in presences:
+			presence.session_ended = ended[presence.patient_id]
+			pubsub.publish(presence.patient.uuid, pubsub.ENDED)
+		PatientPresence.objects.bulk_update(presences, ['session_ended'])
+	return len(presences)
+
+def close_ended_rooms(cutoff, batch_size):
+	"Close the sessions whose room ended, reading room-ended events received since the last pass."
+	position = get_watermark(ROOM_ENDED)
+	if position is None:
+		# the first pass leaves older sessions to the timeout
+		position = cutoff
+		set_watermark(ROOM_ENDED, position)
+	events = CallEvent.objects.filter(event=EVENT_ROOM_ENDED, patient__isnull=False)
+	closed = 0
+	after = Q(received__gte=position - EVENT_LAG)
+	while True:
+		batch = list(events.filter(after).order_by('received', 'id')
+			.values_list('id', 'received', 'patient_id', 'timestamp', 'patient__presence__session_started')[:batch_size])
+		if not batch:
+			break
+		# a room ended before the session started is an earlier call's
+		closed += close({patient_id: timestamp for _, _, patient_id, timestamp, started in batch if started and timestamp >= started})
+		last_id, last_received = batch[-1][:2]
+		set_watermark(ROOM_ENDED, last_received)
+		after = Q(received__gt=last_received) | Q(received=last_received, id__gt=last_id)
+	return closed
+
+def close_timed_out(cutoff, batch_size):
+	"Close the sessions started since the last pass whose participants haven't been seen since cutoff."
+	sessions = PatientPresence.get_active_sessions(PatientPresence.objects).filter(session_started__lt=cutoff)
+	start = get_watermark(TIMED_OUT)
+	if start:
+		sessions = sessions.filter(session_started__gte=start)
+	closed = 0
+	# sessions still in use hold the watermark back, to be looked at again next time
+	kept = None
+	after = Q()
+	while True:
+		batch = list(sessions.filter(after).order_by('session_started', 'patient_id')
+			.values_list('patient_id', 'session_started', 'last_seen', 'doctor__presence__last_seen')[:batch_size])
+		if not batch:
+			break
+		ended = {}
+		for patient_id, started, *seen in batch:
+			last = max([started] + [s for s in seen if s])
+			if last < cutoff:
+				ended[patient_id] = last
+			elif kept is None:
+				kept = started
+		closed += close(ended)
+		last_id, last_started = batch[-1][:2]
+		after = Q(session_started__gt=last_started) | Q(session_started=last_started, patient_id__gt=last_id)
+	set_watermark(TIMED_OUT, kept or cutoff)
+	return closed
+
+def sweep(stale_after, batch_size=500):
+	"Close stale sessions; return how many were closed because their room ended, and because they timed out."
+	cutoff = datetime.now() - stale_after
+	return close_ended_rooms(cutoff, batch_size), close_timed_out(cutoff, batch_size)
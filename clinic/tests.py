@@ -1,3 +1,838 @@
-from django.test import TestCase
+from datetime import datetime, timedelta
+from unittest import mock, skipIf, skipUnless
+from urllib.parse import urlencode
+import asyncio, importlib, io, json, re, shutil, tempfile, threading
 
-# Create your tests here.
+from django.apps import apps as django_apps
+from django.core.cache import cache
+from django.core.management import CommandError, call_command
+from django.contrib.auth.models import User
+from django.db import DatabaseError, IntegrityError, connection, transaction
+from django.http import HttpResponse
+from asgiref.sync import async_to_sync, sync_to_async
+from django.test import AsyncRequestFactory, RequestFactory, TestCase, TransactionTestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+
+from clinic import archive, async_views, chatbuffer, pubsub, ratelimit, instrumentation, profiling, routers, sockets, sweeper, views, waitlist
+from clinic.models import *
+
+def updated_columns(queries, table):
+	"Return the set of columns written by UPDATE statements against table."
+	columns = set()
+	for query in queries:
+		sql = query['sql']
+		if sql.startswith('UPDATE "{}"'.format(table)):
+			assignments = sql.split(' SET ', 1)[1].split(' WHERE ', 1)[0]
+			columns.update(re.findall(r'"(\w+)" = ', assignments))
+	return columns
+
+class ConsultationTestCase(TestCase):
+	def setUp(self):
+		self.language = Language.objects.create(ietf_tag='en', name='English')
+		self.doctor = Doctor.objects.create(name='Doctor', site_id=1, verified=True, fcm_token='token')
+		self.doctor.languages.add(self.language)
+		self.patient = Patient.objects.create(site_id=1, language=self.language, enable_video=True)
+		PatientPresence.objects.filter(patient=self.patient).update(last_seen=datetime.now())
+		# chat messages stay buffered until a test flushes them
+		cache.clear()
+		patcher = mock.patch.object(chatbuffer.Writer, 'ensure_flushing')
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+	def request(self, method, path, **cookies):
+		for name, value in cookies.items():
+			self.client.cookies[name] = str(value)
+		with CaptureQueriesContext(connection) as queries:
+			getattr(self.client, method)(path)
+		return queries
+
+	def start_session(self):
+		PatientPresence.objects.filter(patient=self.patient).update(doctor=self.doctor, session_started=datetime.now())
+
+class BufferedChatTestCase(ConsultationTestCase):
+	"Buffers chat messages, as with CHAT_FLUSH_INTERVAL set and a cache the workers share."
+	def setUp(self):
+		super().setUp()
+		buffering = override_settings(CHAT_FLUSH_INTERVAL=0.5)
+		buffering.enable()
+		self.addCleanup(buffering.disable)
+		patcher = mock.patch.object(chatbuffer, 'shared_cache', return_value=True)
+		patcher.start()
+		self.addCleanup(patcher.stop)
+
+@override_settings(SITE_ID=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+@mock.patch('clinic.views.setup_twilio_room')
+@mock.patch('clinic.views.get_twilio_jwt', return_value='jwt')
+class ParticipantWriteTests(ConsultationTestCase):
+
+	def test_match_writes_session_columns_only(self, *mocks):
+		queries = self.request('get', '/clinic/consultation/', doctor_id=self.doctor.uuid)
+		self.assertEqual(updated_columns(queries, 'clinic_doctor'), {'twilio_jwt'})
+		self.assertEqual(updated_columns(queries, 'clinic_doctorpresence'), {'last_seen'})
+		self.assertEqual(updated_columns(queries, 'clinic_patient'), {'twilio_jwt'})
+		self.assertEqual(updated_columns(queries, 'clinic_patientpresence'), {'doctor_id', 'session_started'})
+
+	def test_doctor_poll_writes_last_seen_only(self, *mocks):
+		self.start_session()
+		queries = self.request('get', '/clinic/consultation/', doctor_id=self.doctor.uuid)
+		self.assertEqual(updated_columns(queries, 'clinic_doctor'), set())
+		self.assertEqual(updated_columns(queries, 'clinic_doctorpresence'), {'last_seen'})
+		self.assertEqual(updated_columns(queries, 'clinic_patientpresence'), set())
+
+	def test_patient_poll_writes_last_seen_only(self, *mocks):
+		queries = self.request('get', '/clinic/consultation/', patient_id=self.patient.uuid)
+		self.assertEqual(updated_columns(queries, 'clinic_patient'), set())
+		self.assertEqual(updated_columns(queries, 'clinic_patientpresence'), {'last_seen'})
+
+	def test_notification_writes_notification_times_only(self, *mocks):
+		with mock.patch('firebase_admin.messaging.send'), CaptureQueriesContext(connection) as queries:
+			views.send_notification(self.doctor, self.patient)
+		self.assertEqual(updated_columns(queries, 'clinic_doctor'), {'last_notified', 'next_notify_at'})
+
+	def test_doctor_finish_writes_session_ended_only(self, *mocks):
+		self.start_session()
+		queries = self.request('post', '/clinic/finish/', doctor_id=self.doctor.uuid)
+		self.assertEqual(updated_columns(queries, 'clinic_patientpresence'), {'session_ended'})
+
+class PresenceCopyTests(ConsultationTestCase):
+	def test_presence_follows_the_patients_language(self):
+		spanish = Language.objects.create(ietf_tag='es', name='Spanish')
+		self.patient.language = spanish
+		self.patient.save()
+		self.assertEqual(PatientPresence.objects.get(patient=self.patient).language, spanish)
+		self.assertEqual(list(PatientPresence.objects.filter(site_id=1, language=self.language)), [])
+
+	def test_saves_of_other_fields_leave_the_presence_alone(self):
+		with CaptureQueriesContext(connection) as queries:
+			self.patient.save(update_fields=['twilio_jwt'])
+		self.assertEqual(updated_columns(queries, 'clinic_patientpresence'), set())
+
+	def test_old_columns_stay_for_the_previous_release(self):
+		with connection.cursor() as cursor:
+			cursor.execute('UPDATE clinic_patient SET doctor_id = %s, session_started = %s', [self.doctor.id, datetime.now()])
+		# without a foreign key, so the stale column doesn't hold on to deleted doctors
+		self.doctor.delete()
+		connection.check_constraints()
+
+@override_settings(SITE_ID=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class VolunteerUpdateTests(TestCase):
+	def setUp(self):
+		cache.clear()
+
+	def homepage(self):
+		self.client.cookies['doctor_id'] = '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11'
+		return self.client.get('/clinic/')
+
+	def test_saved_updates_show_straight_away(self):
+		update = VolunteerUpdate.objects.create(active=True, message="Welcome")
+		self.assertContains(self.homepage(), "Welcome")
+		update.message = "Thank you"
+		update.save()
+		self.assertContains(self.homepage(), "Thank you")
+
+	def test_updates_are_kept_briefly_without_a_shared_cache(self):
+		self.assertEqual(self.homepage().context['updates_cache_timeout'], views.UNSHARED_UPDATES_CACHE_TIMEOUT)
+		with mock.patch.object(chatbuffer, 'shared_cache', return_value=True):
+			self.assertEqual(self.homepage().context['updates_cache_timeout'], views.UPDATES_CACHE_TIMEOUT)
+
+class BrokerTests(TestCase):
+	def test_delivers_to_subscribed_keys_only(self):
+		broker = pubsub.InMemoryBroker()
+		a, b = broker.subscribe(['a']), broker.subscribe(['b'])
+		broker.send({'key': 'a', 'event': pubsub.MESSAGE})
+		self.assertEqual(a.get(0)['event'], pubsub.MESSAGE)
+		self.assertIsNone(b.get(0))
+
+	def test_unsubscribed_waiters_get_nothing(self):
+		broker = pubsub.InMemoryBroker()
+		waiter = broker.subscribe(['a'])
+		broker.unsubscribe(waiter)
+		broker.send({'key': 'a', 'event': pubsub.MESSAGE})
+		self.assertIsNone(waiter.get(0))
+		self.assertEqual(broker.waiters, {})
+
+	def test_waiter_wakes_for_every_put(self):
+		waiter = pubsub.Waiter(['a'])
+		for i in range(1000):
+			timer = threading.Timer(0, waiter.put, [i])
+			timer.start()
+			self.assertEqual(waiter.get(5), i)
+			timer.join()
+		self.assertIsNone(waiter.get(0))
+
+	def test_publish_waits_for_commit(self):
+		with pubsub.subscribe('a') as waiter:
+			with self.captureOnCommitCallbacks() as callbacks:
+				pubsub.publish('a', pubsub.ENDED)
+			self.assertIsNone(waiter.get(0))
+			for callback in callbacks:
+				callback()
+			self.assertEqual(waiter.get(0), {'key': 'a', 'event': pubsub.ENDED})
+
+@override_settings(SITE_ID=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage', LONG_POLL_TIMEOUT=5)
+@mock.patch('clinic.views.setup_twilio_room')
+@mock.patch('clinic.views.get_twilio_jwt', return_value='jwt')
+class WakeUpTests(ConsultationTestCase):
+	def published(self, method, path, data=None, **cookies):
+		"Make a request and return the events it published for the patient."
+		with pubsub.subscribe(self.patient.uuid) as waiter, self.captureOnCommitCallbacks(execute=True):
+			for name, value in cookies.items():
+				self.client.cookies[name] = str(value)
+			getattr(self.client, method)(path, data, content_type='application/json')
+		events = []
+		while True:
+			message = waiter.get(0)
+			if message is None:
+				return events
+			events.append(message['event'])
+
+	def test_match_wakes_patient(self, *mocks):
+		self.assertEqual(self.published('get', '/clinic/consultation/', doctor_id=self.doctor.uuid), [pubsub.MATCHED])
+
+	def test_chat_message_wakes_session(self, *mocks):
+		data = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}
+		self.assertEqual(self.published('post', '/clinic/chat/', data, patient_id=self.patient.uuid), [pubsub.MESSAGE])
+
+	def test_finish_wakes_patient(self, *mocks):
+		self.start_session()
+		self.assertEqual(self.published('post', '/clinic/finish/', doctor_id=self.doctor.uuid), [pubsub.ENDED])
+
+	def test_wait_returns_when_already_matched(self, *mocks):
+		self.start_session()
+		self.client.cookies['patient_id'] = str(self.patient.uuid)
+		response = self.client.get('/clinic/wait/', {'state': 'waiting'})
+		self.assertEqual(response.json(), {'event': pubsub.MATCHED})
+
+	def test_wait_wakes_on_publish(self, *mocks):
+		self.start_session()
+		message = {'key': str(self.patient.uuid), 'event': pubsub.MESSAGE}
+		timer = threading.Timer(0.1, pubsub.broker().send, [message])
+		timer.start()
+		self.client.cookies['doctor_id'] = str(self.doctor.uuid)
+		response = self.client.get('/clinic/wait/')
+		timer.join()
+		self.assertEqual(response.json(), {'event': pubsub.MESSAGE})
+
+	@override_settings(LONG_POLL_TIMEOUT=0.05)
+	def test_wait_times_out(self, *mocks):
+		self.client.cookies['patient_id'] = str(self.patient.uuid)
+		response = self.client.get('/clinic/wait/', {'state': 'waiting'})
+		self.assertEqual(response.status_code, 204)
+
+	@override_settings(LONG_POLL_TIMEOUT=0)
+	def test_wait_disabled(self, *mocks):
+		self.client.cookies['patient_id'] = str(self.patient.uuid)
+		self.assertEqual(self.client.get('/clinic/wait/').status_code, 404)
+
+@override_settings(SITE_ID=1, LONG_POLL_TIMEOUT=5)
+class AsyncViewTests(ConsultationTestCase):
+	def call(self, view, method, path, data=None, **cookies):
+		request = getattr(AsyncRequestFactory(), method)(path, data, content_type='application/json')
+		request.COOKIES.update({name: str(value) for name, value in cookies.items()})
+		return async_to_sync(view)(request)
+
+	def test_wait_returns_when_already_matched(self):
+		self.start_session()
+		response = self.call(async_views.wait, 'get', '/clinic/wait/?state=waiting', patient_id=self.patient.uuid)
+		self.assertEqual(json.loads(response.content), {'event': pubsub.MATCHED})
+
+	def test_wait_wakes_on_publish(self):
+		self.start_session()
+		message = {'key': str(self.patient.uuid), 'event': pubsub.ENDED}
+		timer = threading.Timer(0.1, pubsub.broker().send, [message])
+		timer.start()
+		response = self.call(async_views.wait, 'get', '/clinic/wait/', doctor_id=self.doctor.uuid)
+		timer.join()
+		self.assertEqual(json.loads(response.content), {'event': pubsub.ENDED})
+
+	def test_chat(self):
+		self.start_session()
+		data = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}
+		self.assertEqual(self.call(async_views.chat, 'post', '/clinic/chat/', data, doctor_id=self.doctor.uuid).status_code, 200)
+		response = self.call(async_views.chat, 'get', '/clinic/chat/', patient_id=self.patient.uuid)
+		self.assertEqual([m['text'] for m in json.loads(response.content)['messages']], ["Hello"])
+
+	def test_room_events(self):
+		request = AsyncRequestFactory().post('/clinic/room-events/', urlencode({
+			'RoomName': str(self.patient.uuid),
+			'RoomStatus': ROOM_IN_PROGRESS,
+			'StatusCallbackEvent': EVENT_PARTICIPANT_CONNECTED,
+			'Timestamp': '2020-04-01T12:00:00Z',
+			'ParticipantIdentity': str(self.patient.uuid),
+		}), content_type='application/x-www-form-urlencoded')
+		self.assertEqual(async_to_sync(async_views.twilio_status_callback)(request).status_code, 200)
+		self.assertEqual(self.patient.call_events.get().participant_role, ROLE_PATIENT)
+
+class ChatMessageTests(ConsultationTestCase):
+	def test_uuid_is_unique_with_sent_as_on_partitioned_postgres(self):
+		partitioned = importlib.import_module('clinic.migrations.0032_partition_events_and_messages')
+		name = ChatMessage._meta.constraints[0].name
+		self.assertTrue(any(name in sql for table, column, interval, ahead, statements in partitioned.TABLES for sql in statements))
+
+		sent = datetime.now()
+		message = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'patient_id': self.patient.uuid, 'text': "Hello"}
+		ChatMessage.objects.create(sent=sent, **message)
+		with self.assertRaises(IntegrityError), transaction.atomic():
+			ChatMessage.objects.create(sent=sent, **message)
+
+	@skipIf(connection.vendor == 'postgresql', "the partitioned table only has uuid unique together with sent")
+	def test_uuid_is_unique_elsewhere(self):
+		message = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'patient_id': self.patient.uuid, 'text': "Hello"}
+		ChatMessage.objects.create(**message)
+		with self.assertRaises(IntegrityError), transaction.atomic():
+			ChatMessage.objects.create(sent=datetime.now() + timedelta(seconds=1), **message)
+
+@override_settings(SITE_ID=1)
+class ChatBufferTests(BufferedChatTestCase):
+	def post(self, data, **cookies):
+		for name, value in cookies.items():
+			self.client.cookies[name] = str(value)
+		return self.client.post('/clinic/chat/', data, content_type='application/json')
+
+	def texts(self, **cookies):
+		for name, value in cookies.items():
+			self.client.cookies[name] = str(value)
+		return [m['text'] for m in self.client.get('/clinic/chat/').json()['messages']]
+
+	def test_reads_merge_buffered_and_written_messages(self):
+		self.start_session()
+		self.post({'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}, patient_id=self.patient.uuid)
+		self.assertEqual(self.texts(), ["Hello"])
+		self.assertEqual(chatbuffer.flush(), 1)
+		self.post({'uuid': '9a0e2f5e-3f2b-4a55-8d0e-2b7cba0a6f31', 'text': "Hi"}, patient_id=self.patient.uuid)
+		self.assertEqual(self.texts(), ["Hello", "Hi"])
+		self.assertEqual(ChatMessage.objects.count(), 1)
+
+	def test_retried_messages_are_stored_once(self):
+		data = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}
+		self.assertEqual(self.post(data, patient_id=self.patient.uuid).status_code, 200)
+		chatbuffer.flush()
+		self.assertEqual(self.post(data).status_code, 200)
+		chatbuffer.flush()
+		self.assertEqual(ChatMessage.objects.count(), 1)
+		self.assertEqual(self.texts(), ["Hello"])
+
+	def test_retries_reaching_another_worker_are_stored_once(self):
+		data = {'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}
+		for flush_interval in (0.5, 0):
+			with self.subTest(flush_interval=flush_interval), override_settings(CHAT_FLUSH_INTERVAL=flush_interval):
+				for i in range(2):
+					# the other worker's cache hasn't seen the message
+					cache.clear()
+					with CaptureQueriesContext(connection) as queries:
+						self.assertEqual(self.post(data, patient_id=self.patient.uuid).status_code, 200)
+						chatbuffer.flush()
+				# not even tried, since the partitioned table wouldn't refuse it
+				self.assertFalse([q for q in queries if q['sql'].startswith('INSERT') and 'INTO "clinic_chatmessage"' in q['sql']])
+				self.assertEqual(ChatMessage.objects.count(), 1)
+
+	def test_messages_are_written_straight_away_without_a_shared_cache(self):
+		chatbuffer.shared_cache.return_value = False
+		self.post({'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}, patient_id=self.patient.uuid)
+		self.assertEqual(ChatMessage.objects.count(), 1)
+		self.assertEqual(chatbuffer.buffered(self.patient.uuid), [])
+
+	def test_locks_time_out_instead_of_being_broken(self):
+		cache.set('room:lock', 'another', None)
+		with mock.patch.object(chatbuffer, 'LOCK_TIMEOUT', 0), self.assertRaises(chatbuffer.LockTimeout):
+			with chatbuffer.locked('room'):
+				pass
+		self.assertEqual(cache.get('room:lock'), 'another')
+
+	def test_locks_taken_over_after_expiring_are_left_alone(self):
+		with chatbuffer.locked('room'):
+			cache.set('room:lock', 'another', None)
+		self.assertEqual(cache.get('room:lock'), 'another')
+
+	def test_malformed_messages_are_refused(self):
+		self.assertEqual(self.post({'uuid': 'not a uuid', 'text': "Hello"}, patient_id=self.patient.uuid).status_code, 400)
+		self.assertEqual(self.post({'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': ""}).status_code, 400)
+		self.assertEqual(chatbuffer.buffered(self.patient.uuid), [])
+
+@override_settings(SITE_ID=1)
+class ReadReceiptTests(BufferedChatTestCase):
+	post = ChatBufferTests.post
+
+	def setUp(self):
+		super().setUp()
+		self.start_session()
+		self.post({'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"}, patient_id=self.patient.uuid)
+		self.post({'uuid': '9a0e2f5e-3f2b-4a55-8d0e-2b7cba0a6f31', 'text': "Are you there?"})
+		chatbuffer.flush()
+		del self.client.cookies['patient_id']
+
+	def reads(self, **cookies):
+		for name, value in cookies.items():
+			self.client.cookies[name] = str(value)
+		return [m['read'] for m in self.client.get('/clinic/chat/').json()['messages']]
+
+	def test_reading_marks_received_messages_in_one_update(self):
+		self.assertEqual(self.reads(doctor_id=self.doctor.uuid), [False, False])
+		with CaptureQueriesContext(connection) as queries:
+			chatbuffer.flush()
+		self.assertEqual(len([q for q in queries if q['sql'].startswith('UPDATE "clinic_chatmessage"')]), 1)
+		self.assertFalse(ChatMessage.get_unread(ChatMessage.objects.all(), by_doctor=True).exists())
+		del self.client.cookies['doctor_id']
+		self.assertEqual(self.reads(patient_id=self.patient.uuid), [True, True])
+
+	@override_settings(CHAT_FLUSH_INTERVAL=0)
+	def test_reading_is_written_straight_away_without_buffering(self):
+		self.reads(doctor_id=self.doctor.uuid)
+		self.assertFalse(ChatMessage.get_unread(ChatMessage.objects.all(), by_doctor=True).exists())
+
+	def test_own_messages_stay_unread(self):
+		self.reads(patient_id=self.patient.uuid)
+		chatbuffer.flush()
+		self.assertEqual(ChatMessage.get_unread(ChatMessage.objects.all(), by_doctor=True).count(), 2)
+
+class ReplicaRouterTests(TestCase):
+	def setUp(self):
+		routers._lag.clear()
+		self.addCleanup(routers._lag.clear)
+
+	def read_db(self):
+		return routers.ReplicaRouter().db_for_read(Patient)
+
+	@mock.patch('clinic.routers.replicas', return_value=['replica0'])
+	@mock.patch('clinic.routers.measure_lag', return_value=0)
+	def test_reads_use_a_replica_inside_use_replica_only(self, *mocks):
+		self.assertEqual(self.read_db(), 'default')
+		with routers.use_replica():
+			self.assertEqual(self.read_db(), 'replica0')
+		self.assertEqual(routers.ReplicaRouter().db_for_write(Patient), 'default')
+
+	@mock.patch('clinic.routers.replicas', return_value=['replica0'])
+	def test_lagging_or_unmeasurable_replicas_fall_back_to_the_primary(self, *mocks):
+		for lag in (30, None):
+			routers._lag.clear()
+			with mock.patch('clinic.routers.measure_lag', return_value=lag), routers.use_replica():
+				self.assertEqual(self.read_db(), 'default')
+		routers._lag.clear()
+		with mock.patch('clinic.routers.measure_lag', side_effect=DatabaseError), routers.use_replica(), self.assertLogs('clinic.routers', 'ERROR'):
+			self.assertEqual(self.read_db(), 'default')
+
+	def test_lag_counts_from_the_last_replay_only_while_behind(self):
+		# a quiet primary, which the replica has caught up with
+		self.assertEqual(routers.lag_seconds(True, True, 3600), 0)
+		self.assertEqual(routers.lag_seconds(True, False, 2), 2)
+		self.assertIsNone(routers.lag_seconds(True, False, None))
+		# not following the primary
+		self.assertIsNone(routers.lag_seconds(False, None, None))
+
+	def test_lag_is_measured_against_the_primarys_position(self):
+		primary, replica = mock.MagicMock(vendor='postgresql'), mock.MagicMock(vendor='postgresql')
+		primary.cursor.return_value.__enter__.return_value.fetchone.return_value = ('0/3000060',)
+		cursor = replica.cursor.return_value.__enter__.return_value
+		cursor.fetchone.return_value = (True, True, 3600.0)
+		with mock.patch.object(routers, 'connections', {'default': primary, 'replica0': replica}):
+			self.assertEqual(routers.measure_lag('replica0'), 0)
+		sql, params = cursor.execute.call_args.args
+		self.assertEqual(params, ['0/3000060'])
+		# the stats views need pg_read_all_stats, which the app's role doesn't have
+		self.assertNotIn('pg_stat', sql)
+
+@override_settings(SITE_ID=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+class AdminReplicaTests(TestCase):
+	def setUp(self):
+		self.client.force_login(User.objects.create_superuser('admin', 'admin@example.com', 'password'))
+
+	def test_changelist_reads_from_a_replica_but_actions_dont(self):
+		with mock.patch('clinic.admin.use_replica', wraps=routers.use_replica) as replica:
+			self.assertEqual(self.client.get('/admin123/clinic/patient/').status_code, 200)
+			self.assertEqual(replica.call_count, 1)
+			self.client.post('/admin123/clinic/patient/', {'action': 'delete_selected', '_selected_action': []})
+			self.assertEqual(replica.call_count, 1)
+
+@override_settings(SITE_ID=1, RATE_LIMITS={'chat': {'ip': (0.01, 3), 'cookie': (0.01, 2)}})
+class RateLimitTests(ConsultationTestCase):
+	def get(self, **cookies):
+		self.client.cookies.clear()
+		for name, value in cookies.items():
+			self.client.cookies[name] = str(value)
+		return self.client.get('/clinic/chat/')
+
+	def test_clients_over_their_limit_get_429(self):
+		self.assertEqual([self.get(patient_id=self.patient.uuid).status_code for i in range(3)], [200, 200, 429])
+		response = self.get(patient_id=self.patient.uuid)
+		self.assertEqual(int(response['Retry-After']), 100)
+
+	def test_address_limit_covers_every_cookie(self):
+		other = Patient.objects.create(site_id=1, language=self.language, enable_video=True)
+		statuses = [self.get(patient_id=self.patient.uuid).status_code, self.get(patient_id=other.uuid).status_code]
+		statuses += [self.get(patient_id=other.uuid).status_code, self.get().status_code]
+		self.assertEqual(statuses, [200, 200, 200, 429])
+
+	def test_forged_forwarded_addresses_share_a_bucket(self):
+		limited = [self.client.get('/clinic/chat/', HTTP_X_FORWARDED_FOR='9.9.9.{}, 1.2.3.4'.format(i)).status_code == 429 for i in range(4)]
+		self.assertEqual(limited, [False, False, False, True])
+		self.assertNotEqual(self.client.get('/clinic/chat/', HTTP_X_FORWARDED_FOR='5.6.7.8').status_code, 429)
+
+	@override_settings(TRUSTED_PROXY_COUNT=0)
+	def test_forwarded_addresses_are_ignored_without_proxies(self):
+		limited = [self.client.get('/clinic/chat/', HTTP_X_FORWARDED_FOR='9.9.9.{}'.format(i)).status_code == 429 for i in range(4)]
+		self.assertEqual(limited, [False, False, False, True])
+
+	def test_async_requests_are_limited(self):
+		async def view(request):
+			return HttpResponse()
+		middleware = ratelimit.RateLimitMiddleware(view)
+		def call():
+			request = AsyncRequestFactory().get('/clinic/chat/')
+			request.COOKIES['doctor_id'] = str(self.doctor.uuid)
+			return async_to_sync(middleware)(request).status_code
+		self.assertEqual([call() for i in range(3)], [200, 200, 429])
+
+@override_settings(SITE_ID=1, STATICFILES_STORAGE='django.contrib.staticfiles.storage.StaticFilesStorage')
+@mock.patch('clinic.views.setup_twilio_room')
+@mock.patch('clinic.views.get_twilio_jwt', return_value='jwt')
+class QueueTests(ConsultationTestCase):
+	def setUp(self):
+		super().setUp()
+		self.others = [Patient.objects.create(site_id=1, language=self.language, enable_video=True) for i in range(2)]
+		PatientPresence.objects.filter(patient__in=self.others).update(last_seen=datetime.now())
+
+	def queue(self, patient):
+		self.client.cookies.clear()
+		self.client.cookies['patient_id'] = str(patient.uuid)
+		return self.client.get('/clinic/queue/')
+
+	def test_position_is_read_from_the_cached_queue(self, *mocks):
+		self.assertEqual(self.queue(self.others[1]).json(), {'position': 3, 'wait': None})
+		# only the caller's own row
+		with self.assertNumQueries(1):
+			self.assertEqual(self.queue(self.others[0]).json(), {'position': 2, 'wait': None})
+
+	def test_match_moves_callers_up_and_estimates_wait(self, *mocks):
+		self.queue(self.others[1])
+		self.client.cookies['doctor_id'] = str(self.doctor.uuid)
+		with self.captureOnCommitCallbacks(execute=True):
+			self.client.get('/clinic/consultation/')
+		del self.client.cookies['doctor_id']
+		self.assertEqual(self.queue(self.patient).status_code, 404)
+		self.assertEqual(self.queue(self.others[0]).json(), {'position': 1, 'wait': 1800})
+		response = self.client.get('/clinic/consultation/')
+		self.assertContains(response, "You are number 1 in line.")
+		self.assertContains(response, "about 30 minutes")
+
+class CallEventTests(ConsultationTestCase):
+	def event(self, participant_id, room_name=None, **kwargs):
+		kwargs.setdefault('event', EVENT_PARTICIPANT_CONNECTED)
+		kwargs.setdefault('timestamp', datetime.now())
+		return CallEvent(room_name=room_name or str(self.patient.uuid), room_status=ROOM_IN_PROGRESS, participant_id=participant_id, **kwargs)
+
+	def resolved(self, e):
+		e.resolve_participant()
+		return e.patient_id, e.participant_role
+
+	def test_participants_resolve_to_the_patient_and_their_role(self):
+		self.start_session()
+		self.assertEqual(self.resolved(self.event(str(self.patient.uuid))), (self.patient.id, ROLE_PATIENT))
+		self.assertEqual(self.resolved(self.event(str(self.doctor.id))), (self.patient.id, ROLE_DOCTOR))
+		# the room is still the patient's, whoever else joins it
+		self.assertEqual(self.resolved(self.event('someone')), (self.patient.id, None))
+
+	def test_rooms_that_are_not_a_patient_stay_unresolved(self):
+		self.assertEqual(self.resolved(self.event('test', room_name='test')), (None, None))
+		unknown = '7c9e6679-7425-40de-944b-e07fc1f99a42'
+		self.assertEqual(self.resolved(self.event(unknown, room_name=unknown)), (None, None))
+
+	def test_backfill_resolves_every_batch(self):
+		self.start_session()
+		events = [self.event(str(self.patient.uuid)), self.event(str(self.doctor.id)), self.event('test', room_name='test')]
+		CallEvent.objects.bulk_create(events)
+		migration = importlib.import_module('clinic.migrations.0034_callevent_patient')
+		with mock.patch.object(migration, 'BATCH_SIZE', 2):
+			migration.resolve_participants(django_apps, None)
+		self.assertEqual(list(CallEvent.objects.order_by('id').values_list('patient_id', 'participant_role')),
+			[(self.patient.id, ROLE_PATIENT), (self.patient.id, ROLE_DOCTOR), (None, None)])
+
+	def test_summaries_read_events_by_patient(self):
+		self.start_session()
+		start = datetime.now()
+		for participant_id, seconds, event in [(str(self.patient.uuid), 0, EVENT_PARTICIPANT_CONNECTED), (str(self.doctor.id), 10, EVENT_PARTICIPANT_CONNECTED), (None, 60, EVENT_ROOM_ENDED)]:
+			views.save_call_event(self.event(participant_id, event=event, timestamp=start + timedelta(seconds=seconds)))
+		with CaptureQueriesContext(connection) as queries:
+			call_command('generate_call_summaries', stdout=io.StringIO())
+		summary = CallSummary.objects.get(patient=self.patient)
+		self.assertEqual((summary.patient_connected, summary.doctor_connected, summary.duration), (timedelta(), timedelta(seconds=10), timedelta(seconds=60)))
+		events = [q['sql'] for q in queries if q['sql'].startswith('SELECT') and 'FROM "clinic_callevent"' in q['sql']]
+		self.assertTrue(events)
+		for sql in events:
+			self.assertIn('"clinic_callevent"."patient_id" =', sql)
+			self.assertNotIn('"room_name" =', sql)
+
+class ArchiveTests(ConsultationTestCase):
+	def setUp(self):
+		super().setUp()
+		location = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, location)
+		patcher = override_settings(ARCHIVE_STORAGE='django.core.files.storage.FileSystemStorage', ARCHIVE_LOCATION=location)
+		patcher.enable()
+		self.addCleanup(patcher.disable)
+		long_ago = datetime.now() - timedelta(days=100)
+		self.start_session()
+		PatientPresence.objects.filter(patient=self.patient).update(session_started=long_ago, session_ended=long_ago)
+		CallEvent.objects.create(event=EVENT_ROOM_ENDED, room_name=str(self.patient.uuid), room_status=ROOM_COMPLETED, timestamp=long_ago, patient=self.patient)
+		ChatMessage.objects.create(uuid='5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', patient=self.patient, doctor=self.doctor, text="Hello", sent=long_ago)
+
+	def archive(self):
+		call_command('archive_patients', stdout=io.StringIO())
+
+	def test_archived_patients_can_be_restored(self):
+		self.archive()
+		self.assertFalse(Patient.objects.exists())
+		self.assertFalse(CallEvent.objects.exists() or ChatMessage.objects.exists())
+		call_command('restore_patient', str(self.patient.id), stdout=io.StringIO())
+		patient = Patient.objects.get(uuid=self.patient.uuid)
+		self.assertEqual(patient.presence.doctor, self.doctor)
+		self.assertEqual(patient.call_events.get().event, EVENT_ROOM_ENDED)
+		self.assertEqual(ChatMessage.objects.get(patient=patient).text, "Hello")
+
+	def test_reported_patients_are_kept(self):
+		Report.objects.create(by_doctor=self.doctor, against_patient=self.patient)
+		self.archive()
+		self.assertTrue(Patient.objects.filter(id=self.patient.id).exists())
+		self.assertEqual(ChatMessage.objects.count(), 1)
+
+	def test_batches_are_checked_again_once_locked(self):
+		cutoff = datetime.now() - timedelta(days=30)
+		ids = list(archive.archivable(cutoff).values_list('id', flat=True))
+		# reported, and then deleted, after the ids were read
+		Report.objects.create(by_doctor=self.doctor, against_patient=self.patient)
+		self.assertEqual(archive.archive_batch(ids, cutoff), (None, 0))
+		self.assertTrue(Patient.objects.filter(id=self.patient.id).exists())
+		self.assertEqual(archive.archive_batch([self.patient.id + 1], cutoff), (None, 0))
+
+@override_settings(SITE_ID=1, METRICS_TOKEN='secret')
+class MetricsTests(ConsultationTestCase):
+	def scrape(self, authorization=None):
+		headers = {'HTTP_AUTHORIZATION': authorization} if authorization is not None else {}
+		return self.client.get('/clinic/metrics/', **headers)
+
+	def test_metrics_need_the_token(self):
+		for authorization in (None, 'Bearer wrong', 'Bearer sécret'):
+			self.assertEqual(self.scrape(authorization).status_code, 404)
+		with override_settings(METRICS_TOKEN=None):
+			self.assertEqual(self.scrape('Bearer None').status_code, 404)
+		self.assertEqual(self.scrape('Bearer secret').status_code, 200)
+
+	def test_gauges_count_the_queue_and_providers_online(self):
+		DoctorPresence.objects.filter(doctor=self.doctor).update(last_seen=datetime.now())
+		body = self.scrape('Bearer secret').content.decode()
+		self.assertIn('clinic_queue_depth{language="en",site="1"} 1.0', body)
+		self.assertIn('clinic_providers_online{site="1"} 1.0', body)
+
+@override_settings(INSTRUMENTATION=True)
+class InstrumentationTests(ConsultationTestCase):
+	def setUp(self):
+		super().setUp()
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		patcher = override_settings(INSTRUMENTATION_DIR=directory)
+		patcher.enable()
+		self.addCleanup(patcher.disable)
+		instrumentation._stats.clear()
+		self.addCleanup(instrumentation._stats.clear)
+
+	def test_server_timing_counts_queries(self):
+		def view(request):
+			Patient.objects.count()
+			return HttpResponse()
+		response = instrumentation.InstrumentationMiddleware(view)(RequestFactory().get('/'))
+		self.assertIn('db;dur=', response['Server-Timing'])
+		self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+	def test_async_requests_are_instrumented_without_a_thread(self):
+		async def view(request):
+			await sync_to_async(Patient.objects.count)()
+			return HttpResponse()
+		middleware = instrumentation.InstrumentationMiddleware(view)
+		self.assertTrue(asyncio.iscoroutinefunction(middleware))
+		response = async_to_sync(middleware)(AsyncRequestFactory().get('/'))
+		self.assertIn('desc="1 queries"', response['Server-Timing'])
+
+	def test_report_merges_flushed_histograms(self):
+		middleware = instrumentation.InstrumentationMiddleware(lambda request: HttpResponse())
+		for i in range(3):
+			middleware(RequestFactory().get('/'))
+		instrumentation.flush()
+		out = io.StringIO()
+		call_command('instrumentation_report', '--json', stdout=out)
+		self.assertEqual(sum(json.loads(out.getvalue())['views']['<unresolved>']['total']['counts']), 3)
+
+@override_settings(PROFILING=True)
+class ProfilingTests(ConsultationTestCase):
+	def setUp(self):
+		super().setUp()
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		patcher = override_settings(PROFILING_DIR=directory)
+		patcher.enable()
+		self.addCleanup(patcher.disable)
+		self.staff = User.objects.create_user('staff', is_staff=True)
+
+	def get(self, user, factory=RequestFactory):
+		request = factory().get('/?profile=1')
+		request.user = user
+		return request
+
+	def test_only_staff_requests_are_profiled(self):
+		middleware = profiling.ProfilingMiddleware(lambda request: HttpResponse())
+		profile_id = middleware(self.get(self.staff))['X-Profile-Id']
+		self.assertEqual([p['id'] for p in profiling.list_profiles()], [profile_id])
+		self.assertNotIn('X-Profile-Id', middleware(self.get(User.objects.create_user('visitor'))))
+		self.assertEqual(len(profiling.list_profiles()), 1)
+
+	def test_async_staff_requests_are_profiled(self):
+		async def view(request):
+			return HttpResponse()
+		middleware = profiling.ProfilingMiddleware(view)
+		self.assertTrue(asyncio.iscoroutinefunction(middleware))
+		response = async_to_sync(middleware)(self.get(self.staff, AsyncRequestFactory))
+		self.assertEqual(response['X-Profile-Id'], profiling.list_profiles()[0]['id'])
+
+	def test_switch_refuses_a_cache_each_process_keeps_to_itself(self):
+		with self.assertRaisesMessage(CommandError, "CACHE_BACKEND"):
+			call_command('profiles', 'disable', stdout=io.StringIO())
+		self.assertFalse(profiling.is_disabled())
+
+	def test_switch_turns_profiling_off(self):
+		directory = tempfile.mkdtemp()
+		self.addCleanup(shutil.rmtree, directory)
+		with override_settings(CACHES={'default': {'BACKEND': 'django.core.cache.backends.filebased.FileBasedCache', 'LOCATION': directory}}):
+			call_command('profiles', 'disable', stdout=io.StringIO())
+			response = profiling.ProfilingMiddleware(lambda request: HttpResponse())(self.get(self.staff))
+		self.assertNotIn('X-Profile-Id', response)
+
+class SweeperTests(ConsultationTestCase):
+	def room_ended(self, patient, timestamp):
+		CallEvent.objects.create(event=EVENT_ROOM_ENDED, room_name=str(patient.uuid), room_status=ROOM_COMPLETED, timestamp=timestamp, patient=patient)
+
+	def sweep(self):
+		with mock.patch.object(pubsub, 'send') as send, self.captureOnCommitCallbacks(execute=True):
+			closed = sweeper.sweep(timedelta(hours=2))
+		return closed, [c.args for c in send.call_args_list]
+
+	def test_ended_rooms_close_their_sessions_once(self):
+		self.start_session()
+		ended = datetime.now()
+		self.room_ended(self.patient, ended)
+		self.assertEqual(self.sweep(), ((1, 0), [(self.patient.uuid, pubsub.ENDED)]))
+		self.assertEqual(PatientPresence.objects.get(patient=self.patient).session_ended, ended)
+		# the next pass starts where this one stopped
+		Watermark.objects.filter(name=sweeper.ROOM_ENDED).update(position=datetime.now() + sweeper.EVENT_LAG)
+		PatientPresence.objects.filter(patient=self.patient).update(session_ended=None)
+		self.assertEqual(self.sweep(), ((0, 0), []))
+
+	def test_sessions_nobody_was_seen_in_time_out(self):
+		long_ago = datetime.now() - timedelta(hours=3)
+		self.start_session()
+		PatientPresence.objects.filter(patient=self.patient).update(session_started=long_ago, last_seen=long_ago)
+		other = Patient.objects.create(site_id=1, language=self.language, enable_video=True)
+		PatientPresence.objects.filter(patient=other).update(doctor=self.doctor, session_started=long_ago + timedelta(minutes=1), last_seen=datetime.now())
+		self.assertEqual(self.sweep(), ((0, 1), [(self.patient.uuid, pubsub.ENDED)]))
+		self.assertEqual(PatientPresence.objects.get(patient=self.patient).session_ended, long_ago)
+		# the session still in use is looked at again next time
+		self.assertEqual(Watermark.objects.get(name=sweeper.TIMED_OUT).position, long_ago + timedelta(minutes=1))
+
+	@override_settings(SITE_ID=1)
+	def test_sessions_still_open_in_a_page_stay_open(self):
+		long_ago = datetime.now() - timedelta(hours=3)
+		self.start_session()
+		PatientPresence.objects.filter(patient=self.patient).update(session_started=long_ago, last_seen=long_ago)
+		DoctorPresence.objects.filter(doctor=self.doctor).update(last_seen=long_ago)
+		self.client.cookies['doctor_id'] = str(self.doctor.uuid)
+		self.client.get('/clinic/chat/')
+		self.client.get('/clinic/chat/')
+		self.assertEqual(self.sweep(), ((0, 0), []))
+		self.assertGreater(DoctorPresence.objects.get(doctor=self.doctor).last_seen, long_ago)
+
+	def test_doctor_with_two_open_sessions_gets_the_latest(self):
+		self.start_session()
+		other = Patient.objects.create(site_id=1, language=self.language, enable_video=True)
+		PatientPresence.objects.filter(patient=other).update(doctor=self.doctor, session_started=datetime.now() + timedelta(seconds=1))
+		self.assertEqual(Doctor.objects.get(pk=self.doctor.pk).patient, other)
+
+class Socket:
+	"Drives clinic.sockets.application the way an ASGI server would."
+	def __init__(self, origin='http://testserver', **cookies):
+		headers = [(b'host', b'testserver'), (b'origin', origin.encode())]
+		headers.append((b'cookie', '; '.join('{}={}'.format(k, v) for k, v in cookies.items()).encode()))
+		scope = {'type': 'websocket', 'path': sockets.CHAT_PATH, 'query_string': b'', 'headers': headers}
+		self.incoming, self.outgoing = asyncio.Queue(), asyncio.Queue()
+		self.incoming.put_nowait({'type': 'websocket.connect'})
+		self.task = asyncio.ensure_future(sockets.application(scope, self.incoming.get, self.outgoing.put))
+
+	async def receive(self):
+		event = await asyncio.wait_for(self.outgoing.get(), 5)
+		return json.loads(event['text']) if event['type'] == 'websocket.send' else event
+
+	async def send(self, data):
+		await self.incoming.put({'type': 'websocket.receive', 'text': json.dumps(data)})
+
+	async def close(self):
+		await self.incoming.put({'type': 'websocket.disconnect', 'code': 1000})
+		await asyncio.wait_for(self.task, 5)
+
+@override_settings(SITE_ID=1)
+class ChatSocketTests(BufferedChatTestCase):
+	def setUp(self):
+		super().setUp()
+		self.start_session()
+
+	def test_messages_reach_the_other_participant_before_they_are_written(self):
+		async def converse():
+			patient = Socket(patient_id=self.patient.uuid)
+			doctor = Socket(doctor_id=self.doctor.uuid)
+			for socket in (patient, doctor):
+				self.assertEqual(await socket.receive(), {'type': 'websocket.accept'})
+				self.assertEqual(await socket.receive(), {'messages': []})
+			await patient.send({'uuid': '5b5bfae8-9e1b-4a4f-a4a4-0c7a44d4ee11', 'text': "Hello"})
+			received = [await doctor.receive(), await patient.receive()]
+			await patient.close()
+			await doctor.close()
+			return received
+
+		to_doctor, to_patient = async_to_sync(converse)()
+		self.assertEqual([(m['name'], m['text']) for m in to_doctor['messages']], [("Visitor", "Hello")])
+		self.assertEqual([(m['name'], m['text']) for m in to_patient['messages']], [("You", "Hello")])
+		self.assertFalse(ChatMessage.objects.exists())
+		self.assertEqual(chatbuffer.flush(), 1)
+		self.assertEqual(ChatMessage.objects.get().patient_id, self.patient.uuid)
+
+	def test_open_sockets_keep_their_participant_seen(self):
+		long_ago = datetime.now() - timedelta(hours=3)
+		DoctorPresence.objects.filter(doctor=self.doctor).update(last_seen=long_ago)
+		async def converse():
+			doctor = Socket(doctor_id=self.doctor.uuid)
+			await doctor.receive()
+			await doctor.receive()
+			await doctor.close()
+		with mock.patch.object(views, 'SEEN_INTERVAL', timedelta(0)):
+			async_to_sync(converse)()
+		self.assertGreater(DoctorPresence.objects.get(doctor=self.doctor).last_seen, long_ago)
+
+	def test_cross_site_sockets_are_refused(self):
+		async def connect():
+			return await Socket(origin='http://example.com', patient_id=self.patient.uuid).receive()
+		self.assertEqual(async_to_sync(connect)(), {'type': 'websocket.close', 'code': sockets.POLICY_VIOLATION})
+
+	def test_malformed_messages_close_the_socket(self):
+		async def converse():
+			socket = Socket(doctor_id=self.doctor.uuid)
+			await socket.receive()
+			await socket.receive()
+			await socket.send({'uuid': 'not a uuid', 'text': "Hello"})
+			return await socket.receive()
+		self.assertEqual(async_to_sync(converse)(), {'type': 'websocket.close', 'code': sockets.INVALID_DATA})
+		self.assertEqual(chatbuffer.buffered(self.patient.uuid), [])
+
+@skipUnless(connection.vendor == 'postgresql', "LISTEN/NOTIFY needs Postgres")
+class PostgresBrokerTests(TransactionTestCase):
+	def test_notify_reaches_listener(self):
+		broker = pubsub.PostgresBroker()
+		waiter = broker.subscribe(['a'])
+		# the listener wakes everyone once it's listening
+		self.assertEqual(waiter.get(10)['event'], pubsub.RECHECK)
+		broker.send({'key': 'a', 'event': pubsub.MATCHED})
+		self.assertEqual(waiter.get(10)['event'], pubsub.MATCHED)
@@ -1,8 +1,14 @@
+from django.conf import settings
 from django.urls import path
 from django.views.generic import TemplateView
 
 from . import views
 
+if settings.ASYNC_VIEWS:
+    from . import async_views as polling_views
+else:
+    polling_views = views
+
 urlpatterns = [
     path('', views.index, name='index'),
     path('volunteer/', views.volunteer, name='volunteer'),
@@ -16,6 +22,9 @@ urlpatterns = [
     path('volunteer-guide/', TemplateView.as_view(template_name='clinic/volunteer_guide.html'), name='volunteer_guide'),
     path('for-organizations/', TemplateView.as_view(template_name='clinic/landing_org.html'), name='landing_org'),
     path('org-request/', views.submit_org, name='submit_org'),
-    path('chat/', views.chat, name='chat'),
-    path('room-events/', views.twilio_status_callback, name='twilio_status_callback'),
+    path('chat/', polling_views.chat, name='chat'),
+    path('wait/', polling_views.wait, name='wait'),
+    path('queue/', polling_views.queue, name='queue'),
+    path('room-events/', polling_views.twilio_status_callback, name='twilio_status_callback'),
+    path('metrics/', views.metrics_view, name='metrics'),
 ]
@@ -1,12 +1,14 @@
 from datetime import datetime, timedelta
-import json, logging
+import hmac, json, logging
 
 from django.conf import settings
+from django.core.cache import cache
+from django.core.exceptions import ValidationError
 from django.core.mail import mail_admins
 from django.contrib.auth.decorators import login_required
 from django.contrib.sites.shortcuts import get_current_site
 from django.db import transaction
-from django.http import HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse
+from django.http import Http404, HttpResponse, HttpResponseBadRequest, HttpResponseNotFound, JsonResponse
 from django.shortcuts import redirect, render
 from django.urls import reverse
 from django.utils.dateparse import parse_datetime
@@ -14,20 +16,20 @@ from django.utils.translation import gettext as _
 from django.views.decorators.csrf import csrf_exempt
 from django.views.decorators.http import require_http_methods
 
+from clinic import chatbuffer, clients, metrics, pubsub, waitlist
 from clinic.forms import *
+from clinic.instrumentation import timed
 from clinic.models import *
 
-from firebase_admin import messaging
 from ipware import get_client_ip
-from twilio.jwt.access_token import AccessToken
-from twilio.jwt.access_token.grants import VideoGrant
-
-import requests
-from requests.auth import HTTPBasicAuth
 
 SIX_MONTHS = 15552000
 ONE_MONTH = 2629800
 
+# the cached updates list is only cleared on save in every worker when they share the cache
+UPDATES_CACHE_TIMEOUT = 300
+UNSHARED_UPDATES_CACHE_TIMEOUT = 10
+
 logger = logging.getLogger(__name__)
 
 def primary_site_only(func):
@@ -45,8 +47,7 @@ def index(request):
 	if doctor_id:
 		return volunteer_homepage(request)
 	else:
-		doctor = Doctor.objects.get(user=request.user)
-		doctor.save()
+		doctor = Doctor.objects.only('uuid').get(user=request.user)
 		response = redirect('index')
 		response.set_cookie('doctor_id', doctor.uuid, max_age=SIX_MONTHS)
 		return response
@@ -58,6 +59,7 @@ def index(request):
 def volunteer_homepage(request):
 	return render(request, 'clinic/volunteer_homepage.html', {
 		'updates': VolunteerUpdate.objects.filter(active=True).order_by('-timestamp'),
+		'updates_cache_timeout': UPDATES_CACHE_TIMEOUT if chatbuffer.shared_cache() else UNSHARED_UPDATES_CACHE_TIMEOUT,
 	})
 
 @primary_site_only
@@ -110,7 +112,7 @@ def consultation(request):
 	doctor_id = request.COOKIES.get('doctor_id')
 	if doctor_id:
 		try:
-			doctor = Doctor.objects.get(uuid=doctor_id)
+			doctor = Doctor.objects.select_related('presence').get(uuid=doctor_id)
 		except Doctor.DoesNotExist:
 			response = redirect('consultation')
 			response.delete_cookie('doctor_id')
@@ -120,7 +122,7 @@ def consultation(request):
 	patient_id = request.COOKIES.get('patient_id')
 	if patient_id:
 		try:
-			patient = Patient.objects.get(uuid=patient_id, session_ended__isnull=True)
+			patient = Patient.objects.select_related('presence').get(uuid=patient_id, presence__session_ended__isnull=True)
 		except Patient.DoesNotExist:
 			response = redirect('consultation')
 			response.delete_cookie('patient_id')
@@ -130,13 +132,15 @@ def consultation(request):
 	return redirect('disclaimer')
 
 def get_twilio_jwt(identity, room):
-	token = AccessToken(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_API_KEY, settings.TWILIO_API_SECRET, identity=identity)
-	token.add_grant(VideoGrant(room=room))
+	access_token = clients.twilio_access_token()
+	token = access_token.AccessToken(settings.TWILIO_ACCOUNT_SID, settings.TWILIO_API_KEY, settings.TWILIO_API_SECRET, identity=identity)
+	token.add_grant(access_token.grants.VideoGrant(room=room))
 	return token.to_jwt().decode('utf-8')
 
+@timed('external')
 def setup_twilio_room(request, room):
 	callback_url = settings.TWILIO_CALLBACK_URL or request.build_absolute_uri(reverse('twilio_status_callback'))
-	auth = HTTPBasicAuth(settings.TWILIO_API_KEY, settings.TWILIO_API_SECRET)
+	auth = (settings.TWILIO_API_KEY, settings.TWILIO_API_SECRET)
 	data = {
 		'UniqueName': room,
 		'StatusCallback': callback_url,
@@ -144,27 +148,33 @@ def setup_twilio_room(request, room):
 		'Type': 'peer-to-peer',
 	}
 	logger.info("Creating room: %s", data)
-	r = requests.post('https://video.twilio.com/v1/Rooms', auth=auth, data=data)
+	r = clients.http().post('https://video.twilio.com/v1/Rooms', auth=auth, data=data)
 
 @transaction.atomic
 def consultation_doctor(request, doctor):
-	doctor.last_seen = datetime.now()
-	doctor.save()
+	doctor.presence.last_seen = datetime.now()
+	doctor.presence.save(update_fields=['last_seen'])
 
 	if not doctor.verified:
 		return render(request, 'clinic/unverified.html')
 
 	if not doctor.patient:
-		queryset = Patient.objects.filter(site=doctor.site, language__in=doctor.languages.all())
-		patient = Patient.get_queue(queryset).first()
-		if patient:
+		queryset = PatientPresence.objects.filter(site_id=doctor.site_id, language__in=doctor.languages.all())
+		presence = PatientPresence.get_queue(queryset).select_related('patient').first()
+		if presence:
+			patient = presence.patient
 			room = str(patient.uuid)
-			patient.doctor = doctor
-			patient.session_started = datetime.now()
+			presence.doctor = doctor
+			presence.session_started = datetime.now()
+			presence.save(update_fields=['doctor', 'session_started'])
+			pubsub.publish(patient.uuid, pubsub.MATCHED)
+			transaction.on_commit(lambda: waitlist.matched(presence.site_id, presence.language_id, patient.id))
+			metrics.MATCH_LATENCY.labels(site=doctor.site_id).observe((presence.session_started - patient.created).total_seconds())
 			patient.twilio_jwt = get_twilio_jwt(identity=str(patient.uuid), room=room)
-			patient.save()
+			patient.save(update_fields=['twilio_jwt'])
 			doctor.twilio_jwt = get_twilio_jwt(identity=str(doctor.id), room=room)
-			doctor.save()
+			doctor.save(update_fields=['twilio_jwt'])
+			doctor.patient = patient
 			setup_twilio_room(request, room)
 			return redirect('consultation')
 		else:
@@ -185,7 +195,8 @@ def consultation_doctor(request, doctor):
 
 def send_notification(doctor, patient):
 	doctor.last_notified = datetime.now()
-	doctor.save()
+	doctor.update_next_notify_at()
+	doctor.save(update_fields=['last_notified', 'next_notify_at'])
 
 	logger.info("Patient is waiting, sending notification to {} (waiting for {})".format(doctor, patient.wait_duration))
 
@@ -195,6 +206,7 @@ def send_notification(doctor, patient):
 	else:
 		wait_minutes_str = "{} minutes".format(wait_minutes)
 
+	messaging = clients.firebase_messaging()
 	message = messaging.Message(
 		notification=messaging.Notification(
 			title="Incoming call on doc19.org",
@@ -203,7 +215,13 @@ def send_notification(doctor, patient):
 		token=settings.TEST_FCM_TOKEN or doctor.fcm_token,
 	)
 
-	response = messaging.send(message)
+	try:
+		with timed('external'):
+			response = messaging.send(message)
+	except Exception:
+		metrics.NOTIFICATIONS_FAILED.labels(site=doctor.site_id).inc()
+		raise
+	metrics.NOTIFICATIONS_SENT.labels(site=doctor.site_id).inc()
 	logger.info("Sent notification to {}: {}".format(doctor, response))
 
 SEND_FIRST_NOTIFICATION_AFTER=timedelta(seconds=30)
@@ -225,16 +243,19 @@ def maybe_send_notification(request, patient):
 
 @transaction.atomic
 def consultation_patient(request, patient):
-	patient.last_seen = datetime.now()
-	patient.save()
+	patient.presence.last_seen = datetime.now()
+	patient.presence.save(update_fields=['last_seen'])
 
 	if not patient.in_session:
 		maybe_send_notification(request, patient)
-		return render(request, 'clinic/waiting_patient.html')
+		queue = waitlist.status(patient.site_id, patient.language_id, patient.id)
+		if queue['wait'] is not None:
+			queue['wait_minutes'] = max(1, round(queue['wait'] / 60))
+		return render(request, 'clinic/waiting_patient.html', context={'queue': queue})
 	else:
 		return render(request, 'clinic/session.html', context={
 			'user_type': 'patient',
-			'doctor': patient.doctor,
+			'doctor': patient.presence.doctor,
 			'video_data': {
 				'token': patient.twilio_jwt,
 				'room': str(patient.uuid),
@@ -253,14 +274,12 @@ def finish(request):
 	patient_id = request.COOKIES.get('patient_id')
 
 	if doctor_id:
-		try:
-			doctor = Doctor.objects.get(uuid=doctor_id)
-			patient = doctor.patient
-			if patient:
-				patient.session_ended = datetime.now()
-				patient.save()
-		except Doctor.DoesNotExist:
-			pass
+		# resolve the doctor's active session in a single query
+		presence = PatientPresence.get_active_sessions(PatientPresence.objects.filter(doctor__uuid=doctor_id)).select_related('patient').order_by('-session_started').first()
+		if presence:
+			presence.session_ended = datetime.now()
+			presence.save(update_fields=['session_ended'])
+			pubsub.publish(presence.patient.uuid, pubsub.ENDED)
 
 		if 'stop_consulting' in request.POST:
 			return response
@@ -278,58 +297,180 @@ def finish(request):
 		form = FeedbackForm(request.POST, instance=patient)
 		if form.is_valid():
 			patient = form.save(commit=False)
-			patient.session_ended = datetime.now()
-			patient.save()
+			patient.save(update_fields=['feedback_response', 'feedback_text'])
 			form.save_m2m()
+			PatientPresence.objects.filter(patient=patient).update(session_ended=datetime.now())
+			pubsub.publish(patient.uuid, pubsub.ENDED)
 		else:
 			return render(request, 'clinic/finish.html', {'form': form})
 
 	return response
 
+def consultation_uuid(patient_id, doctor_id):
+	"Return the UUID of the patient whose consultation the caller or provider is in, or None."
+	if patient_id:
+		return patient_id
+	# the latest, like Doctor.patient
+	return PatientPresence.get_active_sessions(PatientPresence.objects.filter(doctor__uuid=doctor_id)).order_by('-session_started').values_list('patient__uuid', flat=True).first()
+
 @require_http_methods(['GET', 'POST'])
 def chat(request):
+	metrics.CHAT_REQUESTS.labels(method=request.method).inc()
+
 	patient_id = request.COOKIES.get('patient_id')
 	doctor_id = request.COOKIES.get('doctor_id')
-
-	if patient_id:
-		patient = Patient(uuid=patient_id)
-	elif doctor_id:
-		try:
-			patient = Patient.objects.only('uuid').get(doctor__uuid=doctor_id, session_started__isnull=False, session_ended__isnull=True)
-		except Patient.DoesNotExist:
-			return HttpResponseNotFound("no active session")
-	else:
+	if not patient_id and not doctor_id:
 		return HttpResponseBadRequest("patient_id or doctor_id required")
 
+	patient_uuid = consultation_uuid(patient_id, doctor_id)
+	if patient_uuid is None:
+		return HttpResponseNotFound("no active session")
+	seen(patient_id, doctor_id)
+
 	if request.method == 'POST':
-		return chat_post(request, patient.uuid, doctor_id)
+		return chat_post(request, patient_uuid, doctor_id)
+
+	return JsonResponse({'messages': chat_messages(patient_uuid, patient_id, doctor_id)})
+
+def chat_messages(patient_uuid, patient_id, doctor_id):
+	"""
+	Return the messages of a consultation, including those still waiting to
+	be written, for the caller (patient_id) or provider (doctor_id), who has
+	now seen the ones the other sent.
+	"""
+	written = [
+		dict(m, uuid=str(m['uuid']), doctor_name=m['doctor__name'] if m['doctor_id'] else None)
+		for m in ChatMessage.objects.filter(patient__uuid=patient_uuid).values('uuid', 'doctor_id', 'doctor__name', 'text', 'sent', 'read')
+	]
+	uuids = {m['uuid'] for m in written}
+	buffered = [dict(m, read=None) for m in chatbuffer.buffered(patient_uuid) if m['uuid'] not in uuids]
 
 	messages = []
-	for msg in ChatMessage.objects.order_by('sent').filter(patient__uuid=patient.uuid):
-		if (msg.doctor and doctor_id) or (not msg.doctor and patient_id):
-			name = _("You")
-		elif msg.doctor:
-			name = msg.doctor.name
-		else:
-			name = _("Visitor")
-
+	last_received = None
+	for msg in sorted(written + buffered, key=lambda m: m['sent']):
+		# the caller receives the provider's messages, and the provider the caller's
+		received = (msg['doctor_name'] is not None) == bool(patient_id)
+		if received:
+			last_received = msg['sent']
 		messages.append({
-			'uuid': msg.uuid,
-			'name': name,
-			'time': msg.sent.timestamp() * 1000, # JS uses milliseconds
-			'text': msg.text,
+			'uuid': msg['uuid'],
+			'name': sender_name(msg['doctor_name'], patient_id, doctor_id),
+			'time': msg['sent'].timestamp() * 1000, # JS uses milliseconds
+			'text': msg['text'],
+			'read': not received and bool(msg['read']), # by the other participant
 		})
-
-	return JsonResponse({'messages': messages})
+	if last_received:
+		chatbuffer.mark_read(patient_uuid, chatbuffer.PATIENT if patient_id else chatbuffer.DOCTOR, last_received)
+	return messages
+
+def sender_name(doctor_name, patient_id, doctor_id):
+	"Name to show the caller (patient_id) or provider (doctor_id) for a message from a provider, or from the caller if doctor_name is None."
+	if (doctor_name is not None and doctor_id) or (doctor_name is None and patient_id):
+		return _("You")
+	elif doctor_name is not None:
+		return doctor_name
+	return _("Visitor")
 
 def chat_post(request, patient_id, doctor_id):
-	json_data = json.loads(request.body.decode('utf-8'))
-	msg = ChatMessage(patient_id=patient_id, uuid=json_data.get('uuid'), text=json_data.get('text'))
-	if doctor_id:
-		msg.doctor_id = doctor_id
-	msg.save()
+	try:
+		save_chat_message(patient_id, doctor_id, request.body)
+	except ValueError:
+		return HttpResponseBadRequest("uuid and text required")
 	return HttpResponse(status=200)
 
+def save_chat_message(patient_id, doctor_id, body):
+	"Accept a posted message, to be written behind (see clinic/chatbuffer.py); raise ValueError if it's malformed."
+	chatbuffer.post(patient_id, doctor_id, json.loads(body.decode('utf-8')))
+
+def wait(request):
+	"""
+	Long poll: respond as soon as something happens to the consultation of the
+	caller or provider making the request, or with 204 after LONG_POLL_TIMEOUT
+	seconds. A waiting caller passes state=waiting, so that being matched
+	before the request arrived isn't missed.
+	"""
+	if not settings.LONG_POLL_TIMEOUT:
+		raise Http404
+
+	patient_id = request.COOKIES.get('patient_id')
+	doctor_id = request.COOKIES.get('doctor_id')
+	if not patient_id and not doctor_id:
+		return HttpResponseBadRequest("patient_id or doctor_id required")
+
+	patient_uuid = consultation_uuid(patient_id, doctor_id)
+	if patient_uuid is None:
+		return HttpResponseNotFound("no consultation")
+
+	# subscribe before looking at the session, so nothing published in between is missed
+	with pubsub.subscribe(patient_uuid) as waiter:
+		presence = consultation_state(patient_uuid, waiting_caller=bool(patient_id))
+		if presence is None:
+			return HttpResponseNotFound("no consultation")
+		event = unseen_event(presence, request.GET.get('state'))
+		if event:
+			return JsonResponse({'event': event})
+		if presence['session_started']:
+			seen(patient_id, doctor_id)
+
+		message = waiter.get(settings.LONG_POLL_TIMEOUT)
+	if message is None:
+		return HttpResponse(status=204)
+	return JsonResponse({'event': message['event']})
+
+@require_http_methods(['GET'])
+def queue(request):
+	"A waiting caller's position in the queue and estimated wait in seconds, as JSON."
+	patient_id = request.COOKIES.get('patient_id')
+	if not patient_id:
+		return HttpResponseBadRequest("patient_id required")
+	status = queue_status(patient_id)
+	if status is None:
+		return HttpResponseNotFound("not waiting")
+	return JsonResponse(status)
+
+def queue_status(patient_id):
+	"Return waitlist.status for a waiting caller, or None if they aren't waiting."
+	try:
+		presence = PatientPresence.objects.filter(patient__uuid=patient_id).values('patient_id', 'site_id', 'language_id', 'session_started', 'session_ended').get()
+	except (PatientPresence.DoesNotExist, ValidationError):
+		return None
+	if presence['session_started'] or presence['session_ended']:
+		return None
+	return waitlist.status(presence['site_id'], presence['language_id'], presence['patient_id'])
+
+def consultation_state(patient_uuid, waiting_caller):
+	try:
+		presence = PatientPresence.objects.filter(patient__uuid=patient_uuid).values('patient_id', 'session_started', 'session_ended').get()
+	except (PatientPresence.DoesNotExist, ValidationError):
+		return None
+	if waiting_caller and not presence['session_started']:
+		# the caller is still waiting, and counts as online while a wait request is open
+		PatientPresence.objects.filter(patient_id=presence['patient_id']).update(last_seen=datetime.now())
+	return presence
+
+# how often participants of an open session are recorded as still there
+SEEN_INTERVAL=timedelta(minutes=1)
+
+def seen(patient_id, doctor_id):
+	"Record that the caller (patient_id) or provider (doctor_id) is still there, at most every SEEN_INTERVAL, so that close_stale_sessions leaves their session open."
+	if not cache.add('seen:{}'.format(patient_id or doctor_id), True, SEEN_INTERVAL.total_seconds()):
+		return
+	try:
+		if patient_id:
+			PatientPresence.objects.filter(patient__uuid=patient_id).update(last_seen=datetime.now())
+		else:
+			DoctorPresence.objects.filter(doctor__uuid=doctor_id).update(last_seen=datetime.now())
+	except ValidationError:
+		pass # not a UUID
+
+def unseen_event(presence, state):
+	"Return what happened to the consultation before the client started waiting, if anything."
+	if presence['session_ended']:
+		return pubsub.ENDED
+	if state == 'waiting' and presence['session_started']:
+		return pubsub.MATCHED
+	return None
+
 @login_required
 def submit_org(request):
 	if request.method == 'POST':
@@ -343,24 +484,40 @@ def submit_org(request):
 
 @csrf_exempt
 def twilio_status_callback(request):
+	metrics.CALLBACKS.labels(event=metrics.callback_event_label(request.POST.get('StatusCallbackEvent'))).inc()
+	save_call_event(call_event(request.POST))
+	return HttpResponse(status=200)
+
+def call_event(data):
+	"Build a CallEvent from the parameters of a Twilio status callback."
 	e = CallEvent(
-		room_name=request.POST.get('RoomName'),
-		room_status=request.POST.get('RoomStatus'),
-		event=request.POST.get('StatusCallbackEvent'),
-		timestamp=parse_datetime(request.POST.get('Timestamp')).replace(tzinfo=None),
-		participant_status=request.POST.get('ParticipantStatus'),
-		participant_duration=request.POST.get('ParticipantDuration'),
-		participant_id=request.POST.get('ParticipantIdentity'),
-		track_kind=request.POST.get('TrackKind'),
+		room_name=data.get('RoomName'),
+		room_status=data.get('RoomStatus'),
+		event=data.get('StatusCallbackEvent'),
+		timestamp=parse_datetime(data.get('Timestamp')).replace(tzinfo=None),
+		participant_status=data.get('ParticipantStatus'),
+		participant_duration=data.get('ParticipantDuration'),
+		participant_id=data.get('ParticipantIdentity'),
+		track_kind=data.get('TrackKind'),
 	)
 
-	room_duration = request.POST.get('RoomDuration')
+	room_duration = data.get('RoomDuration')
 	if room_duration:
 		e.room_duration = timedelta(seconds=int(room_duration))
 
-	participant_duration = request.POST.get('ParticipantDuration')
+	participant_duration = data.get('ParticipantDuration')
 	if participant_duration:
 		e.participant_duration = timedelta(seconds=int(participant_duration))
+	return e
 
+def save_call_event(e):
+	e.resolve_participant()
 	e.save()
-	return HttpResponse(status=200)
+
+def metrics_view(request):
+	# only available to scrapers presenting METRICS_TOKEN as a bearer token
+	expected = 'Bearer {}'.format(settings.METRICS_TOKEN)
+	# compared as bytes, since compare_digest refuses strings with non-ASCII characters
+	if not settings.METRICS_TOKEN or not hmac.compare_digest(request.META.get('HTTP_AUTHORIZATION', '').encode(), expected.encode()):
+		raise Http404
+	return HttpResponse(metrics.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -0,0 +1,73 @@
+"""
+Where a waiting caller is in the queue, and about how long they'll wait.
+
+Counting the earlier rows of PatientPresence.get_queue on every poll would
+scan the queue once per waiting caller. Instead each (site, language)
+queue is kept in the cache as the sorted ids of its waiting patients,
+which is the order doctors take them in, so a caller's position is a
+binary search. Whichever request finds the list older than QUEUE_REFRESH
+seconds reads it again from the queue index, which also drops callers who
+went offline; callers are taken out as soon as they're matched. Callers
+who joined since aren't in it, but everyone waiting before them is.
+
+Matches are also counted in the cache over the last MATCH_RATE_WINDOW
+seconds, and a caller's wait is estimated as their position over that
+rate. Updates hold a lock on their key (see clinic/chatbuffer.py), so set
+CACHE_BACKEND to share all this between workers.
+"""
+
+import bisect, time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from clinic.chatbuffer import locked
+from clinic.models import *
+
+def waiting_key(site_id, language_id):
+	return 'queue:waiting:{}:{}'.format(site_id, language_id)
+
+def matches_key(site_id, language_id):
+	return 'queue:matches:{}:{}'.format(site_id, language_id)
+
+def waiting(site_id, language_id):
+	"Return the ids of the patients waiting in a queue, in order."
+	key = waiting_key(site_id, language_id)
+	entry = cache.get(key)
+	if entry is None:
+		queryset = PatientPresence.objects.filter(site_id=site_id, language_id=language_id)
+		entry = (time.time() + settings.QUEUE_REFRESH, list(PatientPresence.get_queue(queryset).values_list('patient_id', flat=True)))
+		cache.set(key, entry, settings.QUEUE_REFRESH)
+	return entry[1]
+
+def matched(site_id, language_id, patient_id):
+	"Take a matched patient out of their queue and count the match."
+	key = waiting_key(site_id, language_id)
+	with locked(key):
+		entry = cache.get(key)
+		if entry is not None:
+			expires, ids = entry
+			i = bisect.bisect_left(ids, patient_id)
+			if i < len(ids) and ids[i] == patient_id:
+				del ids[i]
+				# keeping its expiry, so the list is still read again in time
+				cache.set(key, entry, max(1, expires - time.time()))
+
+	key = matches_key(site_id, language_id)
+	with locked(key):
+		now = time.time()
+		times = [t for t in cache.get(key, []) if t > now - settings.MATCH_RATE_WINDOW]
+		cache.set(key, times + [now], settings.MATCH_RATE_WINDOW)
+
+def estimated_wait(site_id, language_id, position):
+	"Return the seconds until the caller at position is likely to be matched, or None without recent matches."
+	now = time.time()
+	matches = [t for t in cache.get(matches_key(site_id, language_id), []) if t > now - settings.MATCH_RATE_WINDOW]
+	if not matches:
+		return None
+	return round(position * settings.MATCH_RATE_WINDOW / len(matches))
+
+def status(site_id, language_id, patient_id):
+	"Return a waiting caller's position, from 1, and estimated wait in seconds."
+	position = bisect.bisect_left(waiting(site_id, language_id), patient_id) + 1
+	return {'position': position, 'wait': estimated_wait(site_id, language_id, position)}
@@ -0,0 +1,87 @@
+"""
+Warm up a freshly started process before it serves requests.
+
+Run from medicam/wsgi.py (and again for the database in each worker by
+gunicorn's post_fork hook when the app is preloaded, see gunicorn.conf.py)
+so the first callers after a deploy don't pay for loading the URLconf,
+compiling templates, reading translation catalogs and the static files
+manifest, or opening a database connection.
+"""
+
+from fnmatch import fnmatch
+import logging, os, time
+
+from django.conf import settings
+from django.contrib.sites.models import SITE_CACHE, Site
+from django.contrib.staticfiles.storage import staticfiles_storage
+from django.db import connections
+from django.template import engines
+from django.template.utils import get_app_template_dirs
+from django.urls import get_resolver
+from django.utils import translation
+
+from clinic.models import Language
+
+logger = logging.getLogger(__name__)
+
+def template_names(patterns):
+	for directory in get_app_template_dirs('templates'):
+		for root, dirs, files in os.walk(directory):
+			for name in files:
+				path = os.path.relpath(os.path.join(root, name), directory).replace(os.sep, '/')
+				if any(fnmatch(path, pattern) for pattern in patterns):
+					yield path
+
+def warm_urls():
+	get_resolver().url_patterns
+
+def warm_templates():
+	# with DEBUG off Django uses the cached template loader, so compiled templates are kept for the life of the process
+	for name in template_names(settings.WARMUP_TEMPLATES):
+		for engine in engines.all():
+			engine.get_template(name)
+
+def warm_translations():
+	for code, name in settings.LANGUAGES:
+		with translation.override(code):
+			translation.gettext("Visitor")
+
+def warm_static():
+	# creating the storage reads the manifest of hashed file names
+	staticfiles_storage.base_url
+
+def warm_database():
+	for connection in connections.all():
+		connection.ensure_connection()
+	for site in Site.objects.all():
+		# the cache CurrentSiteMiddleware and get_current_site() look sites up in
+		SITE_CACHE[site.id] = SITE_CACHE[site.domain] = site
+	list(Language.objects.all())
+
+STEPS = [
+	('urls', warm_urls),
+	('templates', warm_templates),
+	('translations', warm_translations),
+	('static', warm_static),
+	('database', warm_database),
+]
+
+def warm_up(steps=None):
+	"Run the named warm-up steps (all of them by default), log and return how long each took in milliseconds."
+	timings = {}
+	start = time.perf_counter()
+	for name, func in STEPS:
+		if steps is not None and name not in steps:
+			continue
+		step_start = time.perf_counter()
+		try:
+			func()
+		except Exception:
+			# a failed warm-up only means the first request is slower
+			logger.exception("Warm-up step %s failed", name)
+		timings[name] = (time.perf_counter() - step_start) * 1000
+	timings['total'] = (time.perf_counter() - start) * 1000
+
+	logger.info("Warmed up process %s in %.0fms (%s)", os.getpid(), timings['total'],
+		', '.join('{} {:.0f}ms'.format(name, ms) for name, ms in timings.items() if name != 'total'))
+	return timings
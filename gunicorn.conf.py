@@ -0,0 +1,20 @@
+# Read by gunicorn from the working directory.
+#
+# medicam/wsgi.py warms up the app when it's loaded. With GUNICORN_PRELOAD
+# set, that happens once in the master and the forked workers share the
+# warmed caches, so the master's database connections are closed before
+# forking and each worker opens its own.
+
+import os
+
+preload_app = bool(os.getenv('GUNICORN_PRELOAD'))
+
+def when_ready(server):
+    if server.cfg.preload_app:
+        from django.db import connections
+        connections.close_all()
+
+def post_fork(server, worker):
+    if server.cfg.preload_app:
+        from clinic import warmup
+        warmup.warm_up(['database'])
@@ -14,7 +14,13 @@ def main():
             "available on your PYTHONPATH environment variable? Did you "
             "forget to activate a virtual environment?"
         ) from exc
-    execute_from_command_line(sys.argv)
+    try:
+        execute_from_command_line(sys.argv)
+    except Exception as e:
+        # Sentry is only loaded when a command fails, to keep commands fast to start
+        from clinic import clients
+        clients.report_exception(e)
+        raise
 
 
 if __name__ == '__main__':
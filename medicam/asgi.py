@@ -12,5 +12,25 @@ import os
 from django.core.asgi import get_asgi_application
 
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'medicam.settings')
+# serve the endpoints clients poll from clinic/async_views.py
+os.environ.setdefault('ASYNC_VIEWS', '1')
 
-application = get_asgi_application()
+django_application = get_asgi_application()
+
+from clinic import sockets
+
+async def application(scope, receive, send):
+    # Django only speaks HTTP; WebSockets go to clinic/sockets.py
+    if scope['type'] == 'websocket':
+        await sockets.application(scope, receive, send)
+    else:
+        await django_application(scope, receive, send)
+
+# load Sentry up front so that errors in the first requests are reported
+from clinic import clients
+clients.sentry()
+
+from django.conf import settings
+if settings.WARMUP:
+    from clinic import warmup
+    warmup.warm_up()
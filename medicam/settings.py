@@ -12,7 +12,7 @@ https://docs.djangoproject.com/en/3.0/ref/settings/
 
 from django.utils.translation import gettext_lazy as _
 import dj_database_url
-import json, os
+import os, tempfile
 
 from dotenv import load_dotenv
 load_dotenv(dotenv_path='./.env')
@@ -59,7 +59,7 @@ INSTALLED_APPS = [
 
 MIDDLEWARE = [
     'django.middleware.security.SecurityMiddleware',
-    'whitenoise.middleware.WhiteNoiseMiddleware',
+    'clinic.middleware.WhiteNoiseMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.locale.LocaleMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -85,6 +85,8 @@ TEMPLATES = [
                 'django.contrib.auth.context_processors.auth',
                 'django.contrib.messages.context_processors.messages',
                 'clinic.context_processors.sentry_config',
+                'clinic.context_processors.long_polling',
+                'clinic.context_processors.chat_socket',
             ],
         },
     },
@@ -109,6 +111,33 @@ DATABASES = {
     'default': dj_database_url.config(conn_max_age=600),
 }
 
+# set REPLICA_DATABASE_URLS to a comma-separated list of read replicas to serve
+# admin changelists, reports and exports (see clinic/routers.py); a replica
+# lagging more than REPLICA_MAX_LAG seconds behind is skipped. Lag is measured
+# by comparing the replica's replayed WAL position with the primary's, which
+# any role may read, so the app's role needs no monitoring privileges
+for i, url in enumerate(filter(None, os.getenv('REPLICA_DATABASE_URLS', '').split(','))):
+    DATABASES['replica{}'.format(i)] = dict(dj_database_url.parse(url.strip(), conn_max_age=600), TEST={'MIRROR': 'default'})
+
+DATABASE_ROUTERS = ['clinic.routers.ReplicaRouter']
+REPLICA_MAX_LAG = int(os.getenv('REPLICA_MAX_LAG', 10))
+
+
+# Cache
+# https://docs.djangoproject.com/en/3.0/topics/cache/
+
+# set CACHE_BACKEND and CACHE_LOCATION to share the cache between workers,
+# e.g. django.core.cache.backends.db.DatabaseCache and clinic_cache; with the
+# default per-process cache, cached pages and counters are each worker's own,
+# so e.g. a saved volunteer update only shows in the others' homepage once
+# their copy expires
+CACHES = {
+    'default': {
+        'BACKEND': os.getenv('CACHE_BACKEND', 'django.core.cache.backends.locmem.LocMemCache'),
+        'LOCATION': os.getenv('CACHE_LOCATION', ''),
+    },
+}
+
 
 # Password validation
 # https://docs.djangoproject.com/en/3.0/ref/settings/#auth-password-validators
@@ -174,6 +203,12 @@ AWS_SECRET_ACCESS_KEY = os.getenv('AWS_SECRET_ACCESS_KEY')
 
 AWS_DEFAULT_ACL = None
 
+# archive_patients writes old patients to ARCHIVE_STORAGE under ARCHIVE_LOCATION (a
+# key prefix on S3, or a directory with django.core.files.storage.FileSystemStorage)
+ARCHIVE_STORAGE = os.getenv('ARCHIVE_STORAGE', DEFAULT_FILE_STORAGE)
+ARCHIVE_LOCATION = os.getenv('ARCHIVE_LOCATION', 'archive')
+ARCHIVE_AFTER_DAYS = int(os.getenv('ARCHIVE_AFTER_DAYS', 90))
+
 ALLOWED_UPLOAD_EXTENSIONS = ['.doc', '.docx', '.odt', '.rtf', '.pdf', '.jpg', '.png', '.gif', '.tif', '.tiff']
 
 
@@ -186,11 +221,100 @@ TWILIO_API_SECRET = os.getenv('TWILIO_API_SECRET')
 # set TWILIO_CALLBACK_URL to force status callbacks to be sent to a particular URL
 TWILIO_CALLBACK_URL = os.getenv('TWILIO_CALLBACK_URL')
 
+# set CALL_EVENT_RETENTION_DAYS to drop Twilio status callbacks older than that
+# many days (they're kept indefinitely otherwise, see clinic/partitions.py)
+CALL_EVENT_RETENTION_DAYS = os.getenv('CALL_EVENT_RETENTION_DAYS')
+
+# close_stale_sessions ends sessions nobody finished once Twilio reports their
+# room ended, or after STALE_SESSION_MINUTES without either participant being
+# seen (see clinic/sweeper.py)
+STALE_SESSION_MINUTES = int(os.getenv('STALE_SESSION_MINUTES', 120))
+
 # enable WAIT_FOR_TRACK to wait for callers to add a track before matching them
 # (this requires Twilio status callbacks)
 WAIT_FOR_TRACK = os.getenv('WAIT_FOR_TRACK', False)
 
 
+# Long polling
+
+# set LONG_POLL_TIMEOUT to the number of seconds the waiting and session pages
+# may hold a request open waiting to be woken up (see clinic/pubsub.py) rather
+# than refreshing on a timer; keep it under 25 seconds, after which a waiting
+# caller counts as offline, and only enable it with threaded workers or under
+# ASGI (see below), since with sync workers each waiting client holds a worker
+LONG_POLL_TIMEOUT = int(os.getenv('LONG_POLL_TIMEOUT', 0))
+
+# enable ASYNC_VIEWS to serve the wait, queue, chat and room-events endpoints from
+# clinic/async_views.py, so that under an ASGI server a waiting client doesn't
+# hold a thread; medicam/asgi.py enables it, e.g. when run with
+# gunicorn medicam.asgi:application -k uvicorn.workers.UvicornWorker
+ASYNC_VIEWS = os.getenv('ASYNC_VIEWS', False)
+
+# set PUBSUB_BROKER to the dotted path of a clinic.pubsub.Broker subclass to
+# carry wake-ups and chat messages between workers some other way; by default
+# they go through Postgres LISTEN/NOTIFY, or stay in one process on sqlite
+PUBSUB_BROKER = os.getenv('PUBSUB_BROKER')
+
+
+# Chat
+
+# under ASGI, chat goes over a WebSocket (see clinic/sockets.py); either way
+# each message is written as it's sent, unless CHAT_FLUSH_INTERVAL is set, in
+# which case messages are buffered in the cache and written that many seconds
+# later, or as soon as a worker has buffered CHAT_FLUSH_SIZE, with one INSERT
+# per batch (see clinic/chatbuffer.py). Buffering needs CACHE_BACKEND set to a
+# cache the workers share, and is skipped without one
+CHAT_FLUSH_INTERVAL = float(os.getenv('CHAT_FLUSH_INTERVAL', 0))
+CHAT_FLUSH_SIZE = int(os.getenv('CHAT_FLUSH_SIZE', 100))
+
+
+# Queue
+
+# waiting callers are shown their place in the queue and an estimated wait
+# (see clinic/waitlist.py); each queue's order is read from the database at
+# most every QUEUE_REFRESH seconds, and the wait is estimated from the matches
+# made in the last MATCH_RATE_WINDOW seconds
+QUEUE_REFRESH = int(os.getenv('QUEUE_REFRESH', 10))
+MATCH_RATE_WINDOW = int(os.getenv('MATCH_RATE_WINDOW', 1800))
+
+
+# Rate limiting
+
+# RATE_LIMITS caps how often one client may call each of these endpoints,
+# by URL name, with token buckets per IP address and per patient/provider
+# cookie given as (requests per second, burst); clients over the limit get
+# a 429 (see clinic/ratelimit.py). Buckets are kept in the cache, so set
+# CACHE_BACKEND to share them between workers. Set RATE_LIMITING to 0 to
+# turn it off
+RATE_LIMITING = os.getenv('RATE_LIMITING', '1') != '0'
+# clients are told apart by the address the nearest of TRUSTED_PROXY_COUNT
+# proxies in front of the app saw them connect from (1 for the Heroku router);
+# set it to 0 when clients connect to the app directly
+TRUSTED_PROXY_COUNT = int(os.getenv('TRUSTED_PROXY_COUNT', 1))
+RATE_LIMITS = {
+    # polled every few seconds; many callers may share a clinic's address
+    'consultation': {'ip': (10, 200), 'cookie': (1, 20)},
+    'chat': {'ip': (10, 200), 'cookie': (2, 40)},
+    'queue': {'ip': (10, 200), 'cookie': (1, 20)},
+    # each POST creates a patient
+    'disclaimer': {'ip': (0.05, 20), 'methods': ['POST']},
+    # Twilio posts every room's events from a few addresses
+    'twilio_status_callback': {'ip': (200, 2000)},
+}
+
+if RATE_LIMITING:
+    # ahead of sessions and authentication, so a refused request costs no more than the cache lookup
+    MIDDLEWARE.insert(MIDDLEWARE.index('clinic.middleware.WhiteNoiseMiddleware') + 1, 'clinic.ratelimit.RateLimitMiddleware')
+
+
+# Warm-up
+
+# set WARMUP=0 to skip priming caches and connections when the WSGI app loads
+# (see clinic/warmup.py); WARMUP_TEMPLATES are compiled ahead of the first request
+WARMUP = os.getenv('WARMUP', '1') != '0'
+WARMUP_TEMPLATES = ['clinic/*.html']
+
+
 # Logging
 
 LOGGING = {
@@ -214,6 +338,38 @@ LOGGING = {
 }
 
 
+# Instrumentation
+
+# enable INSTRUMENTATION to record per-view query counts and timings
+# (see clinic/instrumentation.py and the instrumentation_report command)
+INSTRUMENTATION = os.getenv('INSTRUMENTATION', False)
+INSTRUMENTATION_DIR = os.getenv('INSTRUMENTATION_DIR', os.path.join(tempfile.gettempdir(), 'medicam-instrumentation'))
+
+if INSTRUMENTATION:
+    MIDDLEWARE.insert(0, 'clinic.instrumentation.InstrumentationMiddleware')
+    TEMPLATES[0]['BACKEND'] = 'clinic.instrumentation.DjangoTemplates'
+
+# enable PROFILING to let staff profile a request by sending an X-Profile
+# header or ?profile= parameter set to a sampling rate between 0 and 1
+# (see clinic/profiling.py and the profiles command). Profiles are written
+# to PROFILING_DIR on the host that served the request; switching profiling
+# off at runtime with the command needs a shared CACHE_BACKEND
+PROFILING = os.getenv('PROFILING', False)
+PROFILING_DIR = os.getenv('PROFILING_DIR', os.path.join(tempfile.gettempdir(), 'medicam-profiles'))
+PROFILING_MAX_PROFILES = int(os.getenv('PROFILING_MAX_PROFILES', 50))
+
+if PROFILING:
+    MIDDLEWARE.append('clinic.profiling.ProfilingMiddleware')
+
+
+# Metrics
+
+# set METRICS_TOKEN to serve Prometheus metrics at /clinic/metrics/ to clients
+# sending it as a bearer token; with several gunicorn workers, also set
+# PROMETHEUS_MULTIPROC_DIR to an empty directory so that counters are shared
+METRICS_TOKEN = os.getenv('METRICS_TOKEN')
+
+
 # Email
 
 ADMINS = [
@@ -233,13 +389,8 @@ if DEBUG:
 
 # Firebase
 
-import firebase_admin
-from firebase_admin import credentials
-
-service_account = os.getenv('FIREBASE_SERVICE_ACCOUNT')
-if service_account:
-    cred = credentials.Certificate(json.loads(service_account))
-    firebase_admin.initialize_app(cred)
+# the app is initialized on first use by clinic.clients.firebase_messaging()
+FIREBASE_SERVICE_ACCOUNT = os.getenv('FIREBASE_SERVICE_ACCOUNT')
 
 # set TEST_FCM_TOKEN to force all push notifications to go to your test device
 TEST_FCM_TOKEN = os.getenv('TEST_FCM_TOKEN')
@@ -247,9 +398,6 @@ TEST_FCM_TOKEN = os.getenv('TEST_FCM_TOKEN')
 
 # Sentry
 
-import sentry_sdk
-from sentry_sdk.integrations.django import DjangoIntegration
-
+# initialized by clinic.clients.sentry() when the WSGI/ASGI application
+# loads; management commands only load it to report an exception
 SENTRY_DSN = os.getenv('SENTRY_DSN')
-if SENTRY_DSN:
-    sentry_sdk.init(dsn=SENTRY_DSN, integrations=[DjangoIntegration()], send_default_pii=False)
@@ -14,3 +14,12 @@ from django.core.wsgi import get_wsgi_application
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'medicam.settings')
 
 application = get_wsgi_application()
+
+# load Sentry up front so that errors in the first requests are reported
+from clinic import clients
+clients.sentry()
+
+from django.conf import settings
+if settings.WARMUP:
+    from clinic import warmup
+    warmup.warm_up()